@@ -2,26 +2,33 @@ from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
 from django.http import HttpResponseRedirect
-from .models import ImageProcessingSession, ImageProcessingRequest
+from .models import ImageProcessingSession, ImageProcessingRequest, StoredBlob
 
 @admin.register(ImageProcessingSession)
 class ImageProcessingSessionAdmin(admin.ModelAdmin):
     list_display = ['session_id', 'created_at', 'get_image_count', 'get_processed_count', 'get_total_size']
-    list_filter = ['created_at']
+    list_filter = ['ephemeral', 'created_at']
     search_fields = ['session_id']
-    readonly_fields = ['session_id', 'created_at']
+    readonly_fields = [
+        'session_id', 'created_at', 'image_count', 'processed_count', 'output_bytes',
+        'first_image_at', 'last_processed_at'
+    ]
     actions = ['delete_selected_sessions']
     
+    # The counts are stored on the session, so the changelist runs the same
+    # queries however many sessions a page shows
     def get_image_count(self, obj):
-        return obj.images.count()
+        return obj.image_count
     get_image_count.short_description = 'Total Images'
+    get_image_count.admin_order_field = 'image_count'
     
     def get_processed_count(self, obj):
-        return obj.images.filter(is_processed=True).count()
+        return obj.processed_count
     get_processed_count.short_description = 'Processed Images'
+    get_processed_count.admin_order_field = 'processed_count'
     
     def get_total_size(self, obj):
-        total_size = sum(img.file_size or 0 for img in obj.images.all())
+        total_size = obj.output_bytes
         if total_size < 1024:
             return f"{total_size} B"
         elif total_size < 1024 * 1024:
@@ -29,6 +36,7 @@ class ImageProcessingSessionAdmin(admin.ModelAdmin):
         else:
             return f"{total_size // (1024 * 1024)} MB"
     get_total_size.short_description = 'Total Size'
+    get_total_size.admin_order_field = 'output_bytes'
     
     def delete_selected_sessions(self, request, queryset):
         """Custom action to delete sessions and their files"""
@@ -48,11 +56,16 @@ class ImageProcessingSessionAdmin(admin.ModelAdmin):
 class ImageProcessingRequestAdmin(admin.ModelAdmin):
     list_display = [
         'original_filename', 'session_link', 'dimensions_comparison', 
-        'dpi', 'is_processed', 'file_size_display', 'created_at'
+        'dpi', 'is_processed', 'file_size_display', 'total_ms', 'decode_ms',
+        'resize_ms', 'encode_ms', 'upload_ms', 'db_ms', 'encode_count', 'created_at'
     ]
-    list_filter = ['is_processed', 'dimension_unit', 'created_at', 'dpi']
+    list_filter = ['is_processed', 'status', 'output_file_type', 'dimension_unit', 'created_at', 'dpi']
     search_fields = ['original_filename', 'session__session_id']
-    readonly_fields = ['created_at', 'processed_at', 'file_size', 'original_width', 'original_height', 'original_file_size']
+    list_select_related = ['session']
+    readonly_fields = [
+        'created_at', 'processed_at', 'file_size', 'original_width', 'original_height', 'original_file_size',
+        'total_ms', 'decode_ms', 'resize_ms', 'encode_ms', 'upload_ms', 'db_ms', 'encode_count'
+    ]
     actions = ['delete_selected_requests']
     
     def session_link(self, obj):
@@ -85,7 +98,7 @@ class ImageProcessingRequestAdmin(admin.ModelAdmin):
     
     fieldsets = (
         ('Image Information', {
-            'fields': ('session', 'original_image', 'processed_image', 'original_filename')
+            'fields': ('session', 'original_image', 'processed_image', 'thumbnail', 'original_filename')
         }),
         ('Original Image Details', {
             'fields': ('original_width', 'original_height', 'original_file_size'),
@@ -102,6 +115,10 @@ class ImageProcessingRequestAdmin(admin.ModelAdmin):
             'fields': ('is_processed', 'created_at', 'processed_at', 'file_size'),
             'classes': ('collapse',)
         }),
+        ('Timings', {
+            'fields': ('total_ms', 'decode_ms', 'resize_ms', 'encode_ms', 'upload_ms', 'db_ms', 'encode_count'),
+            'classes': ('collapse',)
+        }),
     )
     
     def delete_selected_requests(self, request, queryset):
@@ -117,3 +134,10 @@ class ImageProcessingRequestAdmin(admin.ModelAdmin):
         
         self.message_user(request, f"Successfully deleted {deleted_count} requests and their files")
     delete_selected_requests.short_description = "Delete selected requests and all files"
+
+@admin.register(StoredBlob)
+class StoredBlobAdmin(admin.ModelAdmin):
+    list_display = ['sha256', 'path', 'size', 'ref_count', 'created_at']
+    list_filter = ['created_at']
+    search_fields = ['sha256', 'path']
+    readonly_fields = ['sha256', 'path', 'size', 'ref_count', 'created_at']
@@ -0,0 +1,303 @@
+"""
+Admission control for full-resolution decodes.
+
+Every render is charged its estimated decoded size in bytes, worked out from
+the header dimensions before any pixels are decoded. The charge is held
+against two budgets while the render runs:
+
+    process  IMAGE_PROCESS_DECODE_BUDGET_MB, shared by the threads of one
+             worker process
+    host     IMAGE_HOST_DECODE_BUDGET_MB, shared by every worker process on
+             the machine through a locked ledger file (0 disables it)
+
+A job that does not fit waits for budget to free up. Requests give up after
+IMAGE_ADMISSION_WAIT seconds and are answered with 429 and Retry-After;
+background workers wait as long as it takes. A job larger than a whole
+budget is admitted on its own once nothing else holds that budget, so huge
+images are slowed down rather than refused forever.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from django.conf import settings
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the per-process budget applies
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Bytes per pixel of the RGB/RGBA working copy made before resizing
+WORKING_BYTES_PER_PIXEL = 4
+HOST_POLL_INTERVAL = 0.05
+HOST_POLL_MAX_INTERVAL = 0.5
+
+class AdmissionRejected(Exception):
+    """Raised when a job could not be admitted within its wait"""
+    def __init__(self, cost, retry_after):
+        super().__init__(f"Not enough decode budget for {cost // MB} MB")
+        self.cost = cost
+        self.retry_after = retry_after
+
+@lru_cache(maxsize=None)
+def bytes_per_pixel(mode):
+    """Decoded size of one pixel in a Pillow mode, 4 for unknown modes"""
+    if not mode:
+        return WORKING_BYTES_PER_PIXEL
+    try:
+        return max(1, len(Image.new(mode, (1, 1)).tobytes()))
+    except Exception:
+        return WORKING_BYTES_PER_PIXEL
+
+def estimate_decode_cost(width, height, mode=None, output_width=None, output_height=None, band_rows=None):
+    """
+    Peak bytes a render holds: the decoded source, its working copy and the
+    resized output. Sources processed in strips only hold band_rows rows of
+    the source at a time.
+    """
+    height = min(int(height or 0), band_rows) if band_rows else height
+    source_pixels = max(0, int(width or 0)) * max(0, int(height or 0))
+    output_pixels = max(0, int(output_width or 0)) * max(0, int(output_height or 0))
+    return (
+        source_pixels * bytes_per_pixel(mode)
+        + source_pixels * WORKING_BYTES_PER_PIXEL
+        + output_pixels * WORKING_BYTES_PER_PIXEL
+    )
+
+def estimate_request_cost(image_request, mode=None):
+    """Decode cost of an ImageProcessingRequest from its stored dimensions"""
+    return estimate_decode_cost(
+        image_request.original_width, image_request.original_height, mode,
+        image_request.output_width, image_request.output_height
+    )
+
+def get_admission_wait():
+    return float(getattr(settings, 'IMAGE_ADMISSION_WAIT', 10))
+
+def get_retry_after():
+    return int(getattr(settings, 'IMAGE_ADMISSION_RETRY_AFTER', 5))
+
+class ProcessBudget:
+    """Decode budget shared by the threads of this process"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.active_bytes = 0
+        self.queued_bytes = 0
+        self.active_jobs = 0
+        self.queued_jobs = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def budget_bytes(self):
+        return int(getattr(settings, 'IMAGE_PROCESS_DECODE_BUDGET_MB', 1024)) * MB
+
+    def _fits(self, cost):
+        return self.active_jobs == 0 or self.active_bytes + cost <= self.budget_bytes
+
+    def acquire(self, cost, timeout=None):
+        """Reserve cost bytes, waiting up to timeout seconds. Returns False on timeout"""
+        with self._condition:
+            self.queued_bytes += cost
+            self.queued_jobs += 1
+            try:
+                admitted = self._condition.wait_for(lambda: self._fits(cost), timeout=timeout)
+            finally:
+                self.queued_bytes -= cost
+                self.queued_jobs -= 1
+            if not admitted:
+                self.rejected += 1
+                return False
+            self.active_bytes += cost
+            self.active_jobs += 1
+            self.admitted += 1
+            return True
+
+    def release(self, cost, rejected=False):
+        """Return cost bytes; rejected counts a job turned away after acquiring"""
+        with self._condition:
+            self.active_bytes -= cost
+            self.active_jobs -= 1
+            if rejected:
+                self.admitted -= 1
+                self.rejected += 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'budget_bytes': self.budget_bytes,
+                'active_bytes': self.active_bytes,
+                'queued_bytes': self.queued_bytes,
+                'active_jobs': self.active_jobs,
+                'queued_jobs': self.queued_jobs,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class HostBudget:
+    """
+    Decode budget shared by all processes on the machine. The ledger file
+    holds each process's active and queued bytes and is only touched under an
+    exclusive lock; entries of processes that died are dropped on the next
+    access, so a crashed worker does not leak budget.
+    """
+
+    @property
+    def budget_bytes(self):
+        return int(getattr(settings, 'IMAGE_HOST_DECODE_BUDGET_MB', 0)) * MB
+
+    @property
+    def enabled(self):
+        return fcntl is not None and self.budget_bytes > 0
+
+    @property
+    def path(self):
+        return settings.IMAGE_HOST_BUDGET_FILE
+
+    @contextmanager
+    def _ledger(self):
+        """Yield the locked ledger as {pid: [active, queued]}, saving changes"""
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    raw = json.loads(f.read() or '{}')
+                except ValueError:
+                    raw = {}
+                ledger = {
+                    int(pid): entry for pid, entry in raw.items()
+                    if _pid_alive(int(pid))
+                }
+                yield ledger
+                f.seek(0)
+                f.truncate()
+                json.dump({str(pid): entry for pid, entry in ledger.items() if any(entry)}, f)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _adjust(self, ledger, active=0, queued=0):
+        entry = ledger.setdefault(os.getpid(), [0, 0])
+        entry[0] = max(0, entry[0] + active)
+        entry[1] = max(0, entry[1] + queued)
+
+    def _try_acquire(self, cost, queued):
+        with self._ledger() as ledger:
+            active_bytes = sum(entry[0] for entry in ledger.values())
+            if active_bytes == 0 or active_bytes + cost <= self.budget_bytes:
+                self._adjust(ledger, active=cost, queued=-cost if queued else 0)
+                return True
+            if not queued:
+                self._adjust(ledger, queued=cost)
+            return False
+
+    def acquire(self, cost, timeout=None):
+        """Reserve cost bytes on the host, polling the ledger until timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self._try_acquire(cost, queued=False):
+            return True
+        interval = HOST_POLL_INTERVAL
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                if deadline is None:
+                    time.sleep(interval)
+                else:
+                    time.sleep(min(interval, max(0, deadline - time.monotonic())))
+                interval = min(interval * 2, HOST_POLL_MAX_INTERVAL)
+                if self._try_acquire(cost, queued=True):
+                    return True
+        except BaseException:
+            self._cancel(cost)
+            raise
+        self._cancel(cost)
+        return False
+
+    def _cancel(self, cost):
+        with self._ledger() as ledger:
+            self._adjust(ledger, queued=-cost)
+
+    def release(self, cost):
+        with self._ledger() as ledger:
+            self._adjust(ledger, active=-cost)
+
+    def stats(self):
+        if not self.enabled:
+            return None
+        with self._ledger() as ledger:
+            return {
+                'budget_bytes': self.budget_bytes,
+                'active_bytes': sum(entry[0] for entry in ledger.values()),
+                'queued_bytes': sum(entry[1] for entry in ledger.values()),
+                'processes': len(ledger),
+            }
+
+process_budget = ProcessBudget()
+host_budget = HostBudget()
+
+def acquire_budget(cost, timeout=None):
+    """
+    Charge cost bytes against the process and host budgets.
+    Raises AdmissionRejected when they do not free up within timeout seconds.
+    """
+    if cost <= 0:
+        return
+    started = time.monotonic()
+    if not process_budget.acquire(cost, timeout):
+        raise AdmissionRejected(cost, get_retry_after())
+    if not host_budget.enabled:
+        return
+    remaining = None if timeout is None else max(0, timeout - (time.monotonic() - started))
+    try:
+        admitted = host_budget.acquire(cost, remaining)
+    except BaseException:
+        process_budget.release(cost)
+        raise
+    if not admitted:
+        process_budget.release(cost, rejected=True)
+        raise AdmissionRejected(cost, get_retry_after())
+
+def release_budget(cost):
+    if cost <= 0:
+        return
+    if host_budget.enabled:
+        try:
+            host_budget.release(cost)
+        except OSError as e:
+            logger.warning(f"Could not release host decode budget: {e}")
+    process_budget.release(cost)
+
+@contextmanager
+def admit(cost, timeout=None):
+    """Hold cost bytes of decode budget for the duration of the block"""
+    acquire_budget(cost, timeout)
+    try:
+        yield
+    finally:
+        release_budget(cost)
+
+def get_admission_stats():
+    stats = {'process': process_budget.stats()}
+    try:
+        stats['host'] = host_budget.stats()
+    except OSError as e:
+        logger.warning(f"Could not read host decode budget: {e}")
+        stats['host'] = None
+    return stats
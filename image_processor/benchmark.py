@@ -0,0 +1,332 @@
+"""
+Microbenchmarks of the processing engine, run by `manage.py bench_processing`.
+
+A synthetic corpus is generated in memory (no fixtures): photo-like images
+with smooth gradients and fine grain, flat graphics with a few solid colours,
+and pure noise, at several sizes and in every accepted upload format. Each
+corpus image is put through the stages of render_image one at a time so
+their latency can be told apart:
+
+    decode    open and load the source (JPEG draft scaling included)
+    convert   power-of-two reduction and colour conversion
+    resize    final resample to the output size
+    encode    encode in the output format
+    save      write the output to default storage
+    render    the whole render_image call, thumbnails included
+    target    find_optimal_quality for a file size target
+    optimize  try_quality_optimization for the same target
+
+plus throughput of render_image at several thread counts and the ZIP
+download stream. Results are plain dicts so they can be dumped as JSON and
+compared with compare_results.
+"""
+import io
+import platform
+import random
+import statistics
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageDraw, ImageFilter
+
+try:
+    import resource
+except ImportError:  # Windows: peak memory is not reported
+    resource = None
+
+from .encoders import encode_image, get_encoder, output_mode, get_encoder_profile
+from .utils import (
+    prepare_image_for_resize, resize_image, render_image, get_resample_tier,
+    find_optimal_quality, try_quality_optimization, stream_zip
+)
+
+RESULTS_VERSION = 1
+BENCH_DPI = 300
+# Latency changes smaller than this are timer noise, never regressions
+MIN_REGRESSION_MS = 1.0
+
+CORPUS_SIZES = {
+    'small': (640, 480),
+    'medium': (2048, 1536),
+    'large': (6000, 4000),
+}
+
+# Every accepted upload format -> save options for the generated source
+CORPUS_FORMATS = {
+    'JPEG': {'quality': 90},
+    'PNG': {},
+    'GIF': {},
+    'BMP': {},
+    'TIFF': {'compression': 'tiff_lzw'},
+}
+
+GRAPHIC_PALETTE = [
+    (255, 255, 255), (33, 37, 41), (13, 110, 253), (220, 53, 69),
+    (25, 135, 84), (255, 193, 7), (111, 66, 193), (248, 249, 250),
+]
+
+def make_photo(size, seed):
+    """Smooth colour gradients with soft grain, like a camera photo"""
+    rng = random.Random(seed)
+    red = Image.linear_gradient('L').resize(size)
+    green = Image.radial_gradient('L').resize(size)
+    blue = Image.linear_gradient('L').rotate(rng.choice((90, 180, 270))).resize(size)
+    img = Image.merge('RGB', (red, green, blue))
+    grain = Image.effect_noise(size, 48).filter(ImageFilter.GaussianBlur(1.5))
+    return Image.blend(img, Image.merge('RGB', (grain, grain, grain)), 0.3)
+
+def make_graphic(size, seed):
+    """Solid shapes in a handful of colours, like a chart or a logo"""
+    rng = random.Random(seed)
+    img = Image.new('RGB', size, GRAPHIC_PALETTE[0])
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1 = min(width, x0 + rng.randrange(width // 8 + 1, width // 3 + 2))
+        y1 = min(height, y0 + rng.randrange(height // 8 + 1, height // 3 + 2))
+        shape = draw.rectangle if rng.random() < 0.5 else draw.ellipse
+        shape((x0, y0, x1, y1), fill=rng.choice(GRAPHIC_PALETTE[1:]))
+    return img
+
+def make_noise(size, seed):
+    """Uncorrelated noise in every channel, the worst case for encoders"""
+    return Image.merge('RGB', [Image.effect_noise(size, 96 + seed % 8) for _ in range(3)])
+
+CORPUS_KINDS = {
+    'photo': make_photo,
+    'graphic': make_graphic,
+    'noise': make_noise,
+}
+
+def generate_corpus(kinds=None, sizes=None, formats=None):
+    """
+    Encoded source images for every kind x size x format combination.
+    Returns a list of case dicts in the order they should run.
+    """
+    corpus = []
+    for size_name in sizes or CORPUS_SIZES:
+        size = CORPUS_SIZES[size_name]
+        for kind_index, kind in enumerate(kinds or CORPUS_KINDS):
+            img = CORPUS_KINDS[kind](size, seed=kind_index)
+            for source_format in formats or CORPUS_FORMATS:
+                buffer = io.BytesIO()
+                img.save(buffer, format=source_format, **CORPUS_FORMATS[source_format])
+                corpus.append({
+                    'name': f"{kind}-{size_name}-{source_format.lower()}",
+                    'format': source_format,
+                    'width': size[0],
+                    'height': size[1],
+                    'data': buffer.getvalue(),
+                })
+    return corpus
+
+def peak_rss_mb():
+    """High-water mark of this process's resident memory in MB, or None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    divisor = 1024 * 1024 if platform.system() == 'Darwin' else 1024
+    return round(peak / divisor, 1)
+
+def _timed(timings, stage, func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.setdefault(stage, []).append((time.perf_counter() - started) * 1000)
+    return result
+
+def output_size(case, scale):
+    return max(1, round(case['width'] * scale)), max(1, round(case['height'] * scale))
+
+def build_spec(case, output_type, scale, tier):
+    width, height = output_size(case, scale)
+    return {
+        'width': width,
+        'height': height,
+        'dpi': BENCH_DPI,
+        'output_type': output_type,
+        'encoder_profile': get_encoder_profile(),
+        'resample_tier': tier,
+    }
+
+def _decode(data, size):
+    img = Image.open(io.BytesIO(data))
+    if img.format == 'JPEG':
+        img.draft(None, size)
+    img.load()
+    return img
+
+def _save_to_storage(data, extension):
+    name = default_storage.save(f"bench/{uuid.uuid4().hex}.{extension}", ContentFile(data))
+    default_storage.delete(name)
+
+def bench_case(case, output_type='jpg', scale=0.5, repeat=3, tier=None, storage=True):
+    """
+    Time every stage of one corpus image `repeat` times. Returns the median
+    milliseconds per stage, encode counts and output sizes.
+    """
+    tier = get_resample_tier(tier)
+    spec = build_spec(case, output_type, scale, tier)
+    size = (spec['width'], spec['height'])
+    extension = get_encoder(output_type)['extension']
+    timings = {}
+    encodes = {}
+
+    for _ in range(repeat):
+        img = _timed(timings, 'decode', _decode, case['data'], size)
+        mode = output_mode(output_type, img.mode, img.info)
+        img = _timed(timings, 'convert', prepare_image_for_resize, img, *size, mode=mode)
+        resized = _timed(timings, 'resize', resize_image, img, size, tier)
+        data = _timed(timings, 'encode', encode_image, resized, output_type, BENCH_DPI).getvalue()
+        if storage:
+            _timed(timings, 'save', _save_to_storage, data, extension)
+        stats = {'encodes': 0}
+        _timed(timings, 'render', render_image, case['data'], spec, stats=stats, thumbnails={})
+        encodes['render'] = stats['encodes']
+
+        # Aim for half the size of a default-quality JPEG of the output
+        target = len(encode_image(resized.convert('RGB'), 'jpg', BENCH_DPI).getvalue()) // 2
+        stats = {}
+        _timed(timings, 'target', find_optimal_quality, resized.convert('RGB'), target, BENCH_DPI, stats=stats)
+        encodes['target'] = stats.get('encodes', 0)
+        _timed(timings, 'optimize', try_quality_optimization, img.convert('RGB'), *size, target, BENCH_DPI, tier)
+
+    return {
+        'source_bytes': len(case['data']),
+        'source_pixels': case['width'] * case['height'],
+        'output_type': output_type,
+        'output_bytes': len(data),
+        'output_data': data,
+        'stages_ms': {stage: round(statistics.median(values), 3) for stage, values in timings.items()},
+        'encodes': encodes,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def bench_throughput(corpus, concurrency_levels, output_type='jpg', scale=0.5, repeat=3, tier=None):
+    """
+    Render the whole corpus `repeat` times with each number of threads.
+    Pillow releases the GIL while decoding, resampling and encoding, so
+    threads show how far one worker process scales.
+    """
+    tier = get_resample_tier(tier)
+    jobs = [(case, build_spec(case, output_type, scale, tier)) for case in corpus] * repeat
+    pixels = sum(case['width'] * case['height'] for case, _ in jobs)
+    results = {}
+    for threads in concurrency_levels:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            started = time.perf_counter()
+            list(executor.map(lambda job: render_image(job[0]['data'], job[1]), jobs))
+            elapsed = time.perf_counter() - started
+        results[str(threads)] = {
+            'seconds': round(elapsed, 3),
+            'images_per_second': round(len(jobs) / elapsed, 2),
+            'megapixels_per_second': round(pixels / elapsed / 1e6, 2),
+        }
+    return results
+
+def bench_zip(outputs, repeat=3):
+    """Time streaming a ZIP download of (filename, bytes, output type) outputs"""
+    total = sum(len(data) for _, data, _ in outputs)
+    timings = []
+    for _ in range(repeat):
+        entries = []
+        for filename, data, output_type in outputs:
+            zip_info = zipfile.ZipInfo(filename)
+            zip_info.compress_type = (
+                zipfile.ZIP_STORED if get_encoder(output_type)['precompressed'] else zipfile.ZIP_DEFLATED
+            )
+            entries.append((zip_info, io.BytesIO(data), len(data)))
+        started = time.perf_counter()
+        for _ in stream_zip(entries):
+            pass
+        timings.append((time.perf_counter() - started) * 1000)
+    median = statistics.median(timings)
+    return {
+        'members': len(outputs),
+        'bytes': total,
+        'ms': round(median, 3),
+        'mb_per_second': round(total / (1024 * 1024) / (median / 1000), 2) if median else None,
+    }
+
+def run_benchmark(kinds=None, sizes=None, formats=None, output_types=('jpg',), scale=0.5,
+                  repeat=3, concurrency_levels=(1,), tier=None, storage=True, progress=None):
+    """Run the whole suite and return the results dict"""
+    corpus = generate_corpus(kinds, sizes, formats)
+    started = time.perf_counter()
+    cases = {}
+    outputs = []
+    for case in corpus:
+        for output_type in output_types:
+            name = f"{case['name']}->{output_type}"
+            if progress:
+                progress(name)
+            result = bench_case(case, output_type, scale, repeat, tier, storage)
+            extension = get_encoder(output_type)['extension']
+            outputs.append((f"{name.replace('->', '.')}.{extension}", result.pop('output_data'), output_type))
+            cases[name] = result
+
+    return {
+        'version': RESULTS_VERSION,
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': Image.__version__,
+            'machine': platform.machine(),
+        },
+        'options': {
+            'kinds': list(kinds or CORPUS_KINDS),
+            'sizes': list(sizes or CORPUS_SIZES),
+            'formats': list(formats or CORPUS_FORMATS),
+            'output_types': list(output_types),
+            'scale': scale,
+            'repeat': repeat,
+            'resample_tier': get_resample_tier(tier),
+            'encoder_profile': get_encoder_profile(),
+        },
+        'cases': cases,
+        'throughput': bench_throughput(corpus, concurrency_levels, output_types[0], scale, repeat, tier),
+        'zip': bench_zip(outputs, repeat),
+        'peak_rss_mb': peak_rss_mb(),
+        'seconds': round(time.perf_counter() - started, 2),
+    }
+
+def compare_results(current, baseline, threshold=0.1):
+    """
+    Regressions of current against a baseline run: stage latencies or the
+    ZIP stream more than `threshold` slower, or throughput more than
+    `threshold` lower. Cases are matched by name; the corpus-wide throughput
+    and ZIP numbers are only compared when both runs used the same options.
+    Returns a list of human-readable descriptions.
+    """
+    regressions = []
+    same_options = current.get('options') == baseline.get('options')
+
+    def slower(label, now, before):
+        if now is None or before is None:
+            return
+        if now > before * (1 + threshold) and now - before >= MIN_REGRESSION_MS:
+            regressions.append(f"{label}: {before:.1f} ms -> {now:.1f} ms (+{(now / before - 1) * 100:.0f}%)")
+
+    for name, case in current.get('cases', {}).items():
+        baseline_case = baseline.get('cases', {}).get(name)
+        if not baseline_case:
+            continue
+        for stage, value in case['stages_ms'].items():
+            slower(f"{name} {stage}", value, baseline_case['stages_ms'].get(stage))
+
+    if not same_options:
+        return regressions
+
+    for threads, result in current.get('throughput', {}).items():
+        before = baseline.get('throughput', {}).get(threads)
+        if before and result['images_per_second'] < before['images_per_second'] * (1 - threshold):
+            regressions.append(
+                f"throughput x{threads}: {before['images_per_second']} -> "
+                f"{result['images_per_second']} images/s"
+            )
+
+    slower('zip', current.get('zip', {}).get('ms'), baseline.get('zip', {}).get('ms'))
+    return regressions
@@ -0,0 +1,200 @@
+"""
+Content-addressed storage for originals and processed outputs.
+
+Files are stored once per SHA-256 digest under a sharded path
+(cas/ab/cd/<digest>.<ext>) and tracked by StoredBlob rows with a reference
+count. Uploading content that is already stored only bumps the count, and a
+file is removed from storage when its last reference is released.
+
+Storing is split into lookup_blob / upload_blob / register_blob so callers
+can overlap hashing, storage writes and database work. Bulk cleanup uses
+release_blobs, remove_unreferenced_blobs and delete_storage_files instead of
+releasing one blob at a time.
+"""
+import hashlib
+import logging
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.storage import default_storage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .models import StoredBlob
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 64 * 1024
+# Digests per IN (...) clause, below SQLite's bound parameter limit
+BULK_QUERY_SIZE = 500
+
+def hash_file(file):
+    """SHA-256 hex digest of a file object, leaving it rewound"""
+    digest = hashlib.sha256()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    if hasattr(file, 'chunks'):
+        for chunk in file.chunks(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    else:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return digest.hexdigest()
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+def blob_path(digest, extension):
+    """Sharded storage path for a digest, e.g. cas/ab/cd/abcd....jpg"""
+    extension = extension.lstrip('.').lower() or 'bin'
+    return f"cas/{digest[:2]}/{digest[2:4]}/{digest}.{extension}"
+
+def lookup_blob(digest):
+    """Return the stored path for a digest, or None if it is not stored yet"""
+    return StoredBlob.objects.filter(sha256=digest).values_list('path', flat=True).first()
+
+def upload_blob(digest, file, extension):
+    """
+    Write a file to its content-addressed path and return the stored name.
+    A file already at the path is left alone: it may be the file of a blob
+    being deleted, or of a concurrent upload of the same content, so the
+    storage picks another name and register_blob removes the spare copy.
+    """
+    path = blob_path(digest, extension)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return default_storage.save(path, file)
+
+def register_blob(digest, path, size):
+    """
+    Add a reference to a blob just uploaded to `path`, creating its row on
+    first use. Returns the path on record for the digest; when that is not
+    `path`, the uploaded copy is a stray and is deleted.
+    """
+    updated = StoredBlob.objects.filter(sha256=digest).update(ref_count=F('ref_count') + 1)
+    if updated:
+        recorded = lookup_blob(digest)
+    else:
+        try:
+            with transaction.atomic():
+                StoredBlob.objects.create(sha256=digest, path=path, size=size, ref_count=1)
+            recorded = path
+        except IntegrityError:
+            # Registered concurrently by another request
+            StoredBlob.objects.filter(sha256=digest).update(ref_count=F('ref_count') + 1)
+            recorded = lookup_blob(digest)
+    if recorded != path:
+        _delete_storage_file(path)
+    return recorded
+
+def retain_blob(digest):
+    """Add a reference to a blob that is known to be stored"""
+    return StoredBlob.objects.filter(sha256=digest).update(ref_count=F('ref_count') + 1) > 0
+
+def store_blob(file, extension, digest=None):
+    """
+    Store a file by content and take a reference to it.
+    Returns (digest, stored path).
+    """
+    digest = digest or hash_file(file)
+    if retain_blob(digest):
+        return digest, lookup_blob(digest)
+    path = upload_blob(digest, file, extension)
+    return digest, register_blob(digest, path, getattr(file, 'size', 0) or 0)
+
+def release_blob(digest):
+    """
+    Drop a reference to a blob. Once the surrounding transaction commits,
+    blobs that are no longer referenced are removed from storage.
+    """
+    if not digest:
+        return
+    StoredBlob.objects.filter(sha256=digest, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+    transaction.on_commit(lambda: delete_unreferenced_blob(digest))
+
+def delete_unreferenced_blob(digest):
+    """
+    Delete a blob's file and row if nothing references it any more.
+    Returns True when it was deleted.
+    """
+    path = lookup_blob(digest)
+    if path is None:
+        return False
+    deleted, _ = StoredBlob.objects.filter(sha256=digest, ref_count=0).delete()
+    if not deleted:
+        return False
+    # Safe once the row is gone: a store of the same content from now on
+    # uploads a new copy, under another name while this file still exists
+    _delete_storage_file(path)
+    return True
+
+def _chunks(items, size=BULK_QUERY_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def release_blobs(digests):
+    """
+    Drop one reference per occurrence of each digest (empty ones ignored) in
+    a few bulk updates. Returns the digests left without references; once
+    the transaction has committed, pass them to remove_unreferenced_blobs.
+    """
+    counts = Counter(digest for digest in digests if digest)
+    by_count = defaultdict(list)
+    for digest, count in counts.items():
+        by_count[count].append(digest)
+    for count, group in by_count.items():
+        for chunk in _chunks(group):
+            StoredBlob.objects.filter(sha256__in=chunk).update(
+                ref_count=Greatest(F('ref_count') - count, 0)
+            )
+
+    unreferenced = []
+    for chunk in _chunks(counts):
+        unreferenced.extend(
+            StoredBlob.objects.filter(sha256__in=chunk, ref_count=0).values_list('sha256', flat=True)
+        )
+    return unreferenced
+
+def remove_unreferenced_blobs(digests):
+    """
+    Bulk version of the row half of delete_unreferenced_blob: delete the rows
+    of those blobs that are still unreferenced (another request may have
+    stored the same content again meanwhile). Returns their (path, size)
+    for the caller to delete the files with delete_storage_files.
+    """
+    removed = []
+    for chunk in _chunks(list(digests)):
+        with transaction.atomic():
+            # Locked so a concurrent retain_blob waits, then finds no row
+            rows = list(
+                StoredBlob.objects.select_for_update()
+                .filter(sha256__in=chunk, ref_count=0)
+                .values_list('id', 'path', 'size')
+            )
+            StoredBlob.objects.filter(id__in=[row[0] for row in rows], ref_count=0).delete()
+        removed.extend((path, size) for _, path, size in rows)
+    return removed
+
+def _delete_storage_file(path):
+    try:
+        default_storage.delete(path)
+        return True
+    except Exception as e:
+        logger.warning(f"Could not delete {path} from storage: {e}")
+        return False
+
+def delete_storage_files(paths, workers=8):
+    """
+    Delete files from default storage, `workers` at a time since each delete
+    is a round trip on remote storage. Returns the number deleted.
+    """
+    paths = list(paths)
+    if not paths:
+        return 0
+    if workers <= 1 or len(paths) == 1:
+        return sum(_delete_storage_file(path) for path in paths)
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths)), thread_name_prefix='storage-delete') as executor:
+        return sum(executor.map(_delete_storage_file, paths))
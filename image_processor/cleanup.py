@@ -0,0 +1,113 @@
+"""
+Bulk deletion of expired sessions, used by `manage.py cleanup_sessions`.
+
+Sessions are deleted a batch at a time, oldest first. Each batch is one
+transaction that deletes the sessions and their requests with
+QuerySet.delete() and drops the batch's references to content-addressed
+files in a few bulk updates (see blobs.release_blobs); the requests'
+pre_delete handler only collects them meanwhile (models.defer_request_cleanup)
+instead of releasing every file on its own. Once the transaction has
+committed, blobs that are still unreferenced lose their rows and then their
+files, which are removed from storage concurrently.
+
+Every batch commits on its own, so an interrupted run rolls back at most the
+batch in flight, and running again simply carries on with the sessions that
+are left. Blobs it released but did not get to remove are removed first.
+"""
+import time
+from django.db import transaction
+
+from .blobs import release_blobs, remove_unreferenced_blobs, delete_storage_files
+from .models import ImageProcessingSession, ImageProcessingRequest, StoredBlob, defer_request_cleanup
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_STORAGE_WORKERS = 8
+
+# (hash field, file field, size field) of every file a request references.
+# Files stored before content addressing have no hash and are only used by
+# their own request.
+REQUEST_FILE_FIELDS = (
+    ('original_hash', 'original_image', 'original_file_size'),
+    ('processed_hash', 'processed_image', 'file_size'),
+    ('thumbnail_hash', 'thumbnail', None),
+    ('thumbnail_2x_hash', 'thumbnail_2x', None),
+)
+
+def expired_sessions(cutoff):
+    return ImageProcessingSession.objects.filter(created_at__lt=cutoff)
+
+def next_batch(cutoff, batch_size=DEFAULT_BATCH_SIZE):
+    """Ids of the oldest batch_size sessions created before cutoff"""
+    return list(
+        expired_sessions(cutoff).order_by('created_at', 'id').values_list('id', flat=True)[:batch_size]
+    )
+
+def delete_session_batch(session_ids, storage_workers=DEFAULT_STORAGE_WORKERS):
+    """
+    Delete sessions and their requests, then the files nothing references
+    any more. Returns a dict of counts: sessions, requests, files and bytes
+    freed.
+    """
+    with transaction.atomic():
+        with defer_request_cleanup() as deleted_requests:
+            _, deleted = ImageProcessingSession.objects.filter(id__in=session_ids).delete()
+        digests = []
+        legacy_files = []
+        for request in deleted_requests:
+            for hash_field, file_field, size_field in REQUEST_FILE_FIELDS:
+                name = getattr(request, file_field).name
+                if getattr(request, hash_field):
+                    digests.append(getattr(request, hash_field))
+                elif name:
+                    legacy_files.append((name, (getattr(request, size_field) or 0) if size_field else 0))
+        unreferenced = release_blobs(digests)
+
+    # Only blobs still unreferenced now that the batch has committed
+    files = remove_unreferenced_blobs(unreferenced) + legacy_files
+    deleted_files = delete_storage_files([path for path, _ in files], storage_workers)
+    return {
+        'sessions': deleted.get(ImageProcessingSession._meta.label, 0),
+        'requests': deleted.get(ImageProcessingRequest._meta.label, 0),
+        'files': deleted_files,
+        'bytes': sum(size for _, size in files),
+    }
+
+def delete_unreferenced_blobs(storage_workers=DEFAULT_STORAGE_WORKERS):
+    """
+    Remove every blob left without references, e.g. by an interrupted run.
+    Returns a dict of counts: files and bytes freed.
+    """
+    digests = StoredBlob.objects.filter(ref_count=0).values_list('sha256', flat=True)
+    files = remove_unreferenced_blobs(list(digests))
+    return {
+        'files': delete_storage_files([path for path, _ in files], storage_workers),
+        'bytes': sum(size for _, size in files),
+    }
+
+def cleanup_expired_sessions(cutoff, batch_size=DEFAULT_BATCH_SIZE, time_budget=None,
+                             storage_workers=DEFAULT_STORAGE_WORKERS, progress=None):
+    """
+    Delete sessions created before cutoff in batches until none are left or
+    time_budget seconds have passed. progress, if given, is called with the
+    running totals after every batch. Returns the totals, with 'complete'
+    set when no expired sessions are left.
+    """
+    started = time.monotonic()
+    totals = {'sessions': 0, 'requests': 0, 'batches': 0, 'complete': False}
+    totals.update(delete_unreferenced_blobs(storage_workers))
+    while True:
+        if time_budget and time.monotonic() - started >= time_budget:
+            break
+        session_ids = next_batch(cutoff, batch_size)
+        if not session_ids:
+            totals['complete'] = True
+            break
+        batch = delete_session_batch(session_ids, storage_workers)
+        for key, value in batch.items():
+            totals[key] += value
+        totals['batches'] += 1
+        totals['seconds'] = time.monotonic() - started
+        if progress:
+            progress(totals)
+    totals['seconds'] = time.monotonic() - started
+    return totals
@@ -1,41 +1,186 @@
 """
 Database utility functions for handling connections in serverless environments.
+
+DB_CONNECTION_MODE picks how connections outlive a request (the DATABASES
+options are set from it in settings.py). DatabaseConnectionMiddleware calls
+acquire_connection() at the start of each request and release_connection()
+at the end. An open connection is health-checked when the request starts;
+a new one is only opened once the request queries, and counted then through
+the connection_created signal, timed from the start of the request. get_connection_stats() reports how long
+getting a usable connection took and how often an existing one was reused.
 """
 import logging
+import threading
 import time
 from functools import wraps
-from django.db import connection, DatabaseError
+from django.db import DEFAULT_DB_ALIAS, connection, InterfaceError, OperationalError
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+CONNECTION_MODES = ('persistent', 'serverless', 'pool', 'close')
+RETRYABLE_DB_ERRORS = (OperationalError, InterfaceError)
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {
+    'acquired': 0,
+    'reused': 0,
+    'opened': 0,
+    'idle_closed': 0,
+    'health_check_failed': 0,
+    'acquire_ms': 0.0,
+    'max_acquire_ms': 0.0,
+}
+_watched_pools = set()
+
+def get_connection_mode():
+    mode = getattr(settings, 'DB_CONNECTION_MODE', 'serverless')
+    return mode if mode in CONNECTION_MODES else 'serverless'
+
+def _connection_pool():
+    """The in-process pool behind the default connection, if it uses one"""
+    try:
+        from dj_db_conn_pool.core import pool_container
+    except ImportError:
+        return None
+    return pool_container.get(connection.alias) if pool_container.has(connection.alias) else None
+
+def _watch_pool(pool):
+    """
+    Note when the pool opens a database connection, which it only does when
+    none is free, so pooled checkouts can be told apart from new
+    connections. Returns False if the pool was already watched.
+    """
+    with _stats_lock:
+        if id(pool) in _watched_pools:
+            return False
+        _watched_pools.add(id(pool))
+    from sqlalchemy import event
+    event.listen(pool, 'connect', lambda *args: setattr(_local, 'pool_opened', True))
+    return True
+
+def _record(elapsed, reused, counts=None):
+    with _stats_lock:
+        _stats['acquired'] += 1
+        _stats['reused' if reused else 'opened'] += 1
+        _stats['acquire_ms'] += elapsed
+        _stats['max_acquire_ms'] = max(_stats['max_acquire_ms'], elapsed)
+        for name, value in (counts or {}).items():
+            _stats[name] += value
+
+def acquire_connection():
+    """
+    Check the connection a request inherits before it runs. One that is
+    already open is health-checked, timed and counted as reused; in
+    serverless mode it is closed instead if it has been idle for longer than
+    DB_CONN_IDLE_TIMEOUT. Nothing is opened here: a request that needs the
+    database opens its connection when it first queries, and that is timed
+    by _connection_opened. Returns the milliseconds spent, or None.
+    """
+    _local.in_request = True
+    _local.request_started = time.perf_counter()
+    if connection.connection is None:
+        return None
+    counts = {'idle_closed': 0, 'health_check_failed': 0}
+    if get_connection_mode() == 'serverless':
+        idle = time.monotonic() - getattr(_local, 'released_at', 0)
+        if idle > getattr(settings, 'DB_CONN_IDLE_TIMEOUT', 30):
+            connection.close()
+            counts['idle_closed'] = 1
+
+    elapsed = None
+    if connection.connection is not None:
+        started = time.perf_counter()
+        connection.close_if_health_check_failed()
+        if connection.connection is None:
+            counts['health_check_failed'] = 1
+        else:
+            elapsed = (time.perf_counter() - started) * 1000
+
+    if elapsed is not None:
+        _record(elapsed, reused=True, counts=counts)
+    else:
+        # Counted as acquired when the request opens its new connection
+        with _stats_lock:
+            for name, value in counts.items():
+                _stats[name] += value
+    return elapsed
+
+@receiver(connection_created)
+def _connection_opened(sender, **kwargs):
+    """
+    Time a connection opened by a request, or checked out of the pool: how
+    long after the request started its connection was ready
+    """
+    opened = kwargs['connection']
+    if opened.alias != DEFAULT_DB_ALIAS or not getattr(_local, 'in_request', False):
+        return
+    elapsed = (time.perf_counter() - _local.request_started) * 1000
+
+    reused = False
+    pool = _connection_pool() if get_connection_mode() == 'pool' else None
+    if pool is not None:
+        # The pool is created with its first connection
+        reused = not _watch_pool(pool) and not getattr(_local, 'pool_opened', False)
+        _local.pool_opened = False
+    _record(elapsed, reused)
+
+def release_connection():
+    """Note when the request stopped using its connection, for the idle timeout"""
+    _local.in_request = False
+    _local.released_at = time.monotonic()
+
+def get_connection_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    acquired = stats['acquired']
+    stats['mode'] = get_connection_mode()
+    stats['acquire_ms'] = round(stats['acquire_ms'], 2)
+    stats['max_acquire_ms'] = round(stats['max_acquire_ms'], 2)
+    stats['avg_acquire_ms'] = round(stats['acquire_ms'] / acquired, 2) if acquired else None
+    stats['reuse_ratio'] = round(stats['reused'] / acquired, 4) if acquired else None
+    pool = _connection_pool()
+    if pool is not None:
+        stats['pool'] = {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+        }
+    return stats
+
 def retry_on_db_error(max_retries=3, delay=1):
     """
     Decorator to retry database operations on connection errors.
+    Only OperationalError and InterfaceError (a dropped or refused
+    connection) are retried; anything else, including integrity errors, is
+    raised straight away. Inside a transaction the first failure is raised
+    too, since the transaction is lost either way. Keep the wrapped function
+    to the database work, so a retry does not repeat anything expensive.
     """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            last_exception = None
-            
             for attempt in range(max_retries):
                 try:
-                    # Ensure connection is closed before retry
+                    # Only drop the connection if the failure broke it
                     if attempt > 0:
-                        connection.close()
+                        connection.close_if_unusable_or_obsolete()
                         time.sleep(delay * attempt)  # Exponential backoff
                     
                     return func(*args, **kwargs)
                     
-                except (DatabaseError, Exception) as e:
-                    last_exception = e
+                except RETRYABLE_DB_ERRORS as e:
+                    if connection.in_atomic_block:
+                        raise
                     logger.warning(f"Database operation failed (attempt {attempt + 1}/{max_retries}): {e}")
                     
                     if attempt == max_retries - 1:
                         logger.error(f"Database operation failed after {max_retries} attempts")
-                        raise last_exception
-                        
-            return None
+                        raise
         return wrapper
     return decorator
 
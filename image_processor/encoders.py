@@ -0,0 +1,148 @@
+"""
+Output encoders keyed by ImageProcessingRequest.output_file_type.
+
+Each entry declares the Pillow format, file extension and content type of
+the output, whether the format has a quality knob (and so supports file size
+targets), whether its data is already compressed (stored as-is in ZIP
+downloads), and per-profile save options. The profile trades CPU time for
+bytes and is chosen per deployment with IMAGE_ENCODER_PROFILE:
+
+    fast      cheapest encode, largest files
+    balanced  default; matches the previous JPEG output (quality 95, optimized)
+    small     slowest encode, smallest files
+"""
+import io
+from django.conf import settings
+
+OUTPUT_ENCODERS = {
+    'jpg': {
+        'format': 'JPEG',
+        'extension': 'jpg',
+        'content_type': 'image/jpeg',
+        'precompressed': True,
+        'supports_quality': True,
+        'supports_alpha': False,
+        'supports_dpi': True,
+        'default_quality': 95,
+        'profiles': {
+            'fast': {'optimize': False},
+            'balanced': {'optimize': True},
+            'small': {'optimize': True, 'progressive': True},
+        },
+    },
+    'webp': {
+        'format': 'WEBP',
+        'extension': 'webp',
+        'content_type': 'image/webp',
+        'precompressed': True,
+        'supports_quality': True,
+        'supports_alpha': True,
+        'supports_dpi': False,
+        'default_quality': 90,
+        'profiles': {
+            'fast': {'method': 0},
+            'balanced': {'method': 4},
+            'small': {'method': 6},
+        },
+    },
+    'png': {
+        'format': 'PNG',
+        'extension': 'png',
+        'content_type': 'image/png',
+        'precompressed': True,
+        'supports_quality': False,
+        'supports_alpha': True,
+        'supports_dpi': True,
+        'profiles': {
+            'fast': {'compress_level': 1},
+            'balanced': {'compress_level': 6},
+            'small': {'compress_level': 9, 'optimize': True},
+        },
+    },
+    'tiff': {
+        'format': 'TIFF',
+        'extension': 'tiff',
+        'content_type': 'image/tiff',
+        'precompressed': False,
+        'supports_quality': False,
+        'supports_alpha': True,
+        'supports_dpi': True,
+        'profiles': {
+            'fast': {'compression': 'raw'},
+            'balanced': {'compression': 'tiff_lzw'},
+            'small': {'compression': 'tiff_adobe_deflate'},
+        },
+    },
+    'bmp': {
+        'format': 'BMP',
+        'extension': 'bmp',
+        'content_type': 'image/bmp',
+        'precompressed': False,
+        'supports_quality': False,
+        'supports_alpha': False,
+        'supports_dpi': True,
+        'profiles': {
+            'fast': {},
+            'balanced': {},
+            'small': {},
+        },
+    },
+}
+
+DEFAULT_OUTPUT_TYPE = 'jpg'
+DEFAULT_ENCODER_PROFILE = 'balanced'
+ENCODER_PROFILES = ('fast', 'balanced', 'small')
+
+def get_encoder(output_type=None):
+    """Return the registry entry for an output type, JPEG for unknown types"""
+    return OUTPUT_ENCODERS.get(output_type) or OUTPUT_ENCODERS[DEFAULT_OUTPUT_TYPE]
+
+def get_output_type(output_type=None):
+    """Normalise an output type to a registry key"""
+    return output_type if output_type in OUTPUT_ENCODERS else DEFAULT_OUTPUT_TYPE
+
+def get_encoder_profile(profile=None):
+    """
+    Resolve an encoder profile name, falling back to the deployment default
+    (IMAGE_ENCODER_PROFILE) for missing or unknown values.
+    """
+    if profile not in ENCODER_PROFILES:
+        profile = getattr(settings, 'IMAGE_ENCODER_PROFILE', DEFAULT_ENCODER_PROFILE)
+    if profile not in ENCODER_PROFILES:
+        profile = DEFAULT_ENCODER_PROFILE
+    return profile
+
+def output_mode(output_type, source_mode, source_info=None):
+    """
+    Colour mode to render in: RGBA when the source has transparency and the
+    output format can keep it, RGB otherwise
+    """
+    if not get_encoder(output_type)['supports_alpha']:
+        return 'RGB'
+    if source_mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La'):
+        return 'RGBA'
+    if source_mode == 'P' and source_info and 'transparency' in source_info:
+        return 'RGBA'
+    return 'RGB'
+
+def encode_image(img, output_type, dpi_value, quality=None, profile=None, stats=None):
+    """
+    Encode an image with the registry settings for output_type.
+    Returns a buffer positioned at the start. Full-resolution encodes are
+    counted in stats['encodes'] when stats is given.
+    """
+    encoder = get_encoder(output_type)
+    options = dict(encoder['profiles'][get_encoder_profile(profile)])
+    if encoder['supports_quality']:
+        options['quality'] = quality or encoder['default_quality']
+    if encoder['supports_dpi']:
+        options['dpi'] = (dpi_value, dpi_value)
+    if img.mode == 'RGBA' and not encoder['supports_alpha']:
+        img = img.convert('RGB')
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=encoder['format'], **options)
+    if stats is not None:
+        stats['encodes'] = stats.get('encodes', 0) + 1
+    buffer.seek(0)
+    return buffer
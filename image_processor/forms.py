@@ -3,6 +3,9 @@ from django.forms import formset_factory
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Row, Column, Submit, HTML, Div, Field
 from crispy_forms.bootstrap import InlineRadios
+from .models import ImageProcessingRequest
+from .utils import get_ephemeral_mode
+import uuid
 
 class BulkImageProcessingForm(forms.Form):
     """Form for handling multiple image uploads (pixels/cm/inch)"""
@@ -17,8 +20,27 @@ class BulkImageProcessingForm(forms.Form):
             widget=forms.HiddenInput()
         )
         
+        # New for every rendered form; resubmitting the same form with the
+        # same files and settings is recognised as a duplicate
+        self.fields['submission_token'] = forms.CharField(
+            required=False,
+            max_length=64,
+            initial=uuid.uuid4().hex,
+            widget=forms.HiddenInput()
+        )
+        
+        # Offered when the deployment lets users skip storing originals
+        if get_ephemeral_mode() == 'optional':
+            self.fields['ephemeral'] = forms.BooleanField(
+                required=False,
+                label="Don't keep my original images (they cannot be re-processed later)",
+                widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+            )
+        
         for i in range(num_images):
-            self.fields[f'image_{i}'] = forms.ImageField(
+            # Plain FileField: the upload is opened and validated once by
+            # ImageProbe in the view instead of again here
+            self.fields[f'image_{i}'] = forms.FileField(
                 required=False,
                 widget=forms.FileInput(attrs={
                     'class': 'form-control image-upload-input',
@@ -79,6 +101,16 @@ class BulkImageProcessingForm(forms.Form):
                     'placeholder': '300'
                 })
             )
+            self.fields[f'output_file_type_{i}'] = forms.ChoiceField(
+                choices=ImageProcessingRequest.OUTPUT_FILE_TYPE_CHOICES,
+                initial='jpg',
+                required=False,
+                label='Output Format',
+                widget=forms.Select(attrs={
+                    'class': 'form-select',
+                    'data-index': i
+                })
+            )
             self.fields[f'target_file_size_kb_{i}'] = forms.IntegerField(
                 required=False,
                 min_value=5,
@@ -0,0 +1,213 @@
+"""
+Database-backed job queue for image processing.
+
+Each ImageProcessingRequest doubles as a job row. In queue mode the upload
+view only stores the originals and marks the rows as queued; workers started
+with `manage.py process_jobs` claim them with SELECT ... FOR UPDATE SKIP LOCKED
+so several nodes can drain the queue at once. Claims are confirmed with a
+conditional UPDATE as well, which keeps single-node SQLite deployments (where
+row locks are not available) from running a job twice. While a worker holds
+jobs it renews their claims in the background; claims not renewed for the
+lease are returned to the queue, and a worker that lost a claim does not
+write its results.
+"""
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import ImageProcessingRequest
+from .utils import run_processing_job, mark_processing_failed, ClaimLost
+from .admission import admit, estimate_request_cost
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_MODES = ('sync', 'queue')
+
+def get_processing_mode():
+    """Return 'sync' (process inside the request) or 'queue' (hand off to workers)"""
+    mode = getattr(settings, 'IMAGE_PROCESSING_MODE', 'sync')
+    return mode if mode in PROCESSING_MODES else 'sync'
+
+def queue_enabled():
+    return get_processing_mode() == 'queue'
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def requeue_stale_jobs(lease_seconds, max_attempts):
+    """
+    Return jobs whose worker stopped renewing its claim (see ClaimHeartbeat)
+    to the queue, or fail them once they have used up their attempts.
+    Returns (requeued, failed) counts.
+    """
+    cutoff = timezone.now() - timedelta(seconds=lease_seconds)
+    stale = ImageProcessingRequest.objects.filter(
+        status=ImageProcessingRequest.STATUS_PROCESSING,
+        claimed_at__lt=cutoff
+    )
+    failed = stale.filter(attempts__gte=max_attempts).update(
+        status=ImageProcessingRequest.STATUS_FAILED,
+        error_message="Processing did not finish, please try again"
+    )
+    requeued = stale.filter(attempts__lt=max_attempts).update(
+        status=ImageProcessingRequest.STATUS_QUEUED,
+        claimed_at=None,
+        claimed_by=''
+    )
+    return requeued, failed
+
+def claim_jobs(worker_id, batch_size=10):
+    """
+    Claim up to batch_size queued jobs for this worker, oldest first.
+    Rows locked by another worker are skipped rather than waited on.
+    """
+    with transaction.atomic():
+        candidate_ids = list(
+            ImageProcessingRequest.objects
+            .select_for_update(skip_locked=True)
+            .filter(status=ImageProcessingRequest.STATUS_QUEUED)
+            .order_by('created_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+
+        claimed_ids = []
+        now = timezone.now()
+        for job_id in candidate_ids:
+            # Compare-and-set so a row is only ever claimed once, even on
+            # backends that ignore FOR UPDATE
+            updated = ImageProcessingRequest.objects.filter(
+                id=job_id,
+                status=ImageProcessingRequest.STATUS_QUEUED
+            ).update(
+                status=ImageProcessingRequest.STATUS_PROCESSING,
+                claimed_at=now,
+                claimed_by=worker_id,
+                attempts=F('attempts') + 1
+            )
+            if updated:
+                claimed_ids.append(job_id)
+
+    return list(
+        ImageProcessingRequest.objects
+        .filter(id__in=claimed_ids)
+        .select_related('session')
+        .order_by('created_at')
+    )
+
+def renew_claims(job_ids, worker_id):
+    """
+    Move the claim time of jobs this worker still holds to now, so
+    requeue_stale_jobs leaves them alone. Returns the number renewed.
+    """
+    if not job_ids:
+        return 0
+    return ImageProcessingRequest.objects.filter(
+        id__in=list(job_ids),
+        claimed_by=worker_id,
+        status=ImageProcessingRequest.STATUS_PROCESSING
+    ).update(claimed_at=timezone.now())
+
+class ClaimHeartbeat:
+    """
+    Renews the claims of a worker's unfinished jobs every `interval` seconds
+    from a background thread, while they wait for their turn or render:
+
+        with ClaimHeartbeat(worker_id, [job.id for job in jobs], lease / 3) as heartbeat:
+            for job in jobs:
+                ...
+                heartbeat.done(job.id)
+    """
+
+    def __init__(self, worker_id, job_ids, interval):
+        self.worker_id = worker_id
+        self.interval = interval
+        self._job_ids = set(job_ids)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='claim-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def done(self, job_id):
+        with self._lock:
+            self._job_ids.discard(job_id)
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                with self._lock:
+                    job_ids = list(self._job_ids)
+                try:
+                    renew_claims(job_ids, self.worker_id)
+                except Exception as e:
+                    logger.warning(f"Could not renew job claims: {e}")
+        finally:
+            # Connections are per thread
+            connection.close()
+
+def run_job(image_request, worker_id=None, resample_tier=None):
+    """
+    Process a claimed job. Failures are recorded on the row instead of raised
+    so one bad image does not stop the worker. With a worker_id the claim is
+    checked first, and results are only written while it is still held.
+    Returns (success, message); success is None when the claim was lost.
+    """
+    if worker_id is not None:
+        if not renew_claims([image_request.id], worker_id):
+            return None, "Claimed by another worker"
+        image_request._claimed_by = worker_id
+    try:
+        # Workers wait for decode budget instead of turning jobs away
+        with admit(estimate_request_cost(image_request), timeout=None):
+            success, message = run_processing_job(image_request, resample_tier=resample_tier)
+    except ClaimLost as e:
+        return None, str(e)
+    except Exception as e:
+        logger.exception(f"Job {image_request.id} crashed")
+        success, message = False, f"Error processing image: {str(e)}"
+        mark_processing_failed(image_request, message)
+    if not success and worker_id is not None and not ImageProcessingRequest.objects.filter(
+        id=image_request.id, claimed_by=worker_id, status=ImageProcessingRequest.STATUS_FAILED
+    ).exists():
+        # The failure was not recorded, the job belongs to another worker
+        return None, "Claimed by another worker"
+    return success, message
+
+def session_progress(session, images=None):
+    """
+    Summarise the job states of a session for the progress endpoint. Pass
+    the session's images (anything with a status) if they are already
+    loaded to count those instead of querying.
+    """
+    counts = {status: 0 for status, _ in ImageProcessingRequest.STATUS_CHOICES}
+    if images is None:
+        rows = session.images.values('status').annotate(count=Count('id')).order_by()
+        for row in rows:
+            counts[row['status']] = row['count']
+    else:
+        for image in images:
+            status = image['status'] if isinstance(image, dict) else image.status
+            counts[status] += 1
+
+    total = sum(counts.values())
+    pending = counts[ImageProcessingRequest.STATUS_QUEUED] + counts[ImageProcessingRequest.STATUS_PROCESSING]
+    return {
+        'total': total,
+        'queued': counts[ImageProcessingRequest.STATUS_QUEUED],
+        'processing': counts[ImageProcessingRequest.STATUS_PROCESSING],
+        'done': counts[ImageProcessingRequest.STATUS_DONE],
+        'failed': counts[ImageProcessingRequest.STATUS_FAILED],
+        'complete': pending == 0,
+    }
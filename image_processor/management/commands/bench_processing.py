@@ -0,0 +1,126 @@
+from django.core.management.base import BaseCommand, CommandError
+import json
+from image_processor.benchmark import (
+    run_benchmark, compare_results, CORPUS_KINDS, CORPUS_SIZES, CORPUS_FORMATS
+)
+from image_processor.encoders import OUTPUT_ENCODERS
+
+def _choices(value, allowed, normalize=str):
+    items = [normalize(item.strip()) for item in value.split(',') if item.strip()]
+    unknown = [item for item in items if item not in allowed]
+    if unknown:
+        raise CommandError(f"Unknown value(s) {', '.join(unknown)}; choose from {', '.join(allowed)}")
+    return items
+
+class Command(BaseCommand):
+    help = 'Benchmark the image processing stages on a synthetic corpus and print JSON results'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--kinds',
+            default=','.join(CORPUS_KINDS),
+            help=f"Corpus image kinds (default: {','.join(CORPUS_KINDS)})"
+        )
+        parser.add_argument(
+            '--sizes',
+            default='small,medium',
+            help=f"Corpus sizes from {','.join(CORPUS_SIZES)} (default: small,medium)"
+        )
+        parser.add_argument(
+            '--formats',
+            default=','.join(CORPUS_FORMATS),
+            help=f"Source formats (default: {','.join(CORPUS_FORMATS)})"
+        )
+        parser.add_argument(
+            '--output-types',
+            default='jpg',
+            help=f"Output types from {','.join(OUTPUT_ENCODERS)} (default: jpg)"
+        )
+        parser.add_argument(
+            '--scale',
+            type=float,
+            default=0.5,
+            help='Output size as a fraction of the source size (default: 0.5)'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Runs per case; latencies are the median (default: 3)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            default='1,2,4',
+            help='Thread counts for the throughput runs (default: 1,2,4)'
+        )
+        parser.add_argument(
+            '--tier',
+            default=None,
+            help='Resample tier (default: IMAGE_RESAMPLE_TIER)'
+        )
+        parser.add_argument(
+            '--skip-storage',
+            action='store_true',
+            help='Do not time writes to default storage'
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='Write the JSON results to this file instead of stdout'
+        )
+        parser.add_argument(
+            '--baseline',
+            default=None,
+            help='JSON results of an earlier run to compare against'
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=0.1,
+            help='Allowed slowdown against the baseline as a fraction (default: 0.1)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            concurrency = [max(1, int(level)) for level in options['concurrency'].split(',') if level.strip()]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma-separated list of numbers')
+        if options['scale'] <= 0:
+            raise CommandError('--scale must be positive')
+
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read baseline {options['baseline']}: {e}")
+
+        results = run_benchmark(
+            kinds=_choices(options['kinds'], list(CORPUS_KINDS)),
+            sizes=_choices(options['sizes'], list(CORPUS_SIZES)),
+            formats=_choices(options['formats'], list(CORPUS_FORMATS), str.upper),
+            output_types=_choices(options['output_types'], list(OUTPUT_ENCODERS), str.lower),
+            scale=options['scale'],
+            repeat=max(1, options['repeat']),
+            concurrency_levels=concurrency or [1],
+            tier=options['tier'],
+            storage=not options['skip_storage'],
+            progress=lambda name: self.stderr.write(f'Benchmarking {name}'),
+        )
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f"Wrote results to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = compare_results(results, baseline, options['threshold'])
+            for regression in regressions:
+                self.stderr.write(self.style.ERROR(f'Regression: {regression}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regression(s) against {options["baseline"]}')
+            self.stderr.write(self.style.SUCCESS(f'No regressions against {options["baseline"]}'))
@@ -1,11 +1,13 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
-import os
-from image_processor.models import ImageProcessingSession
+from image_processor.cleanup import (
+    expired_sessions, cleanup_expired_sessions, DEFAULT_BATCH_SIZE, DEFAULT_STORAGE_WORKERS
+)
+from image_processor.models import ImageProcessingRequest
 
 class Command(BaseCommand):
-    help = 'Clean up old image processing sessions'
+    help = 'Clean up old image processing sessions and their files'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -19,51 +21,77 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be deleted without actually deleting'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help=f'Sessions deleted per transaction (default: {DEFAULT_BATCH_SIZE})'
+        )
+        parser.add_argument(
+            '--time-budget',
+            type=float,
+            default=0,
+            help='Stop starting new batches after this many seconds; run again to continue (default: no limit)'
+        )
+        parser.add_argument(
+            '--storage-workers',
+            type=int,
+            default=DEFAULT_STORAGE_WORKERS,
+            help=f'Concurrent file deletions (default: {DEFAULT_STORAGE_WORKERS})'
+        )
 
     def handle(self, *args, **options):
         hours = options['hours']
         dry_run = options['dry_run']
-        
+
         # Calculate cutoff time
         cutoff_time = timezone.now() - timedelta(hours=hours)
-        
-        # Find old sessions
-        old_sessions = ImageProcessingSession.objects.filter(created_at__lt=cutoff_time)
-        count = old_sessions.count()
-        
+
         if dry_run:
+            old_sessions = expired_sessions(cutoff_time)
+            request_count = ImageProcessingRequest.objects.filter(session__in=old_sessions).count()
             self.stdout.write(
                 self.style.WARNING(
-                    f'Would delete {count} sessions older than {hours} hours'
+                    f'Would delete {old_sessions.count()} sessions with {request_count} images older than {hours} hours'
                 )
             )
             return
-        
-        if count == 0:
+
+        def report_progress(totals):
+            if options['verbosity'] >= 2:
+                self.stdout.write(
+                    f"Batch {totals['batches']}: {totals['sessions']} sessions, "
+                    f"{totals['requests']} images, {totals['files']} files so far"
+                )
+
+        try:
+            totals = cleanup_expired_sessions(
+                cutoff_time,
+                batch_size=max(1, options['batch_size']),
+                time_budget=options['time_budget'] or None,
+                storage_workers=max(1, options['storage_workers']),
+                progress=report_progress,
+            )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Interrupted; completed batches are kept, run again to continue'))
+            return
+
+        if totals['sessions'] == 0 and totals['complete']:
             self.stdout.write(
                 self.style.SUCCESS('No old sessions to clean up')
             )
             return
-        
-        # Delete old sessions and their files
-        deleted_count = 0
-        
-        for session in old_sessions:
-            try:
-                # With Cloudinary storage, files are automatically managed by the cloud provider
-                # No need to manually delete files
-                
-                # Delete session (this will cascade delete all related objects)
-                session.delete()
-                deleted_count += 1
-                
-            except Exception as e:
-                self.stdout.write(
-                    self.style.ERROR(f'Error deleting session {session.session_id}: {e}')
-                )
-        
+
+        rows = totals['sessions'] + totals['requests']
+        rate = rows / totals['seconds'] if totals['seconds'] else rows
         self.stdout.write(
             self.style.SUCCESS(
-                f'Successfully deleted {deleted_count} old sessions'
+                f"Deleted {totals['sessions']} old sessions and {totals['requests']} images "
+                f"in {totals['seconds']:.1f}s ({rate:.0f} rows/s); removed {totals['files']} files, "
+                f"freed {totals['bytes'] / (1024 * 1024):.1f} MB"
+            )
+        )
+        if not totals['complete']:
+            self.stdout.write(
+                self.style.WARNING('Time budget reached before all old sessions were deleted; run again to continue')
             )
-        ) 
\ No newline at end of file
@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import close_old_connections
+import time
+from image_processor.jobs import claim_jobs, requeue_stale_jobs, run_job, default_worker_id, ClaimHeartbeat
+
+class Command(BaseCommand):
+    help = 'Process queued images (run one or more of these per node)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit instead of polling for new jobs'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10,
+            help='Jobs to claim per round trip (default: 10)'
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=2.0,
+            help='Seconds to wait when the queue is empty (default: 2)'
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=600,
+            help='Seconds before a claimed job is considered abandoned (default: 600)'
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=3,
+            help='Give up on a job after this many claims (default: 3)'
+        )
+        parser.add_argument(
+            '--worker-id',
+            default=None,
+            help='Name recorded on claimed jobs (default: hostname:pid)'
+        )
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id'] or default_worker_id()
+        batch_size = max(1, options['batch_size'])
+        resample_tier = settings.IMAGE_BULK_RESAMPLE_TIER
+
+        self.stdout.write(f'Worker {worker_id} started')
+
+        processed_count = 0
+        failed_count = 0
+
+        try:
+            while True:
+                # Workers never see request_finished, so drop expired or
+                # broken connections here the way Django does between requests
+                close_old_connections()
+                requeued, abandoned = requeue_stale_jobs(options['lease'], options['max_attempts'])
+                if requeued or abandoned:
+                    self.stdout.write(
+                        self.style.WARNING(f'Requeued {requeued} and failed {abandoned} abandoned jobs')
+                    )
+
+                jobs = claim_jobs(worker_id, batch_size)
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+
+                # Claims of jobs still waiting in this batch are renewed
+                # too, so they do not go stale behind a slow render
+                with ClaimHeartbeat(worker_id, [job.id for job in jobs], max(1, options['lease'] / 3)) as heartbeat:
+                    for job in jobs:
+                        success, message = run_job(job, worker_id=worker_id, resample_tier=resample_tier)
+                        heartbeat.done(job.id)
+                        if success is None:
+                            self.stdout.write(self.style.WARNING(f'Job {job.id} skipped: {message}'))
+                        elif success:
+                            processed_count += 1
+                        else:
+                            failed_count += 1
+                            self.stdout.write(
+                                self.style.ERROR(f'Job {job.id} ({job.original_filename}) failed: {message}')
+                            )
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping worker')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Processed {processed_count} images, {failed_count} failed'
+            )
+        )
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+import json
+from image_processor.startup import profile_startup, group_by_package
+
+class Command(BaseCommand):
+    help = 'Measure a cold start in a fresh interpreter and report the import cost per module'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=25,
+            help='Modules to list, slowest first (default: 25)'
+        )
+        parser.add_argument(
+            '--sort',
+            choices=['cumulative', 'self'],
+            default='cumulative',
+            help='Order modules by time including or excluding their imports (default: cumulative)'
+        )
+        parser.add_argument(
+            '--budget-ms',
+            type=float,
+            default=0,
+            help='Fail when the cold start takes longer than this (default: no budget)'
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Print the full results as JSON instead of a table'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            report = profile_startup()
+        except RuntimeError as e:
+            raise CommandError(f'Cold start failed: {e}')
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+        else:
+            self._print_report(report, options['top'], f"{options['sort']}_ms")
+
+        for call in report['network']:
+            self.stdout.write(self.style.WARNING(f'Network call during startup: {call}'))
+
+        budget = options['budget_ms']
+        if budget and report['total_ms'] > budget:
+            raise CommandError(f"Cold start took {report['total_ms']:.0f} ms, over the {budget:.0f} ms budget")
+
+    def _print_report(self, report, top, key):
+        modules = sorted(report['modules'].items(), key=lambda item: item[1][key], reverse=True)
+        self.stdout.write(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for name, timing in modules[:top]:
+            self.stdout.write(f"{timing['cumulative_ms']:>14.1f} {timing['self_ms']:>9.1f}  {name}")
+
+        packages = sorted(group_by_package(report['modules']).items(), key=lambda item: item[1]['self_ms'], reverse=True)
+        self.stdout.write('')
+        self.stdout.write(f"{'self ms':>9} {'modules':>8}  package")
+        for name, package in packages[:top]:
+            self.stdout.write(f"{package['self_ms']:>9.1f} {package['modules']:>8}  {name}")
+
+        self.stdout.write('')
+        self.stdout.write(
+            f"Cold start: {report['total_ms']:.0f} ms ({report['setup_ms']:.0f} ms settings and app loading), "
+            f"{len(report['modules'])} modules imported"
+        )
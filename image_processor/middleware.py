@@ -2,39 +2,31 @@
 Middleware for handling database connections in serverless environments.
 """
 import logging
-from django.db import connection
-from .db_utils import close_db_connections
+from django.db import DatabaseError
+from .db_utils import acquire_connection, release_connection
 
 logger = logging.getLogger(__name__)
 
 class DatabaseConnectionMiddleware:
     """
     Middleware to handle database connections in serverless environments.
-    Ensures connections are properly closed after each request.
+    Health-checks the connection a request inherits, and has the one it
+    opens timed for the connection stats. Whether the connection is then kept, returned to the
+    pool or closed is up to DB_CONNECTION_MODE (see db_utils.py); Django
+    does that itself when the request finishes.
     """
-    
+
     def __init__(self, get_response):
         self.get_response = get_response
-    
+
     def __call__(self, request):
-        # Process request
-        response = self.get_response(request)
-        
-        # Close database connections after response
         try:
-            close_db_connections()
-        except Exception as e:
-            logger.warning(f"Error closing database connections: {e}")
-        
-        return response
-    
-    def process_exception(self, request, exception):
-        """
-        Handle exceptions and ensure database connections are closed.
-        """
+            acquire_connection()
+        except DatabaseError as e:
+            # The view gets the same error if it needs the database
+            logger.warning(f"Could not get a database connection: {e}")
+
         try:
-            close_db_connections()
-        except Exception as e:
-            logger.warning(f"Error closing database connections during exception: {e}")
-        
-        return None 
\ No newline at end of file
+            return self.get_response(request)
+        finally:
+            release_connection()
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:52
+
+from django.db import migrations, models
+
+
+def set_existing_status(apps, schema_editor):
+    # Rows created before the job queue were processed synchronously, so
+    # none of them should be picked up by a worker
+    ImageProcessingRequest = apps.get_model('image_processor', 'ImageProcessingRequest')
+    ImageProcessingRequest.objects.filter(is_processed=True).update(status='done')
+    ImageProcessingRequest.objects.filter(is_processed=False).update(status='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0006_imageprocessingrequest_output_file_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='error_message',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='target_file_size',
+            field=models.PositiveIntegerField(blank=True, help_text='Target output size in bytes', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='imageprocessingrequest',
+            index=models.Index(fields=['status', 'created_at'], name='image_proce_status_a4b296_idx'),
+        ),
+        migrations.RunPython(set_existing_status, migrations.RunPython.noop),
+    ]
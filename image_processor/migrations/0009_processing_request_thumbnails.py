@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:23
+
+import image_processor.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0008_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='thumbnail',
+            field=models.ImageField(blank=True, null=True, upload_to=image_processor.models.cloudinary_upload_path),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='thumbnail_2x',
+            field=models.ImageField(blank=True, null=True, upload_to=image_processor.models.cloudinary_upload_path),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='thumbnail_2x_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='thumbnail_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
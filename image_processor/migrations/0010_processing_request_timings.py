@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0009_processing_request_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='db_ms',
+            field=models.FloatField(blank=True, help_text='Database save time in ms', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='decode_ms',
+            field=models.FloatField(blank=True, help_text='Decoding time in ms', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='encode_count',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Full-size encodes run', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='encode_ms',
+            field=models.FloatField(blank=True, help_text='Encoding and quality search time in ms', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='resize_ms',
+            field=models.FloatField(blank=True, help_text='Resizing time in ms', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='total_ms',
+            field=models.FloatField(blank=True, help_text='Total processing time in ms', null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingrequest',
+            name='upload_ms',
+            field=models.FloatField(blank=True, help_text='Storage upload time in ms', null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0010_processing_request_timings'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='imageprocessingsession',
+            index=models.Index(fields=['created_at'], name='image_proce_created_2d4d2b_idx'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:31
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Q, Sum
+
+STAT_FIELDS = ['image_count', 'processed_count', 'output_bytes', 'first_image_at', 'last_processed_at']
+
+
+def fill_session_stats(apps, schema_editor):
+    # Existing sessions start from their images' current state; from here on
+    # the counts are updated as images are added, processed and deleted
+    ImageProcessingSession = apps.get_model('image_processor', 'ImageProcessingSession')
+    processed = Q(images__is_processed=True)
+    sessions = ImageProcessingSession.objects.annotate(
+        total_images=Count('images'),
+        total_processed=Count('images', filter=processed),
+        total_bytes=Sum('images__file_size', filter=processed),
+        first_created=Min('images__created_at'),
+        last_processed=Max('images__processed_at', filter=processed),
+    ).filter(total_images__gt=0)
+
+    batch = []
+    for session in sessions.iterator(chunk_size=500):
+        session.image_count = session.total_images
+        session.processed_count = session.total_processed
+        session.output_bytes = session.total_bytes or 0
+        session.first_image_at = session.first_created
+        session.last_processed_at = session.last_processed
+        batch.append(session)
+        if len(batch) == 500:
+            ImageProcessingSession.objects.bulk_update(batch, STAT_FIELDS)
+            batch = []
+    if batch:
+        ImageProcessingSession.objects.bulk_update(batch, STAT_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0011_session_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='first_image_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='image_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='last_processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='output_bytes',
+            field=models.PositiveBigIntegerField(default=0, help_text='Total size of the processed images in bytes'),
+        ),
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='processed_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_session_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0012_session_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
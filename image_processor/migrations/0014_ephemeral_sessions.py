@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:46
+
+import image_processor.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_processor', '0013_session_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageprocessingsession',
+            name='ephemeral',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='imageprocessingrequest',
+            name='original_image',
+            field=models.ImageField(blank=True, upload_to=image_processor.models.cloudinary_upload_path),
+        ),
+    ]
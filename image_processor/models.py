@@ -1,11 +1,15 @@
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.conf import settings
+import contextvars
 import uuid
 import os
 import re
 import time
+from contextlib import contextmanager
 
 def cloudinary_upload_path(instance, filename):
     """Generate upload path for Cloudinary storage"""
@@ -33,16 +37,77 @@ def cloudinary_upload_path(instance, filename):
     upload_path = f"img/{session_id}/{clean_name}"
     return upload_path
 
+# Upload path callables referenced by the initial migration. Kept so the
+# migration history still loads; new files use cloudinary_upload_path.
+upload_to_images = cloudinary_upload_path
+upload_to_processed = cloudinary_upload_path
+
+class StoredBlob(models.Model):
+    """A file in content-addressed storage (see image_processor.blobs)"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=255)
+    size = models.PositiveIntegerField(default=0, help_text="Size in bytes")
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.path} ({self.ref_count} refs)"
+
 class ImageProcessingSession(models.Model):
     """Model to group multiple image processing requests"""
     session_id = models.UUIDField(default=uuid.uuid4, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    # Aggregates over the session's images, kept up to date as images are
+    # added, processed and deleted so pages do not have to count them
+    image_count = models.PositiveIntegerField(default=0)
+    processed_count = models.PositiveIntegerField(default=0)
+    output_bytes = models.PositiveBigIntegerField(default=0, help_text="Total size of the processed images in bytes")
+    first_image_at = models.DateTimeField(null=True, blank=True)
+    last_processed_at = models.DateTimeField(null=True, blank=True)
+    
+    # Identifies the form submission that created the session, so a repeated
+    # submission is sent to these results instead of being processed again
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    
+    # Originals were processed from the upload and never stored, so the
+    # images cannot be reprocessed (see IMAGE_EPHEMERAL_MODE)
+    ephemeral = models.BooleanField(default=False)
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
         
     def __str__(self):
         return f"Session {self.session_id}"
+    
+    @property
+    def time_taken_seconds(self):
+        """Seconds from the first image being added to the last one finishing"""
+        if self.first_image_at and self.last_processed_at:
+            return int((self.last_processed_at - self.first_image_at).total_seconds())
+        return None
+    
+    @classmethod
+    def update_stats(cls, session_id, images=0, processed=0, output_bytes=0, image_added_at=None, processed_at=None):
+        """
+        Apply changes to a session's aggregates in a single UPDATE, without
+        reading the row first
+        """
+        changes = {}
+        for field, delta in (('image_count', images), ('processed_count', processed), ('output_bytes', output_bytes)):
+            if delta > 0:
+                changes[field] = F(field) + delta
+            elif delta < 0:
+                changes[field] = Greatest(F(field) + delta, 0)
+        if image_added_at:
+            changes['first_image_at'] = Coalesce(F('first_image_at'), Value(image_added_at))
+        if processed_at:
+            changes['last_processed_at'] = processed_at
+        if changes:
+            cls.objects.filter(pk=session_id).update(**changes)
 
 class ImageProcessingRequest(models.Model):
     UNIT_CHOICES = [
@@ -51,6 +116,17 @@ class ImageProcessingRequest(models.Model):
         ('inch', 'Inches'),
     ]
     
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
     OUTPUT_FILE_TYPE_CHOICES = [
         ('jpg', 'JPG'),
         ('png', 'PNG'),
@@ -61,10 +137,23 @@ class ImageProcessingRequest(models.Model):
     
     session = models.ForeignKey(ImageProcessingSession, on_delete=models.CASCADE, related_name='images')
     
-    # Use default storage configuration from settings
-    original_image = models.ImageField(upload_to=cloudinary_upload_path)
+    # Use default storage configuration from settings; empty in ephemeral
+    # sessions
+    original_image = models.ImageField(upload_to=cloudinary_upload_path, blank=True)
     processed_image = models.ImageField(upload_to=cloudinary_upload_path, null=True, blank=True)
     
+    # Previews of the processed image for the results page, at 1x and 2x
+    # pixel density (see image_processor.thumbnails)
+    thumbnail = models.ImageField(upload_to=cloudinary_upload_path, null=True, blank=True)
+    thumbnail_2x = models.ImageField(upload_to=cloudinary_upload_path, null=True, blank=True)
+    
+    # Content hashes of the stored files (StoredBlob.sha256), empty for files
+    # stored before content addressing
+    original_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    processed_hash = models.CharField(max_length=64, blank=True)
+    thumbnail_hash = models.CharField(max_length=64, blank=True)
+    thumbnail_2x_hash = models.CharField(max_length=64, blank=True)
+    
     # Output file type
     output_file_type = models.CharField(max_length=4, choices=OUTPUT_FILE_TYPE_CHOICES, default='jpg', help_text="Output file format")
     
@@ -85,17 +174,40 @@ class ImageProcessingRequest(models.Model):
     # DPI settings
     dpi = models.PositiveIntegerField(default=300, help_text="Dots per inch")
     
+    # Target output size in bytes (optional)
+    target_file_size = models.PositiveIntegerField(null=True, blank=True, help_text="Target output size in bytes")
+    
     # Processing status
     is_processed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     processed_at = models.DateTimeField(null=True, blank=True)
     
+    # Job queue state (see image_processor.jobs)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    error_message = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=100, blank=True)
+    
+    # Stage timings in milliseconds, recorded when IMAGE_TRACING is on (see
+    # image_processor.tracing)
+    total_ms = models.FloatField(null=True, blank=True, help_text="Total processing time in ms")
+    decode_ms = models.FloatField(null=True, blank=True, help_text="Decoding time in ms")
+    resize_ms = models.FloatField(null=True, blank=True, help_text="Resizing time in ms")
+    encode_ms = models.FloatField(null=True, blank=True, help_text="Encoding and quality search time in ms")
+    upload_ms = models.FloatField(null=True, blank=True, help_text="Storage upload time in ms")
+    db_ms = models.FloatField(null=True, blank=True, help_text="Database save time in ms")
+    encode_count = models.PositiveSmallIntegerField(null=True, blank=True, help_text="Full-size encodes run")
+    
     # File information
     original_filename = models.CharField(max_length=255)
     file_size = models.PositiveIntegerField(null=True, blank=True)  # in bytes
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
         
     def __str__(self):
         return f"{self.original_filename} - {self.output_width}x{self.output_height}"
@@ -123,24 +235,47 @@ class ImageProcessingRequest(models.Model):
             if self.dimension_width <= 0 or self.dimension_height <= 0:
                 raise ValueError("Physical dimensions must be positive")
         
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        if adding and self.session_id:
+            ImageProcessingSession.update_stats(self.session_id, images=1, image_added_at=self.created_at)
+
+_deferred_deletes = contextvars.ContextVar('deferred_request_deletes', default=None)
 
-@receiver(pre_delete, sender=ImageProcessingSession)
-def delete_session_files(sender, instance, **kwargs):
+@contextmanager
+def defer_request_cleanup():
     """
-    Delete all files associated with a session before deleting the session
-    Note: With Cloudinary storage, files are automatically managed by the cloud provider
+    Collect the image requests deleted in the block instead of releasing
+    their files one at a time, for callers that delete whole sessions and
+    release the files in bulk (see cleanup.delete_session_batch). Yields the
+    list the deleted requests are added to.
     """
-    # With Cloudinary storage, we don't need to manually delete files
-    # The cloud storage provider handles file cleanup automatically
-    pass
+    deleted = []
+    token = _deferred_deletes.set(deleted)
+    try:
+        yield deleted
+    finally:
+        _deferred_deletes.reset(token)
 
 @receiver(pre_delete, sender=ImageProcessingRequest)
 def delete_request_files(sender, instance, **kwargs):
     """
-    Delete files associated with an image request before deleting the request
-    Note: With Cloudinary storage, files are automatically managed by the cloud provider
+    Take an image request out of its session's totals and release its
+    content-addressed files before deleting it. Files shared with other
+    requests stay until their last reference is gone.
     """
-    # With Cloudinary storage, we don't need to manually delete files
-    # The cloud storage provider handles file cleanup automatically
-    pass
+    deferred = _deferred_deletes.get()
+    if deferred is not None:
+        deferred.append(instance)
+        return
+    from .blobs import release_blob
+    ImageProcessingSession.update_stats(
+        instance.session_id,
+        images=-1,
+        processed=-1 if instance.is_processed else 0,
+        output_bytes=-(instance.file_size or 0) if instance.is_processed else 0,
+    )
+    release_blob(instance.original_hash)
+    release_blob(instance.processed_hash)
+    release_blob(instance.thumbnail_hash)
+    release_blob(instance.thumbnail_2x_hash)
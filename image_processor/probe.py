@@ -0,0 +1,196 @@
+"""
+Single-pass probing of uploaded images.
+
+ImageProbe opens an upload once, reads what validation, dimension
+calculation and processing need from the header, and keeps the opened (not
+yet decoded) image so processing can decode it straight away instead of
+opening the file again.
+
+The same probe runs on header-only uploads (see upload_handlers), where it
+never needs more than the bytes that were kept. probe_files probes several
+files concurrently for the AJAX endpoints.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from .upload_handlers import HeaderUnavailable
+from .strips import open_strip_reader, open_source_image
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+SUPPORTED_FORMATS = ('JPEG', 'PNG', 'GIF', 'BMP', 'TIFF')
+
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_THUMBNAIL_OFFSET_TAG = 0x0201
+EXIF_THUMBNAIL_LENGTH_TAG = 0x0202
+# Raw EXIF data in img.info starts with this marker before the TIFF header
+EXIF_HEADER = b'Exif\x00\x00'
+
+HEADER_PROBE_THREADS = 4
+# Orientations that rotate the image by 90 or 270 degrees
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def get_exif_orientation(img):
+    """
+    EXIF orientation of an opened image, 1 when absent. Never decodes pixels.
+    """
+    try:
+        if img.format == 'PNG':
+            # PNG.getexif() loads the whole image when the eXIf chunk comes
+            # after the pixel data, so only use what the header already had
+            exif_data = img.info.get('exif')
+            if not exif_data:
+                return 1
+            exif = Image.Exif()
+            exif.load(exif_data)
+        else:
+            exif = img.getexif()
+        orientation = exif.get(EXIF_ORIENTATION_TAG, 1)
+        return orientation if orientation in range(1, 9) else 1
+    except Exception:
+        return 1
+
+def apply_orientation(img, orientation):
+    """Rotate/flip decoded pixels so they display upright without EXIF"""
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    return img.transpose(method) if method is not None else img
+
+class ImageProbe:
+    """
+    Header information about an uploaded image, gathered with one open.
+
+    width and height are the displayed size, i.e. after applying the EXIF
+    orientation. `error` is set when the file cannot be used.
+    `header_incomplete` is set when a header-only upload did not keep enough
+    bytes to read the header; the file is then neither accepted nor rejected.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = file.size
+        self.format = None
+        self.mode = None
+        self.width = None
+        self.height = None
+        self.orientation = 1
+        self.error = None
+        self.header_incomplete = False
+        self._image = None
+        self._probe()
+
+    def _probe(self):
+        if self.size > MAX_UPLOAD_SIZE:
+            self.error = "File size must be less than 10MB"
+            return
+
+        try:
+            if hasattr(self.file, 'seek'):
+                self.file.seek(0)
+            img = open_source_image(self.file)
+        except HeaderUnavailable:
+            self.header_incomplete = True
+            return
+        except Exception as e:
+            self.error = f"Invalid image file: {str(e)}"
+            return
+
+        if img.format not in SUPPORTED_FORMATS:
+            self.error = "Unsupported image format"
+            return
+
+        self._image = img
+        self.format = img.format
+        self.mode = img.mode
+        self.orientation = get_exif_orientation(img)
+        self.width, self.height = img.size
+        if self.orientation in TRANSPOSED_ORIENTATIONS:
+            self.width, self.height = self.height, self.width
+
+    @property
+    def is_valid(self):
+        return self.error is None
+
+    @property
+    def info(self):
+        """The dict get_image_info used to return, plus orientation"""
+        if not self.is_valid or self.header_incomplete:
+            return None
+        return {
+            'width': self.width,
+            'height': self.height,
+            'format': self.format,
+            'mode': self.mode,
+            'size': self.size,
+            'orientation': self.orientation,
+        }
+
+    @property
+    def band_rows(self):
+        """
+        Rows decoded at a time when the image will be processed in strips,
+        None when it is decoded whole
+        """
+        if self._image is None:
+            return None
+        reader = open_strip_reader(self._image)
+        return reader.band_rows if reader is not None else None
+
+    def exif_thumbnail(self):
+        """
+        The JPEG thumbnail embedded in the EXIF data, or None. Only reads the
+        EXIF block that was parsed with the header.
+        """
+        if self._image is None or self.format != 'JPEG':
+            return None
+        raw = self._image.info.get('exif')
+        if not raw or not raw.startswith(EXIF_HEADER):
+            return None
+        from PIL import ExifTags
+        try:
+            ifd1 = self._image.getexif().get_ifd(ExifTags.IFD.IFD1)
+            offset = ifd1.get(EXIF_THUMBNAIL_OFFSET_TAG)
+            length = ifd1.get(EXIF_THUMBNAIL_LENGTH_TAG)
+        except Exception:
+            return None
+        if not offset or not length:
+            return None
+        start = len(EXIF_HEADER) + offset
+        thumbnail = raw[start:start + length]
+        return thumbnail if len(thumbnail) == length else None
+
+    def take_image(self):
+        """
+        Hand over the opened image for decoding. It can only be taken once,
+        later callers get None and should open the file themselves.
+        """
+        img, self._image = self._image, None
+        return img
+
+_probe_pool = None
+_probe_pool_lock = threading.Lock()
+
+def get_probe_pool():
+    global _probe_pool
+    with _probe_pool_lock:
+        if _probe_pool is None:
+            _probe_pool = ThreadPoolExecutor(
+                max_workers=HEADER_PROBE_THREADS,
+                thread_name_prefix='image-probe'
+            )
+        return _probe_pool
+
+def probe_files(files):
+    """Probe several files concurrently, returning probes in the same order"""
+    files = list(files)
+    if len(files) <= 1:
+        return [ImageProbe(file) for file in files]
+    return list(get_probe_pool().map(ImageProbe, files))
@@ -0,0 +1,107 @@
+"""
+Process pool for rendering images outside the request thread.
+
+Bulk submissions fan their per-image work out to a persistent, bounded pool
+of worker processes and gather the results in order. The pool is disabled
+by default (IMAGE_POOL_WORKERS = 0), in which case images are processed
+inline as before.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+
+from .utils import render_image_job
+from .tracing import tracing_enabled
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+def get_pool_workers():
+    """Number of worker processes, 0 when the pool is disabled"""
+    return max(0, int(getattr(settings, 'IMAGE_POOL_WORKERS', 0)))
+
+def processing_pool_enabled():
+    return get_pool_workers() > 0
+
+def get_processing_pool():
+    """
+    Return the shared executor and the semaphore bounding its queue,
+    creating them on first use
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            workers = get_pool_workers()
+            queue_depth = max(0, int(getattr(settings, 'IMAGE_POOL_QUEUE_DEPTH', 20)))
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_slots = threading.BoundedSemaphore(workers + queue_depth)
+        return _pool, _pool_slots
+
+def reset_processing_pool():
+    """Drop a broken pool so the next submission starts a fresh one"""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_slots = None
+
+def _read_source(file):
+    """
+    Turn an uploaded or stored file into something picklable: the path of a
+    temporary upload, or the raw bytes
+    """
+    # The storage backend may have moved the temporary file already
+    if hasattr(file, 'temporary_file_path') and os.path.exists(file.temporary_file_path()):
+        return file.temporary_file_path()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return file.read()
+
+def render_in_pool(jobs):
+    """
+    Render (file, spec) jobs in the process pool.
+    Returns a list of (success, (bytes, thumbnails, timings) or error
+    message) in job order.
+    """
+    pool, slots = get_processing_pool()
+    timeout = getattr(settings, 'IMAGE_POOL_TASK_TIMEOUT', 120)
+
+    trace = tracing_enabled()
+    futures = []
+    for file, spec in jobs:
+        # Wait for room in the queue; every slot frees up when a task ends
+        if not slots.acquire(timeout=timeout):
+            futures.append(None)
+            continue
+        try:
+            future = pool.submit(render_image_job, _read_source(file), spec, trace)
+        except Exception as e:
+            slots.release()
+            logger.warning(f"Could not submit image to processing pool: {e}")
+            futures.append(None)
+            continue
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+
+    results = []
+    for future in futures:
+        if future is None:
+            results.append((False, "Server is busy, please try again shortly"))
+            continue
+        try:
+            results.append(future.result(timeout=timeout))
+        except TimeoutError:
+            results.append((False, "Processing timed out"))
+        except BrokenProcessPool:
+            reset_processing_pool()
+            results.append((False, "Processing worker stopped unexpectedly"))
+        except Exception as e:
+            results.append((False, f"Error processing image: {str(e)}"))
+    return results
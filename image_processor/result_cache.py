@@ -0,0 +1,96 @@
+"""
+Processed-output cache shared by all workers.
+
+Renders are keyed by the source content hash plus the normalised processing
+spec (size, DPI, physical dimensions, target size, output type, encoder
+profile and resample tier). The cached value is the output's content hash,
+its bytes and its thumbnails. On a hit the bytes go through content-addressed storage, which
+only takes a new reference when the output is still stored, so nothing is
+decoded or encoded again. Outputs above IMAGE_RESULT_CACHE_MAX_ITEM_BYTES
+are not cached.
+
+The cache is the IMAGE_RESULT_CACHE_ALIAS Django cache: a bounded on-disk
+store by default, or Redis/Memcached to share results across nodes. Hits
+and misses are counted per worker process, like the connection stats in
+db_utils: the file-based cache has no atomic increment, so shared counters
+would lose updates under concurrent lookups.
+"""
+import hashlib
+import json
+import logging
+import threading
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Bump when rendering changes so old entries stop matching
+RESULT_CACHE_VERSION = 2
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+}
+
+def get_result_cache():
+    alias = getattr(settings, 'IMAGE_RESULT_CACHE_ALIAS', 'default')
+    return caches[alias if alias in settings.CACHES else 'default']
+
+def result_cache_key(image_request, spec):
+    """
+    Cache key for rendering a request's original with a spec, or None when
+    the original has no content hash. Requests of ephemeral sessions carry
+    the hash of their unstored upload as _source_hash.
+    """
+    source_hash = image_request.original_hash or getattr(image_request, '_source_hash', '')
+    if not source_hash:
+        return None
+    normalized = {
+        'source': source_hash,
+        'width': spec['width'],
+        'height': spec['height'],
+        'dpi': spec['dpi'],
+        'unit': image_request.dimension_unit or 'pixels',
+        'physical': [image_request.dimension_width, image_request.dimension_height],
+        'target': spec.get('target_size_bytes') or 0,
+        'output_type': spec.get('output_type', 'jpg'),
+        'profile': spec.get('encoder_profile'),
+        'resample': spec.get('resample_tier'),
+    }
+    digest = hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+    return f"result:{RESULT_CACHE_VERSION}:{digest}"
+
+def lookup_result(image_request, spec):
+    """
+    Return (output hash, output bytes, thumbnails) for a cached render, or None.
+    Counts the hit or miss.
+    """
+    key = result_cache_key(image_request, spec)
+    if key is None:
+        return None
+    try:
+        cached = get_result_cache().get(key)
+    except Exception as e:
+        logger.warning(f"Result cache lookup failed: {e}")
+        cached = None
+    with _stats_lock:
+        _stats['hits' if cached else 'misses'] += 1
+    return cached
+
+def remember_result(image_request, spec, output_hash, data, thumbnails=None):
+    key = result_cache_key(image_request, spec)
+    if key is None or len(data) > getattr(settings, 'IMAGE_RESULT_CACHE_MAX_ITEM_BYTES', 5 * 1024 * 1024):
+        return
+    try:
+        get_result_cache().set(key, (output_hash, data, thumbnails or {}), timeout=getattr(settings, 'IMAGE_RESULT_CACHE_TIMEOUT', None))
+    except Exception as e:
+        logger.warning(f"Result cache store failed: {e}")
+
+def get_result_cache_stats():
+    """Lookups served by this worker process since it started"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else None
+    return stats
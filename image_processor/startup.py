@@ -0,0 +1,138 @@
+"""
+Cold start profiling, used by `manage.py startup_report`.
+
+profile_startup() starts a fresh interpreter that does what a new web
+process does before its first response: load settings, set up Django, build
+the WSGI handler and import the URLconf with every view. Inside it, an
+import hook times the execution of every module, including the ones Django
+loads with importlib (settings, apps, middleware, URLconf), which
+`python -X importtime` leaves out. Name lookups and socket connects made
+during startup are recorded too, since none should happen at import time.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+DEFAULT_TARGETS = ('django.core.wsgi', 'ROOT_URLCONF')
+
+class _TimingLoader:
+    """Wraps a module loader to time exec_module, with and without children"""
+
+    def __init__(self, loader, profiler):
+        self._loader = loader
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        profiler = self._profiler
+        profiler.stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - started
+            children = profiler.stack.pop()
+            if profiler.stack:
+                profiler.stack[-1] += total
+            profiler.modules[module.__name__] = {
+                'cumulative_ms': total * 1000,
+                'self_ms': (total - children) * 1000,
+            }
+
+class ImportProfiler:
+    """Meta path finder that wraps every module loader in a _TimingLoader"""
+
+    def __init__(self):
+        self.modules = {}
+        self.stack = []
+        self.network = []
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimingLoader(spec.loader, self)
+            return spec
+        return None
+
+    def install(self):
+        import socket
+        sys.meta_path.insert(0, self)
+
+        def record(kind, original):
+            def wrapper(*args, **kwargs):
+                self.network.append(f"{kind} {args[0] if kind != 'connect' else args[1]!r}")
+                return original(*args, **kwargs)
+            return wrapper
+
+        socket.getaddrinfo = record('getaddrinfo', socket.getaddrinfo)
+        socket.gethostbyname = record('gethostbyname', socket.gethostbyname)
+        socket.socket.connect = record('connect', socket.socket.connect)
+
+def _run_profile(targets):
+    """Body of the profiling interpreter; prints the results as JSON"""
+    profiler = ImportProfiler()
+    profiler.install()
+    started = time.perf_counter()
+
+    import django
+    from django.conf import settings
+    django.setup()
+    settings_done = time.perf_counter()
+    import importlib
+    for target in targets:
+        module = importlib.import_module(settings.ROOT_URLCONF if target == 'ROOT_URLCONF' else target)
+        if target == 'django.core.wsgi':
+            module.get_wsgi_application()
+    if 'ROOT_URLCONF' in targets:
+        from django.urls import get_resolver
+        get_resolver().url_patterns
+    finished = time.perf_counter()
+
+    # On a line of its own, after anything a module printed
+    sys.stdout.write('\n')
+    json.dump({
+        'total_ms': (finished - started) * 1000,
+        'setup_ms': (settings_done - started) * 1000,
+        'modules': profiler.modules,
+        'network': profiler.network,
+    }, sys.stdout)
+
+def profile_startup(targets=DEFAULT_TARGETS, settings_module=None):
+    """
+    Profile a cold start in a new interpreter. targets are modules imported
+    after django.setup(); 'ROOT_URLCONF' stands for the URLconf, loaded with
+    all its views. Returns a dict with total_ms, setup_ms, per-module timings
+    and the network calls made.
+    """
+    from django.conf import settings
+    env = dict(os.environ)
+    env['DJANGO_SETTINGS_MODULE'] = settings_module or env.get('DJANGO_SETTINGS_MODULE', 'images_resizer.settings')
+    code = f"from image_processor.startup import _run_profile; _run_profile({list(targets)!r})"
+    result = subprocess.run(
+        [sys.executable, '-c', code], env=env, capture_output=True, text=True, cwd=str(settings.BASE_DIR)
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'profiling failed')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def group_by_package(modules):
+    """Sum self times per top-level package"""
+    packages = defaultdict(lambda: {'self_ms': 0.0, 'modules': 0})
+    for name, timing in modules.items():
+        package = packages[name.split('.')[0]]
+        package['self_ms'] += timing['self_ms']
+        package['modules'] += 1
+    return dict(packages)
@@ -0,0 +1,238 @@
+"""
+Background storage writes for upload batches.
+
+Every original and processed output of a batch is written to storage, which
+is an HTTP round trip per file on Cloudinary and a disk write locally. A
+StorageWritePipeline hands those writes to a small thread pool so the
+request thread can decode and resize the next image while earlier files are
+still uploading:
+
+    with storage_write_pipeline() as pipeline:
+        write = pipeline.store(upload, ext, digest)
+        pipeline.after([write], callback, on_error)
+        ...  # process the next image
+        pipeline.finish()
+
+Only the storage I/O runs on the threads, each write retried a few times
+with backoff. Blob rows, request rows and the callbacks are handled on the
+calling thread in finish(), the barrier before the response, since database
+connections belong to one thread. While a pipeline is active,
+save_processed_image queues its outputs here instead of uploading them.
+"""
+import contextvars
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+
+from .blobs import blob_path, hash_file, lookup_blob, register_blob, release_blob, retain_blob, upload_blob
+
+logger = logging.getLogger(__name__)
+
+_active_pipeline = contextvars.ContextVar('storage_write_pipeline', default=None)
+
+def active_pipeline():
+    """The pipeline of the current batch, or None when writes are synchronous"""
+    return _active_pipeline.get()
+
+class PendingWrite:
+    """
+    A file queued for storage. `name` is the content-addressed path it will
+    be stored under; finish() replaces it with the path on record.
+    """
+
+    def __init__(self, digest, extension, size):
+        self.digest = digest
+        self.size = size
+        self.name = blob_path(digest, extension)
+        # None when the blob was already stored and only referenced
+        self.future = None
+        # Time the write took on a worker thread
+        self.upload_ms = 0
+        self.error = None
+        self.referenced = False
+
+class StorageWritePipeline:
+    """
+    Uploads files on up to `workers` threads (0 uploads inline) while the
+    caller keeps working. Identical content queued twice in a batch is only
+    uploaded once.
+    """
+
+    def __init__(self, workers=None, retries=None, retry_delay=None):
+        self.workers = max(0, settings.IMAGE_STORAGE_WRITE_WORKERS if workers is None else workers)
+        self.retries = max(0, settings.IMAGE_STORAGE_WRITE_RETRIES if retries is None else retries)
+        self.retry_delay = settings.IMAGE_STORAGE_WRITE_RETRY_DELAY if retry_delay is None else retry_delay
+        self._executor = None
+        self._uploads = {}
+        self._writes = []
+        self._callbacks = []
+
+    def store(self, file, extension, digest=None):
+        """Queue a file object for storage and return its PendingWrite"""
+        digest = digest or hash_file(file)
+        return self._queue(digest, extension, getattr(file, 'size', 0) or 0, lambda: _detached(file))
+
+    def store_bytes(self, data, extension, digest):
+        """Queue encoded bytes for storage and return their PendingWrite"""
+        return self._queue(digest, extension, len(data), lambda: (lambda: ContentFile(data)))
+
+    def _queue(self, digest, extension, size, detach):
+        write = PendingWrite(digest, extension, size)
+        self._writes.append(write)
+        if digest in self._uploads:
+            write.future = self._uploads[digest]
+        elif retain_blob(digest):
+            write.referenced = True
+            write.name = lookup_blob(digest) or write.name
+        else:
+            # The worker reads its own copy, the caller keeps using the file
+            write.future = self._submit(digest, extension, detach())
+            self._uploads[digest] = write.future
+        return write
+
+    def _submit(self, digest, extension, opener):
+        if self.workers == 0:
+            future = Future()
+            try:
+                # Timed by the caller, as for any other inline work
+                name, _ = self._upload(digest, extension, opener)
+                future.set_result((name, 0))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='storage-write')
+        return self._executor.submit(self._upload, digest, extension, opener)
+
+    def _upload(self, digest, extension, opener):
+        """Store one file, retrying with backoff. Returns (stored name, milliseconds)"""
+        started = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            file = opener()
+            try:
+                name = upload_blob(digest, file, extension)
+                return name, (time.perf_counter() - started) * 1000
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Storage write of {digest[:12]} failed, retrying: {e}")
+                time.sleep(self.retry_delay * 2 ** attempt)
+            finally:
+                file.close()
+
+    def after(self, writes, callback, on_error=None, requires=()):
+        """
+        Run callback(writes) in finish() once all of the writes, and the
+        writes it requires, are stored, or on_error(message) if one of them
+        could not be. Only the references of `writes` are dropped on error.
+        """
+        self._callbacks.append((writes, tuple(requires), callback, on_error))
+
+    def finish(self):
+        """
+        Wait for every write, record the stored blobs and run the callbacks
+        in the order they were added. Returns the number of failed callbacks.
+        """
+        try:
+            for write in self._writes:
+                self._wait(write)
+        finally:
+            self._shutdown(cancel=False)
+
+        # From here on every reference belongs to a callback, or is dropped
+        # below when its write failed
+        self._writes = []
+        failures = 0
+        callbacks, self._callbacks = self._callbacks, []
+        for writes, requires, callback, on_error in callbacks:
+            failed = next((write for write in (*writes, *requires) if write.error), None)
+            if failed is None:
+                try:
+                    callback(writes)
+                    continue
+                except Exception as e:
+                    logger.exception("Storage write callback failed")
+                    message = str(e)
+            else:
+                message = f"Could not store the file: {failed.error}"
+                # Keep no references for a result that will not be used
+                for write in writes:
+                    if write.referenced:
+                        release_blob(write.digest)
+                        write.referenced = False
+            failures += 1
+            if on_error is not None:
+                on_error(message)
+        return failures
+
+    def _wait(self, write):
+        if write.future is None:
+            return
+        try:
+            name, write.upload_ms = write.future.result()
+        except Exception as e:
+            logger.error(f"Storage write of {write.digest[:12]} failed: {e}")
+            write.error = str(e) or type(e).__name__
+            return
+        write.name = register_blob(write.digest, name, write.size)
+        write.referenced = True
+
+    def close(self):
+        """
+        Abandon the batch: stop queued uploads, wait for running ones and drop
+        every reference the batch holds. Files uploaded but not yet recorded
+        are registered first so that releasing them removes them from storage.
+        """
+        self._shutdown(cancel=True)
+        writes, self._writes = self._writes, []
+        self._callbacks = []
+        for write in writes:
+            try:
+                if not write.referenced and write.future is not None and not write.future.cancelled():
+                    self._wait(write)
+                if write.referenced:
+                    release_blob(write.digest)
+                    write.referenced = False
+            except Exception:
+                # Do not hide the error the batch is being abandoned for
+                logger.exception(f"Could not release abandoned write of {write.digest[:12]}")
+
+    def _shutdown(self, cancel):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=cancel)
+            self._executor = None
+
+def _detached(file):
+    """
+    Return an opener giving the worker thread its own copy of an uploaded
+    file: the spooled temporary file is reopened by path, anything else is
+    copied to memory.
+    """
+    if hasattr(file, 'temporary_file_path'):
+        path = file.temporary_file_path()
+        return lambda: File(open(path, 'rb'))
+    position = file.tell() if hasattr(file, 'tell') else None
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    data = file.read()
+    if position is not None:
+        file.seek(position)
+    return lambda: ContentFile(data)
+
+@contextmanager
+def storage_write_pipeline(**options):
+    """
+    Make a StorageWritePipeline active for the block. The caller runs
+    finish(); if the block raises, pending uploads are abandoned.
+    """
+    pipeline = StorageWritePipeline(**options)
+    token = _active_pipeline.set(pipeline)
+    try:
+        yield pipeline
+    finally:
+        _active_pipeline.reset(token)
+        pipeline.close()
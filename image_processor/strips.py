@@ -0,0 +1,433 @@
+"""
+Band-by-band decoding of very large TIFF and PNG sources.
+
+Pillow decodes a compressed TIFF or a PNG as one tile, so a 20000x15000 scan
+needs its full decoded size in memory before resizing can start. The readers
+here hand out the image as a sequence of horizontal bands instead. Each band
+is re-wrapped as a small standalone image that Pillow decodes on its own:
+
+    TIFF  the band's strips (or one row of tiles) are copied unchanged into a
+          minimal TIFF with the source's compression tags. Uncompressed
+          strips that are too tall are split by rows.
+    PNG   the IDAT stream is inflated incrementally and the band's filtered
+          scanlines are stored in a minimal PNG, preceded by the previous
+          band's last row so the row filters reconstruct correctly.
+
+Sources that cannot be split this way (planar TIFFs, single-strip
+compressed TIFFs, interlaced or non-8-bit PNGs) get no reader and are
+decoded whole as before. Only sources whose decoded size reaches
+IMAGE_STRIP_THRESHOLD_MB use the band path; bands hold about
+IMAGE_STRIP_BAND_MB of decoded pixels.
+
+Pillow's decompression bomb limit is never changed. For a TIFF or PNG over
+it, open_source_image reads the size from the file header, checks it
+against IMAGE_MAX_SOURCE_PIXELS and opens the file with the format's image
+class directly, keeping it only if it gets a band reader.
+"""
+import io
+import math
+import struct
+import zlib
+from django.conf import settings
+from PIL import Image, PngImagePlugin, TiffImagePlugin
+
+from .admission import bytes_per_pixel
+
+MB = 1024 * 1024
+# A band may exceed the configured size by this factor when the source's
+# strips or tile rows cannot be split any finer
+MAX_BAND_OVERSHOOT = 4
+IDAT_READ_SIZE = 64 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# 8-bit PNG colour types and their bytes per pixel
+PNG_COLOR_TYPES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+PNG_RAW_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_TILE_WIDTH = 322
+TIFF_TILE_LENGTH = 323
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+TIFF_COMPRESSION_NONE = 1
+TIFF_COMPRESSION_OLD_JPEG = 6
+# Tags that describe how strip data is encoded, copied into every band
+TIFF_BAND_TAGS = (
+    258, 259, 262, 266, 277, 284, 317, 320, 322, 323,
+    338, 339, 347, 529, 530, 531, 532,
+)
+TIFF_BYTE, TIFF_SHORT, TIFF_LONG, TIFF_RATIONAL, TIFF_UNDEFINED = 1, 3, 4, 5, 7
+TIFF_PACK_FORMATS = {TIFF_SHORT: 'H', TIFF_LONG: 'L'}
+
+def get_band_bytes():
+    return int(getattr(settings, 'IMAGE_STRIP_BAND_MB', 16)) * MB
+
+def get_strip_threshold():
+    return int(getattr(settings, 'IMAGE_STRIP_THRESHOLD_MB', 256)) * MB
+
+def _as_tuple(value):
+    return value if isinstance(value, tuple) else (value,)
+
+class TiffStripReader:
+    """Bands of a striped or tiled, contiguous TIFF"""
+
+    def __init__(self, img, band_bytes):
+        tags = img.tag_v2
+        self.fp = img.fp
+        self.size = img.size
+        self.mode = img.mode
+        self.prefix = tags.prefix
+        self.endian = '<' if self.prefix == b'II' else '>'
+
+        self.band_tags = {}
+        for tag in TIFF_BAND_TAGS:
+            if tag in tags:
+                typ = tags.tagtype.get(tag)
+                if typ not in (TIFF_BYTE, TIFF_SHORT, TIFF_LONG, TIFF_RATIONAL, TIFF_UNDEFINED):
+                    raise ValueError(f"Unsupported type {typ} for TIFF tag {tag}")
+                self.band_tags[tag] = (typ, tags[tag])
+
+        if tags.get(TIFF_PLANAR_CONFIGURATION, 1) != 1:
+            raise ValueError("Planar TIFFs are decoded whole")
+        compression = tags.get(TIFF_COMPRESSION, TIFF_COMPRESSION_NONE)
+        if compression == TIFF_COMPRESSION_OLD_JPEG:
+            raise ValueError("Old-style JPEG TIFFs are decoded whole")
+
+        width, height = self.size
+        row_bytes = width * bytes_per_pixel(self.mode)
+        max_rows = max(1, band_bytes // row_bytes)
+        if TIFF_TILE_OFFSETS in tags:
+            self.bands = self._tile_bands(tags, max_rows)
+        elif TIFF_STRIP_OFFSETS in tags:
+            self.bands = self._strip_bands(tags, compression, max_rows)
+        else:
+            raise ValueError("TIFF has no strips or tiles")
+        self.band_rows = max(band[1] for band in self.bands)
+        if self.band_rows > max_rows * MAX_BAND_OVERSHOOT:
+            raise ValueError("TIFF strips are too tall to read in bands")
+
+    def _strip_bands(self, tags, compression, max_rows):
+        """(first row, rows, rows per strip, [(offset, byte count)]) for each band"""
+        width, height = self.size
+        offsets = _as_tuple(tags[TIFF_STRIP_OFFSETS])
+        counts = _as_tuple(tags[TIFF_STRIP_BYTE_COUNTS])
+        rows_per_strip = min(tags.get(TIFF_ROWS_PER_STRIP, height), height)
+        if len(offsets) != math.ceil(height / rows_per_strip) or len(counts) != len(offsets):
+            raise ValueError("TIFF strip layout does not match its size")
+
+        if compression == TIFF_COMPRESSION_NONE and rows_per_strip > max_rows:
+            # Raw strips can be cut anywhere on a row boundary
+            bits = sum(_as_tuple(tags.get(TIFF_BITS_PER_SAMPLE, 1)))
+            stride = (width * bits + 7) // 8
+            bands = []
+            for index, offset in enumerate(offsets):
+                first = index * rows_per_strip
+                strip_rows = min(rows_per_strip, height - first)
+                for row in range(0, strip_rows, max_rows):
+                    rows = min(max_rows, strip_rows - row)
+                    bands.append((first + row, rows, rows, [(offset + row * stride, rows * stride)]))
+            return bands
+
+        strips_per_band = max(1, max_rows // rows_per_strip)
+        bands = []
+        for index in range(0, len(offsets), strips_per_band):
+            first = index * rows_per_strip
+            rows = min(strips_per_band * rows_per_strip, height - first)
+            pieces = list(zip(offsets[index:index + strips_per_band], counts[index:index + strips_per_band]))
+            bands.append((first, rows, rows_per_strip, pieces))
+        return bands
+
+    def _tile_bands(self, tags, max_rows):
+        """One band per row of tiles"""
+        width, height = self.size
+        tile_width = tags[TIFF_TILE_WIDTH]
+        tile_length = tags[TIFF_TILE_LENGTH]
+        offsets = _as_tuple(tags[TIFF_TILE_OFFSETS])
+        counts = _as_tuple(tags[TIFF_TILE_BYTE_COUNTS])
+        across = math.ceil(width / tile_width)
+        if len(offsets) != across * math.ceil(height / tile_length) or len(counts) != len(offsets):
+            raise ValueError("TIFF tile layout does not match its size")
+        bands = []
+        for index in range(0, len(offsets), across):
+            first = (index // across) * tile_length
+            pieces = list(zip(offsets[index:index + across], counts[index:index + across]))
+            bands.append((first, min(tile_length, height - first), None, pieces))
+        return bands
+
+    def _pack_values(self, typ, values):
+        if typ in (TIFF_BYTE, TIFF_UNDEFINED):
+            return bytes(values) if isinstance(values, (bytes, bytearray)) else bytes(_as_tuple(values))
+        values = _as_tuple(values)
+        if typ == TIFF_RATIONAL:
+            pairs = [int(part) for value in values for part in (value.numerator, value.denominator)]
+            return struct.pack(f'{self.endian}{len(pairs)}L', *pairs)
+        return struct.pack(f'{self.endian}{len(values)}{TIFF_PACK_FORMATS[typ]}', *values)
+
+    def _band_file(self, rows, rows_per_strip, pieces):
+        """A standalone TIFF holding one band's strip or tile data"""
+        band_file = io.BytesIO()
+        band_file.write(b'\0' * 8)  # header, written once the IFD offset is known
+        offsets, counts = [], []
+        for offset, count in pieces:
+            self.fp.seek(offset)
+            offsets.append(band_file.tell())
+            counts.append(band_file.write(self.fp.read(count)))
+        if band_file.tell() % 2:
+            band_file.write(b'\0')
+
+        tags = dict(self.band_tags)
+        tags[TIFF_IMAGE_WIDTH] = (TIFF_LONG, self.size[0])
+        tags[TIFF_IMAGE_LENGTH] = (TIFF_LONG, rows)
+        if TIFF_TILE_WIDTH in tags:
+            tags[TIFF_TILE_OFFSETS] = (TIFF_LONG, tuple(offsets))
+            tags[TIFF_TILE_BYTE_COUNTS] = (TIFF_LONG, tuple(counts))
+        else:
+            tags[TIFF_ROWS_PER_STRIP] = (TIFF_LONG, rows_per_strip)
+            tags[TIFF_STRIP_OFFSETS] = (TIFF_LONG, tuple(offsets))
+            tags[TIFF_STRIP_BYTE_COUNTS] = (TIFF_LONG, tuple(counts))
+
+        ifd_offset = band_file.tell()
+        aux_offset = ifd_offset + 2 + 12 * len(tags) + 4
+        entries = struct.pack(f'{self.endian}H', len(tags))
+        aux = bytearray()
+        for tag, (typ, values) in sorted(tags.items()):
+            packed = self._pack_values(typ, values)
+            if typ in (TIFF_BYTE, TIFF_UNDEFINED):
+                count = len(packed)
+            else:
+                count = len(_as_tuple(values))
+            if len(packed) <= 4:
+                field = packed.ljust(4, b'\0')
+            else:
+                field = struct.pack(f'{self.endian}L', aux_offset + len(aux))
+                aux += packed + (b'\0' if len(packed) % 2 else b'')
+            entries += struct.pack(f'{self.endian}HHL', tag, typ, count) + field
+        entries += b'\0\0\0\0'
+
+        band_file.write(entries)
+        band_file.write(aux)
+        band_file.seek(0)
+        band_file.write(self.prefix + struct.pack(f'{self.endian}HL', 42, ifd_offset))
+        band_file.seek(0)
+        return band_file
+
+    def iter_bands(self):
+        """Yield (first row, band image) from top to bottom"""
+        for first, rows, rows_per_strip, pieces in self.bands:
+            band = Image.open(self._band_file(rows, rows_per_strip, pieces))
+            band.load()
+            if band.height > rows:
+                band = band.crop((0, 0, band.width, rows))
+            yield first, band
+
+class PngStripReader:
+    """Bands of a non-interlaced 8-bit PNG"""
+
+    def __init__(self, img, band_bytes):
+        self.fp = img.fp
+        self.size = img.size
+        self.mode = img.mode
+        self.fp.seek(0)
+        if self.fp.read(8) != PNG_SIGNATURE:
+            raise ValueError("Not a PNG file")
+        length, chunk_type = struct.unpack('>I4s', self.fp.read(8))
+        if chunk_type != b'IHDR':
+            raise ValueError("PNG does not start with IHDR")
+        (width, height, bit_depth, self.color_type,
+         compression, filter_method, interlace) = struct.unpack('>IIBBBBB', self.fp.read(length))
+        if bit_depth != 8 or self.color_type not in PNG_COLOR_TYPES:
+            raise ValueError("Only 8-bit PNGs are read in bands")
+        if interlace or compression or filter_method:
+            raise ValueError("Interlaced PNGs are decoded whole")
+        self.rawmode = PNG_RAW_MODES[self.color_type]
+        self.stride = width * PNG_COLOR_TYPES[self.color_type]
+        self.band_rows = max(1, band_bytes // (width * bytes_per_pixel(self.mode)))
+
+    def _chunk(self, chunk_type, data):
+        return b''.join(self._chunk_parts(chunk_type, data))
+
+    def _chunk_parts(self, chunk_type, data):
+        crc = zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff
+        return struct.pack('>I', len(data)) + chunk_type, data, struct.pack('>I', crc)
+
+    def _idat_pieces(self, extra_chunks):
+        """Yield the compressed image data, collecting PLTE/tRNS on the way"""
+        self.fp.seek(8)
+        while True:
+            header = self.fp.read(8)
+            if len(header) < 8:
+                return
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'IDAT':
+                remaining = length
+                while remaining:
+                    piece = self.fp.read(min(remaining, IDAT_READ_SIZE))
+                    if not piece:
+                        return
+                    remaining -= len(piece)
+                    yield piece
+                self.fp.seek(4, io.SEEK_CUR)
+                continue
+            if chunk_type == b'IEND':
+                return
+            data = self.fp.read(length)
+            self.fp.seek(4, io.SEEK_CUR)
+            if chunk_type in (b'PLTE', b'tRNS'):
+                extra_chunks.append(self._chunk(chunk_type, data))
+
+    def _band_file(self, rows, context_row, scanlines, extra_chunks):
+        """
+        A standalone PNG of the band's scanlines, stored uncompressed, after
+        an unfiltered context row when one is given
+        """
+        compressor = zlib.compressobj(0)
+        image_data = b''.join((
+            compressor.compress(b'\0' + context_row) if context_row else b'',
+            compressor.compress(scanlines),
+            compressor.flush(),
+        ))
+        header = struct.pack('>IIBBBBB', self.size[0], rows, 8, self.color_type, 0, 0, 0)
+        band_file = io.BytesIO()
+        band_file.write(PNG_SIGNATURE)
+        band_file.write(self._chunk(b'IHDR', header))
+        for chunk in extra_chunks:
+            band_file.write(chunk)
+        for part in self._chunk_parts(b'IDAT', image_data):
+            band_file.write(part)
+        band_file.write(self._chunk(b'IEND', b''))
+        band_file.seek(0)
+        return band_file
+
+    def iter_bands(self):
+        """Yield (first row, band image) from top to bottom"""
+        width, height = self.size
+        line = self.stride + 1
+        extra_chunks = []
+        pieces = self._idat_pieces(extra_chunks)
+        inflater = zlib.decompressobj()
+        buffered = bytearray()
+        pending = b''
+        previous_row = None
+        first = 0
+        while first < height:
+            rows = min(self.band_rows, height - first)
+            needed = rows * line
+            while len(buffered) < needed:
+                if not pending:
+                    pending = next(pieces, b'')
+                    if not pending:
+                        raise OSError("PNG image data is truncated")
+                buffered += inflater.decompress(pending, needed - len(buffered))
+                pending = inflater.unconsumed_tail
+            with memoryview(buffered) as view:
+                # The previous row, unfiltered, lets the first row's filter
+                # refer to the right pixels
+                context_rows = 1 if previous_row else 0
+                band_file = self._band_file(rows + context_rows, previous_row, view[:needed], extra_chunks)
+            del buffered[:needed]
+
+            band = Image.open(band_file)
+            band.load()
+            band_file.close()
+            if context_rows:
+                band = band.crop((0, 1, width, rows + 1))
+            previous_row = band.crop((0, rows - 1, width, rows)).tobytes('raw', self.rawmode)
+            yield first, band
+            first += rows
+
+STRIP_READERS = {
+    'TIFF': TiffStripReader,
+    'PNG': PngStripReader,
+}
+
+def open_strip_reader(img, min_bytes=None, band_bytes=None):
+    """
+    Band reader for an opened, not yet decoded image, or None when it is
+    small enough to decode whole or cannot be read in bands
+    """
+    reader_class = STRIP_READERS.get(img.format)
+    if reader_class is None or not hasattr(img, 'fp') or img.fp is None:
+        return None
+    min_bytes = get_strip_threshold() if min_bytes is None else min_bytes
+    if img.width * img.height * bytes_per_pixel(img.mode) < min_bytes:
+        return None
+    position = img.fp.tell()
+    try:
+        return reader_class(img, band_bytes or get_band_bytes())
+    except (ValueError, KeyError, OSError, struct.error):
+        return None
+    finally:
+        img.fp.seek(position)
+
+# Opened directly rather than through Image.open, which applies Pillow's
+# global pixel limit; open_source_image checks the header size instead
+STRIP_IMAGE_FILES = {
+    'TIFF': TiffImagePlugin.TiffImageFile,
+    'PNG': PngImagePlugin.PngImageFile,
+}
+
+def read_header_size(fp):
+    """
+    (format, width, height) from the header of a TIFF or PNG file, without
+    decoding anything, or None for other files and unreadable headers
+    """
+    fp.seek(0)
+    head = fp.read(24)
+    if head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return 'PNG', width, height
+    if head[:4] not in (b'II*\0', b'MM\0*'):
+        return None
+    endian = '<' if head[:2] == b'II' else '>'
+    try:
+        (ifd_offset,) = struct.unpack(f'{endian}L', head[4:8])
+        fp.seek(ifd_offset)
+        (count,) = struct.unpack(f'{endian}H', fp.read(2))
+        entries = fp.read(12 * count)
+        size = {}
+        for index in range(count):
+            tag, typ, _, value = struct.unpack(f'{endian}HHL4s', entries[12 * index:12 * index + 12])
+            if tag in (TIFF_IMAGE_WIDTH, TIFF_IMAGE_LENGTH) and typ in TIFF_PACK_FORMATS:
+                (size[tag],) = struct.unpack_from(f'{endian}{TIFF_PACK_FORMATS[typ]}', value)
+    except struct.error:
+        return None
+    if len(size) < 2:
+        return None
+    return 'TIFF', size[TIFF_IMAGE_WIDTH], size[TIFF_IMAGE_LENGTH]
+
+def open_source_image(fp):
+    """
+    Image.open() for sources to be processed. TIFF and PNG sources over
+    Pillow's decompression bomb limit are accepted, up to
+    IMAGE_MAX_SOURCE_PIXELS, when open_strip_reader can read them in bands;
+    any other image over the limit raises DecompressionBombError as usual.
+    """
+    try:
+        return Image.open(fp)
+    except Image.DecompressionBombError as e:
+        over_limit = e
+    max_pixels = getattr(settings, 'IMAGE_MAX_SOURCE_PIXELS', 0)
+    if not max_pixels or not hasattr(fp, 'seek'):
+        raise over_limit
+    header = read_header_size(fp)
+    if header is None or header[1] * header[2] > max_pixels:
+        raise over_limit
+    image_format, width, height = header
+    fp.seek(0)
+    try:
+        img = STRIP_IMAGE_FILES[image_format](fp)
+    except Exception:
+        raise over_limit
+    img._exclusive_fp = False
+    if img.size != (width, height) or open_strip_reader(img) is None:
+        img.close()
+        raise over_limit
+    return img
@@ -1,3 +1,1246 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from importlib import import_module
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+import cloudinary
+from django.apps import apps as django_apps
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.core.management import call_command
+from django.db.backends.signals import connection_created
+from django.db.models import Max, Min, Sum
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+from . import db_utils
+from .admission import (
+    MB, AdmissionRejected, HostBudget, ProcessBudget, admit, estimate_decode_cost, fcntl, process_budget
+)
+from .blobs import (
+    blob_path, hash_bytes, lookup_blob, register_blob, release_blob, release_blobs, remove_unreferenced_blobs,
+    store_blob, upload_blob
+)
+from .cleanup import cleanup_expired_sessions
+from .db_utils import acquire_connection, get_connection_stats, release_connection
+from .downloads import RangeNotSatisfiable, parse_range, storage_redirect_url
+from .encoders import get_encoder_profile
+from .jobs import claim_jobs, requeue_stale_jobs
+from .models import ImageProcessingRequest, ImageProcessingSession, StoredBlob
+from .probe import EXIF_ORIENTATION_TAG, MAX_UPLOAD_SIZE, ImageProbe, apply_orientation, probe_files
+from .result_cache import get_result_cache, get_result_cache_stats
+from .storage_writes import StorageWritePipeline, storage_write_pipeline
+from .strips import PngStripReader, TiffStripReader, open_source_image, open_strip_reader, read_header_size
+from .upload_handlers import HEADER_HEAD_BYTES, HEADER_TAIL_BYTES, HeaderUnavailable, ImageHeaderUploadHandler
+from .utils import (
+    encode_jpeg, find_optimal_quality, find_optimal_quality_parallel, get_processed_filename, prepare_image_for_resize,
+    render_image, resize_image, resize_in_strips, run_processing_job, stream_zip, try_aggressive_optimization
+)
+from .views import BUSY_MESSAGE
+
+session_stats_migration = import_module('image_processor.migrations.0012_session_stats')
+STAT_FIELDS = session_stats_migration.STAT_FIELDS
+
+
+class MediaRootMixin:
+    """Keep files written by a test out of the project's media directory"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class BlobRefCountTests(MediaRootMixin, TestCase):
+
+    def store(self, data):
+        return store_blob(ContentFile(data), 'txt', hash_bytes(data))
+
+    def ref_count(self, digest):
+        return StoredBlob.objects.get(sha256=digest).ref_count
+
+    def test_identical_content_is_stored_once(self):
+        digest, path = self.store(b'same bytes')
+        other_digest, other_path = self.store(b'same bytes')
+        self.assertEqual((other_digest, other_path), (digest, path))
+        self.assertEqual(self.ref_count(digest), 2)
+        self.assertEqual(StoredBlob.objects.count(), 1)
+
+    def test_release_keeps_blob_while_referenced(self):
+        digest, path = self.store(b'shared')
+        self.store(b'shared')
+        with self.captureOnCommitCallbacks(execute=True):
+            release_blob(digest)
+        self.assertEqual(self.ref_count(digest), 1)
+        self.assertTrue(default_storage.exists(path))
+
+    def test_last_release_deletes_row_and_file(self):
+        digest, path = self.store(b'only once')
+        with self.captureOnCommitCallbacks(execute=True):
+            release_blob(digest)
+        self.assertIsNone(lookup_blob(digest))
+        self.assertFalse(default_storage.exists(path))
+
+    def test_file_without_row_is_not_trusted(self):
+        digest = hash_bytes(b'current')
+        stale_path = blob_path(digest, 'txt')
+        default_storage.save(stale_path, ContentFile(b'left behind'))
+        _, path = self.store(b'current')
+        self.assertNotEqual(path, stale_path)
+        self.assertEqual(lookup_blob(digest), path)
+        with default_storage.open(path) as file:
+            self.assertEqual(file.read(), b'current')
+        with default_storage.open(stale_path) as file:
+            self.assertEqual(file.read(), b'left behind')
+
+    def test_spare_copy_of_concurrent_upload_is_removed(self):
+        digest, path = self.store(b'raced')
+        # Uploaded by a request that missed the row, then registered
+        spare = upload_blob(digest, ContentFile(b'raced'), 'txt')
+        self.assertNotEqual(spare, path)
+        self.assertEqual(register_blob(digest, spare, 5), path)
+        self.assertFalse(default_storage.exists(spare))
+        self.assertTrue(default_storage.exists(path))
+        self.assertEqual(self.ref_count(digest), 2)
+
+
+class ParseRangeTests(SimpleTestCase):
+
+    def test_no_header(self):
+        self.assertIsNone(parse_range(None, 1000))
+
+    def test_bounded_range(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+
+    def test_end_is_clamped_to_file(self):
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 999))
+
+    def test_open_ended_range(self):
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+
+    def test_suffix_longer_than_file(self):
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 999))
+
+    def test_start_beyond_end_is_not_satisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=1000-', 1000)
+
+    def test_empty_suffix_is_not_satisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=-0', 1000)
+
+    def test_unsupported_ranges_are_ignored(self):
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(parse_range('bytes=9-5', 1000))
+        self.assertIsNone(parse_range('items=0-1', 1000))
+
+
+def upload_form_data(token='', width=120):
+    """POST data of the home form with one small JPEG"""
+    image = io.BytesIO()
+    Image.new('RGB', (width, 80), 'navy').save(image, 'JPEG')
+    return {
+        'num_images': '1',
+        'submission_token': token,
+        'image_0': SimpleUploadedFile('photo.jpg', image.getvalue(), content_type='image/jpeg'),
+        'dimension_unit_0': 'pixels',
+        'output_width_0': '60',
+        'output_height_0': '40',
+        'dpi_0': '72',
+    }
+
+
+@override_settings(IMAGE_PROCESSING_MODE='sync', IMAGE_POOL_WORKERS=0, IMAGE_STORAGE_WRITE_WORKERS=0)
+class SubmissionTokenTests(MediaRootMixin, TestCase):
+
+    def test_resubmission_shows_first_results(self):
+        first = self.client.post('/', upload_form_data('token-1'))
+        self.assertEqual(first.status_code, 302)
+
+        second = self.client.post('/', upload_form_data('token-1'), follow=True)
+        self.assertRedirects(second, first['Location'])
+        self.assertIn(
+            "These images were already submitted; showing the results of that submission.",
+            [message.message for message in second.context['messages']]
+        )
+        self.assertEqual(ImageProcessingSession.objects.count(), 1)
+        self.assertEqual(ImageProcessingRequest.objects.count(), 1)
+
+    def test_same_token_with_other_files_is_a_new_submission(self):
+        self.client.post('/', upload_form_data('token-2'))
+        self.client.post('/', upload_form_data('token-2', width=140))
+        self.assertEqual(ImageProcessingSession.objects.count(), 2)
+
+    def test_without_token_every_post_is_processed(self):
+        self.client.post('/', upload_form_data(''))
+        self.client.post('/', upload_form_data(''))
+        self.assertEqual(ImageProcessingSession.objects.count(), 2)
+
+
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        self.session = ImageProcessingSession.objects.create()
+
+    def add_job(self, **fields):
+        return ImageProcessingRequest.objects.create(
+            session=self.session,
+            original_filename='photo.jpg',
+            output_width=60,
+            output_height=40,
+            **fields
+        )
+
+    def test_claims_oldest_queued_jobs(self):
+        jobs = [self.add_job() for _ in range(3)]
+        self.add_job(status=ImageProcessingRequest.STATUS_DONE)
+
+        claimed = claim_jobs('worker-1', batch_size=2)
+        self.assertEqual([job.id for job in claimed], [jobs[0].id, jobs[1].id])
+        for job in claimed:
+            self.assertEqual(job.status, ImageProcessingRequest.STATUS_PROCESSING)
+            self.assertEqual(job.claimed_by, 'worker-1')
+            self.assertEqual(job.attempts, 1)
+            self.assertIsNotNone(job.claimed_at)
+
+    def test_claimed_jobs_are_not_claimed_again(self):
+        job = self.add_job()
+        self.assertEqual(claim_jobs('worker-1'), [job])
+        self.assertEqual(claim_jobs('worker-2'), [])
+
+    def test_stale_jobs_are_requeued(self):
+        job = self.add_job()
+        claim_jobs('worker-1')
+        ImageProcessingRequest.objects.filter(id=job.id).update(claimed_at=timezone.now() - timedelta(minutes=10))
+
+        self.assertEqual(requeue_stale_jobs(lease_seconds=60, max_attempts=3), (1, 0))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImageProcessingRequest.STATUS_QUEUED)
+        self.assertEqual(job.claimed_by, '')
+        self.assertIsNone(job.claimed_at)
+        self.assertEqual(claim_jobs('worker-2'), [job])
+
+    def test_recent_claims_are_left_alone(self):
+        self.add_job()
+        claim_jobs('worker-1')
+        self.assertEqual(requeue_stale_jobs(lease_seconds=60, max_attempts=3), (0, 0))
+
+    def test_stale_jobs_out_of_attempts_fail(self):
+        job = self.add_job(attempts=2)
+        claim_jobs('worker-1')
+        ImageProcessingRequest.objects.filter(id=job.id).update(claimed_at=timezone.now() - timedelta(minutes=10))
+
+        self.assertEqual(requeue_stale_jobs(lease_seconds=60, max_attempts=3), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImageProcessingRequest.STATUS_FAILED)
+
+
+def gradient_image(mode, size=(257, 193)):
+    """A smooth test picture with detail in every row, so a misplaced row shows"""
+    noise = Image.effect_noise(size, 64).filter(ImageFilter.GaussianBlur(2)).convert('L')
+    rgb = Image.merge('RGB', (noise, noise.transpose(Image.Transpose.FLIP_TOP_BOTTOM), Image.linear_gradient('L').resize(size)))
+    if mode == 'RGBA':
+        return Image.merge('RGBA', (*rgb.split(), noise))
+    return rgb.convert(mode)
+
+def encoded(img, image_format, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, image_format, **options)
+    buffer.seek(0)
+    return buffer
+
+def max_difference(first, second):
+    extrema = ImageChops.difference(first.convert('RGBA'), second.convert('RGBA')).getextrema()
+    return max(high for _, high in extrema)
+
+
+class StripReaderTests(SimpleTestCase):
+    # About 20 rows of the 257 pixel wide test image per band
+    band_bytes = 257 * 4 * 20
+
+    def assertBandsRebuild(self, source, expected_reader):
+        img = Image.open(source)
+        reader = open_strip_reader(img, min_bytes=0, band_bytes=self.band_bytes)
+        self.assertIsInstance(reader, expected_reader)
+        # Pasted as RGBA so that palettes are compared too
+        rebuilt = Image.new('RGBA', img.size)
+        next_row, band_count = 0, 0
+        for first, band in reader.iter_bands():
+            self.assertEqual(first, next_row)
+            rebuilt.paste(band.convert('RGBA'), (0, first))
+            next_row += band.height
+            band_count += 1
+        self.assertEqual(next_row, img.height)
+        self.assertGreater(band_count, 2)
+        source.seek(0)
+        self.assertEqual(max_difference(rebuilt, Image.open(source)), 0)
+
+    def test_tiff_bands_rebuild_the_image(self):
+        for compression in ('raw', 'tiff_lzw', 'tiff_adobe_deflate', 'packbits'):
+            for mode in ('RGB', 'L', 'RGBA'):
+                with self.subTest(compression=compression, mode=mode):
+                    # Small strips so several make up a band
+                    source = encoded(gradient_image(mode), 'TIFF', compression=compression, strip_size=4096)
+                    self.assertBandsRebuild(source, TiffStripReader)
+
+    def test_tall_raw_tiff_strip_is_split_by_rows(self):
+        source = encoded(gradient_image('RGB'), 'TIFF', compression='raw', strip_size=10 ** 9)
+        self.assertBandsRebuild(source, TiffStripReader)
+
+    def test_single_compressed_tiff_strip_has_no_reader(self):
+        source = encoded(gradient_image('RGB'), 'TIFF', compression='tiff_lzw', strip_size=10 ** 9)
+        self.assertIsNone(open_strip_reader(Image.open(source), min_bytes=0, band_bytes=self.band_bytes))
+
+    def test_png_bands_rebuild_the_image(self):
+        for mode in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+            with self.subTest(mode=mode):
+                img = gradient_image('RGB').quantize(64) if mode == 'P' else gradient_image('RGBA').convert(mode)
+                self.assertBandsRebuild(encoded(img, 'PNG'), PngStripReader)
+
+    def test_small_images_are_decoded_whole(self):
+        self.assertIsNone(open_strip_reader(Image.open(encoded(gradient_image('RGB'), 'PNG'))))
+
+    def test_banded_resize_matches_full_resize(self):
+        sources = {
+            'tiff': encoded(gradient_image('RGB'), 'TIFF', compression='tiff_lzw', strip_size=4096),
+            'png': encoded(gradient_image('RGB'), 'PNG'),
+            'png rgba': encoded(gradient_image('RGBA'), 'PNG'),
+        }
+        for name, source in sources.items():
+            for size, tier in (((60, 45), 'best'), ((120, 150), 'balanced'), ((250, 190), 'fast'), ((400, 300), 'best')):
+                with self.subTest(source=name, size=size, tier=tier):
+                    source.seek(0)
+                    img = Image.open(source)
+                    mode = 'RGBA' if img.mode == 'RGBA' else 'RGB'
+                    reader = open_strip_reader(img, min_bytes=0, band_bytes=self.band_bytes)
+                    banded = resize_in_strips(reader, size, mode, tier)
+                    source.seek(0)
+                    full = resize_image(prepare_image_for_resize(Image.open(source), *size, mode=mode), size, tier)
+                    self.assertEqual(banded.size, size)
+                    # Rounding differs slightly between the two; a wrong
+                    # seam or context row is far off
+                    self.assertLessEqual(max_difference(banded, full), 3)
+
+
+class OpenSourceImageTests(SimpleTestCase):
+
+    def setUp(self):
+        self.default_limit = Image.MAX_IMAGE_PIXELS
+        self.addCleanup(setattr, Image, 'MAX_IMAGE_PIXELS', self.default_limit)
+        # The test images count as decompression bombs
+        Image.MAX_IMAGE_PIXELS = 257 * 193 // 4
+
+    def test_reads_size_from_headers(self):
+        img = gradient_image('RGB')
+        self.assertEqual(read_header_size(encoded(img, 'PNG')), ('PNG', 257, 193))
+        self.assertEqual(read_header_size(encoded(img, 'TIFF', compression='raw')), ('TIFF', 257, 193))
+        self.assertIsNone(read_header_size(encoded(img, 'BMP')))
+
+    @override_settings(IMAGE_MAX_SOURCE_PIXELS=10 ** 6, IMAGE_STRIP_THRESHOLD_MB=0)
+    def test_large_strip_sources_open_without_raising_the_limit(self):
+        for image_format in ('PNG', 'TIFF'):
+            with self.subTest(image_format=image_format):
+                img = open_source_image(encoded(gradient_image('RGB'), image_format, compression='tiff_lzw', strip_size=4096))
+                self.assertEqual(img.size, (257, 193))
+                self.assertEqual(Image.MAX_IMAGE_PIXELS, 257 * 193 // 4)
+
+    @override_settings(IMAGE_MAX_SOURCE_PIXELS=10 ** 6, IMAGE_STRIP_THRESHOLD_MB=0)
+    def test_other_formats_stay_limited(self):
+        with self.assertRaises(Image.DecompressionBombError):
+            open_source_image(encoded(gradient_image('RGB'), 'BMP'))
+
+    @override_settings(IMAGE_MAX_SOURCE_PIXELS=10000, IMAGE_STRIP_THRESHOLD_MB=0)
+    def test_sources_over_the_maximum_are_refused(self):
+        with self.assertRaises(Image.DecompressionBombError):
+            open_source_image(encoded(gradient_image('RGB'), 'PNG'))
+
+
+class CleanupTests(MediaRootMixin, TestCase):
+
+    def add_session(self, hours_old, *contents):
+        session = ImageProcessingSession.objects.create()
+        ImageProcessingSession.objects.filter(id=session.id).update(created_at=timezone.now() - timedelta(hours=hours_old))
+        for data in contents:
+            digest, path = store_blob(ContentFile(data), 'jpg', hash_bytes(data))
+            ImageProcessingRequest.objects.create(
+                session=session, original_filename='photo.jpg', output_width=60, output_height=40,
+                original_image=path, original_hash=digest, original_file_size=len(data)
+            )
+        return session
+
+    def cutoff(self):
+        return timezone.now() - timedelta(hours=24)
+
+    def test_deletes_expired_sessions_in_batches(self):
+        for index in range(5):
+            self.add_session(48, b'old %d' % index, b'shared')
+        live = self.add_session(1, b'shared')
+        progress = []
+
+        totals = cleanup_expired_sessions(self.cutoff(), batch_size=2, progress=lambda totals: progress.append(totals['batches']))
+
+        self.assertEqual((totals['sessions'], totals['requests'], totals['batches']), (5, 10, 3))
+        self.assertTrue(totals['complete'])
+        self.assertEqual(progress, [1, 2, 3])
+        self.assertEqual(totals['files'], 5)
+        self.assertEqual(totals['bytes'], 5 * len(b'old 0'))
+        self.assertEqual(list(ImageProcessingSession.objects.all()), [live])
+        # Only the blob the live session still uses is left
+        shared = StoredBlob.objects.get()
+        self.assertEqual((shared.sha256, shared.ref_count), (hash_bytes(b'shared'), 1))
+        self.assertEqual(sorted(default_storage.listdir(os.path.dirname(shared.path))[1]), [os.path.basename(shared.path)])
+        for index in range(5):
+            self.assertFalse(default_storage.exists(blob_path(hash_bytes(b'old %d' % index), 'jpg')))
+
+    def test_files_stored_before_content_addressing_are_deleted(self):
+        session = self.add_session(48)
+        legacy = default_storage.save('uploads/legacy.jpg', ContentFile(b'legacy'))
+        ImageProcessingRequest.objects.create(
+            session=session, original_filename='legacy.jpg', output_width=60, output_height=40,
+            original_image=legacy, original_file_size=6
+        )
+        totals = cleanup_expired_sessions(self.cutoff())
+        self.assertEqual((totals['requests'], totals['files'], totals['bytes']), (1, 1, 6))
+        self.assertFalse(default_storage.exists(legacy))
+
+    def test_blob_stored_again_after_release_is_kept(self):
+        digest, path = store_blob(ContentFile(b'again'), 'jpg', hash_bytes(b'again'))
+        self.assertEqual(release_blobs([digest]), [digest])
+        store_blob(ContentFile(b'again'), 'jpg', digest)
+        self.assertEqual(remove_unreferenced_blobs([digest]), [])
+        self.assertEqual(lookup_blob(digest), path)
+        self.assertTrue(default_storage.exists(path))
+
+    def test_blobs_left_unreferenced_are_removed(self):
+        digest, path = store_blob(ContentFile(b'left over'), 'jpg', hash_bytes(b'left over'))
+        release_blobs([digest])
+        totals = cleanup_expired_sessions(self.cutoff())
+        self.assertEqual((totals['sessions'], totals['files']), (0, 1))
+        self.assertIsNone(lookup_blob(digest))
+        self.assertFalse(default_storage.exists(path))
+
+    def test_command(self):
+        self.add_session(48, b'expired')
+        self.add_session(1, b'recent')
+        out = io.StringIO()
+        call_command('cleanup_sessions', '--dry-run', stdout=out)
+        self.assertIn('Would delete 1 sessions with 1 images older than 24 hours', out.getvalue())
+        self.assertEqual(ImageProcessingSession.objects.count(), 2)
+
+        out = io.StringIO()
+        call_command('cleanup_sessions', '--batch-size', '1', stdout=out)
+        self.assertIn('Deleted 1 old sessions and 1 images', out.getvalue())
+        self.assertIn('removed 1 files', out.getvalue())
+        self.assertEqual(ImageProcessingSession.objects.count(), 1)
+
+
+def synthetic_images():
+    """A few pictures whose JPEG size curves differ: noise, smooth, flat with edges"""
+    gradient = Image.linear_gradient('L').resize((256, 256))
+    lines = Image.new('RGB', (280, 210), 'white')
+    draw = ImageDraw.Draw(lines)
+    for x in range(0, 280, 14):
+        draw.line((x, 0, 280 - x, 210), fill=(x % 255, 80, 200 - x % 200), width=2)
+    return {
+        'noise': Image.effect_noise((320, 240), 40).convert('RGB'),
+        'blurred noise': Image.effect_noise((300, 200), 60).filter(ImageFilter.GaussianBlur(3)).convert('RGB'),
+        'gradient': Image.merge('RGB', (gradient, gradient.rotate(90), gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))),
+        'lines': lines,
+    }
+
+
+class QualitySearchTests(SimpleTestCase):
+
+    def assertMatchesScan(self, search, profile=None, tolerance=0):
+        for name, img in synthetic_images().items():
+            sizes = {quality: len(encode_jpeg(img, quality, 72, profile=profile).getvalue()) for quality in range(1, 101)}
+            targets = [sizes[1] * 9 // 10] + [sizes[1] + (sizes[100] - sizes[1]) * share // 10 for share in (1, 3, 5, 8)]
+            for target in targets:
+                with self.subTest(image=name, target=target):
+                    expected = max((quality for quality, size in sizes.items() if size <= target), default=-1)
+                    buffer, quality = search(img, target)
+                    if tolerance and expected != -1:
+                        self.assertIn(quality, range(expected - tolerance, expected + 1))
+                    else:
+                        self.assertEqual(quality, expected)
+                    if expected == -1:
+                        self.assertIsNone(buffer)
+                    else:
+                        self.assertLessEqual(len(buffer.getvalue()), target)
+                        self.assertEqual(Image.open(buffer).size, img.size)
+
+    def test_finds_highest_quality_that_fits(self):
+        self.assertMatchesScan(lambda img, target: find_optimal_quality(img, target, 72, threads=1))
+
+    def test_parallel_search_matches_serial_search(self):
+        for threads in (2, 4):
+            with self.subTest(threads=threads):
+                self.assertMatchesScan(lambda img, target: find_optimal_quality(img, target, 72, threads=threads))
+
+    def test_search_encodes_with_the_profile(self):
+        # Progressive scans make the size curve slightly uneven, so the
+        # predicted stop may settle one quality short of the scan
+        for threads in (1, 3):
+            with self.subTest(threads=threads):
+                self.assertMatchesScan(
+                    lambda img, target: find_optimal_quality(img, target, 72, threads=threads, profile='small'),
+                    'small', tolerance=1
+                )
+        img = synthetic_images()['gradient']
+        buffer, _ = find_optimal_quality(img, len(encode_jpeg(img, 70, 72).getvalue()), 72, threads=1, profile='small')
+        self.assertTrue(Image.open(buffer).info.get('progressive'))
+
+    @override_settings(IMAGE_ENCODER_PROFILE='small')
+    def test_size_targeted_output_uses_the_deployment_profile(self):
+        img = synthetic_images()['noise']
+        spec = {'width': 160, 'height': 120, 'dpi': 72, 'resample_tier': None, 'output_type': 'jpg', 'target_size_bytes': 20000}
+        for data in (
+            render_image(encoded(img, 'PNG').getvalue(), {**spec, 'encoder_profile': get_encoder_profile()}),
+            try_aggressive_optimization(img, 320, 240, 2000, 72, 4 / 3)[0],
+        ):
+            output = Image.open(io.BytesIO(data))
+            self.assertEqual(output.format, 'JPEG')
+            self.assertTrue(output.info.get('progressive'))
+
+    def test_parallel_search_counts_its_encodes(self):
+        img = synthetic_images()['lines']
+        stats = {}
+        find_optimal_quality_parallel(img, len(encode_jpeg(img, 50, 72).getvalue()), 72, stats=stats, threads=3)
+        # log4(100) rounds of three
+        self.assertLessEqual(stats['encodes'], 4 * 3)
+
+    def test_uses_few_encodes(self):
+        img = synthetic_images()['blurred noise']
+        target = len(encode_jpeg(img, 60, 72).getvalue())
+        stats = {}
+        find_optimal_quality(img, target, 72, stats=stats, threads=1)
+        # A bisection over 1-100 needs 7
+        self.assertLessEqual(stats['encodes'], 6)
+
+
+@override_settings(IMAGE_PROCESS_DECODE_BUDGET_MB=10, IMAGE_HOST_DECODE_BUDGET_MB=0)
+class ProcessBudgetTests(SimpleTestCase):
+
+    def setUp(self):
+        self.budget = ProcessBudget()
+
+    def test_jobs_share_the_budget(self):
+        self.assertTrue(self.budget.acquire(6 * MB, timeout=0))
+        self.assertTrue(self.budget.acquire(4 * MB, timeout=0))
+        self.assertFalse(self.budget.acquire(1, timeout=0))
+        self.budget.release(4 * MB)
+        self.assertTrue(self.budget.acquire(1, timeout=0))
+        stats = self.budget.stats()
+        self.assertEqual((stats['active_bytes'], stats['active_jobs']), (6 * MB + 1, 2))
+        self.assertEqual((stats['admitted'], stats['rejected']), (3, 1))
+
+    def test_job_larger_than_the_budget_runs_alone(self):
+        self.assertTrue(self.budget.acquire(1, timeout=0))
+        self.assertFalse(self.budget.acquire(50 * MB, timeout=0))
+        self.budget.release(1)
+        self.assertTrue(self.budget.acquire(50 * MB, timeout=0))
+
+    def test_waiting_job_is_admitted_when_budget_frees_up(self):
+        self.budget.acquire(10 * MB)
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(self.budget.acquire(5 * MB, timeout=5)))
+        waiter.start()
+        while self.budget.stats()['queued_jobs'] == 0:
+            time.sleep(0.01)
+        self.budget.release(10 * MB)
+        waiter.join()
+        self.assertEqual(admitted, [True])
+        self.assertEqual(self.budget.stats()['queued_bytes'], 0)
+
+
+@skipIf(fcntl is None, "The host budget needs fcntl")
+class HostBudgetTests(SimpleTestCase):
+
+    def setUp(self):
+        ledger_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ledger_dir, ignore_errors=True)
+        self.ledger = os.path.join(ledger_dir, 'budget.json')
+        settings_override = override_settings(IMAGE_HOST_DECODE_BUDGET_MB=10, IMAGE_HOST_BUDGET_FILE=self.ledger)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.budget = HostBudget()
+
+    def write_ledger(self, ledger):
+        with open(self.ledger, 'w') as f:
+            json.dump(ledger, f)
+
+    def test_other_processes_count_against_the_budget(self):
+        self.write_ledger({str(os.getppid()): [8 * MB, 0]})
+        self.assertFalse(self.budget.acquire(4 * MB, timeout=0))
+        self.assertTrue(self.budget.acquire(2 * MB, timeout=0))
+        self.assertEqual(self.budget.stats()['active_bytes'], 10 * MB)
+        self.budget.release(2 * MB)
+        self.assertEqual(self.budget.stats()['active_bytes'], 8 * MB)
+        self.assertEqual(self.budget.stats()['queued_bytes'], 0)
+
+    def test_entries_of_dead_processes_are_dropped(self):
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        self.write_ledger({str(dead.pid): [10 * MB, 0]})
+        self.assertTrue(self.budget.acquire(4 * MB, timeout=0))
+        self.assertEqual(self.budget.stats()['processes'], 1)
+        self.budget.release(4 * MB)
+
+
+@override_settings(IMAGE_PROCESS_DECODE_BUDGET_MB=1, IMAGE_HOST_DECODE_BUDGET_MB=0)
+class AdmitTests(SimpleTestCase):
+
+    def test_budget_is_released_after_the_block(self):
+        with admit(MB):
+            self.assertEqual(process_budget.stats()['active_bytes'], MB)
+        self.assertEqual(process_budget.stats()['active_bytes'], 0)
+
+    def test_budget_is_released_when_the_block_raises(self):
+        with self.assertRaises(ValueError):
+            with admit(MB):
+                raise ValueError
+        self.assertEqual(process_budget.stats()['active_bytes'], 0)
+
+    @override_settings(IMAGE_ADMISSION_RETRY_AFTER=7)
+    def test_rejection_carries_retry_after(self):
+        with admit(MB):
+            with self.assertRaises(AdmissionRejected) as rejected:
+                with admit(MB, timeout=0):
+                    pass
+        self.assertEqual((rejected.exception.cost, rejected.exception.retry_after), (MB, 7))
+        self.assertEqual(process_budget.stats()['active_bytes'], 0)
+
+    def test_decode_cost_of_strip_sources_counts_one_band(self):
+        whole = estimate_decode_cost(1000, 1000, 'RGB', 100, 100)
+        banded = estimate_decode_cost(1000, 1000, 'RGB', 100, 100, band_rows=10)
+        self.assertEqual(whole, 1000 * 1000 * (3 + 4) + 100 * 100 * 4)
+        self.assertEqual(banded, 1000 * 10 * (3 + 4) + 100 * 100 * 4)
+
+
+@override_settings(
+    IMAGE_PROCESSING_MODE='sync', IMAGE_POOL_WORKERS=0, IMAGE_STORAGE_WRITE_WORKERS=0,
+    IMAGE_PROCESS_DECODE_BUDGET_MB=1, IMAGE_HOST_DECODE_BUDGET_MB=0,
+    IMAGE_ADMISSION_WAIT=0, IMAGE_ADMISSION_RETRY_AFTER=3,
+)
+class AdmissionViewTests(MediaRootMixin, TestCase):
+
+    def test_busy_server_answers_429(self):
+        with admit(MB):
+            response = self.client.post('/', upload_form_data())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertIn(BUSY_MESSAGE, [message.message for message in response.context['messages']])
+        self.assertEqual(ImageProcessingSession.objects.count(), 0)
+
+    def test_budget_is_only_held_while_rendering(self):
+        response = self.client.post('/', upload_form_data())
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(process_budget.stats()['active_bytes'], 0)
+
+
+class ZipStreamTests(SimpleTestCase):
+
+    def test_streamed_archive_opens(self):
+        contents = {'a.jpg': os.urandom(5000), 'b.png': b'png ' * 3000, 'unknown.bin': b'no size given'}
+        entries = [
+            (zipfile.ZipInfo(name), io.BytesIO(data), None if name == 'unknown.bin' else len(data))
+            for name, data in contents.items()
+        ]
+        entries[1][0].compress_type = zipfile.ZIP_DEFLATED
+        chunks = list(stream_zip(entries, chunk_size=1024))
+        self.assertGreater(len(chunks), 3)
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({name: archive.read(name) for name in archive.namelist()}, contents)
+
+
+@override_settings(IMAGE_PROCESSING_MODE='sync', IMAGE_POOL_WORKERS=0, IMAGE_STORAGE_WRITE_WORKERS=0)
+class SessionZipTests(MediaRootMixin, TestCase):
+
+    def test_archive_contains_every_processed_image(self):
+        data = upload_form_data()
+        data.update({
+            'num_images': '2',
+            'image_1': upload_form_data(width=150)['image_0'],
+            'dimension_unit_1': 'pixels', 'output_width_1': '30', 'output_height_1': '20', 'dpi_1': '72',
+            'output_file_type_1': 'png',
+        })
+        self.client.post('/', data)
+        session = ImageProcessingSession.objects.get()
+        images = list(session.images.order_by('created_at'))
+        self.assertTrue(all(image.is_processed for image in images))
+
+        response = self.client.get(f'/download/session/{session.session_id}/')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(sorted(archive.namelist()), sorted(get_processed_filename(image) for image in images))
+            for image in images:
+                with image.processed_image.open('rb') as processed:
+                    self.assertEqual(archive.read(get_processed_filename(image)), processed.read())
+
+
+def uploaded_image(img, image_format, name='upload', **options):
+    buffer = encoded(img, image_format, **options)
+    return SimpleUploadedFile(f'{name}.{image_format.lower()}', buffer.getvalue(), content_type=f'image/{image_format.lower()}')
+
+
+class ImageProbeTests(SimpleTestCase):
+
+    def test_reads_header_information(self):
+        probe = ImageProbe(uploaded_image(Image.new('RGB', (120, 80)), 'PNG'))
+        self.assertTrue(probe.is_valid)
+        self.assertEqual(probe.info, {
+            'width': 120, 'height': 80, 'format': 'PNG', 'mode': 'RGB', 'size': probe.file.size, 'orientation': 1,
+        })
+        self.assertIsNone(probe.band_rows)
+
+    def test_exif_orientation_swaps_displayed_size(self):
+        for orientation, size in ((1, (120, 80)), (3, (120, 80)), (6, (80, 120)), (8, (80, 120))):
+            with self.subTest(orientation=orientation):
+                exif = Image.Exif()
+                exif[EXIF_ORIENTATION_TAG] = orientation
+                probe = ImageProbe(uploaded_image(Image.new('RGB', (120, 80)), 'JPEG', exif=exif.tobytes()))
+                self.assertEqual((probe.orientation, (probe.width, probe.height)), (orientation, size))
+
+    def test_png_exif_orientation(self):
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION_TAG] = 6
+        probe = ImageProbe(uploaded_image(Image.new('RGB', (120, 80)), 'PNG', exif=exif.tobytes()))
+        self.assertEqual((probe.orientation, probe.width, probe.height), (6, 80, 120))
+
+    def test_apply_orientation_turns_pixels_upright(self):
+        img = Image.new('RGB', (2, 1))
+        img.putpixel((0, 0), (255, 0, 0))
+        upright = apply_orientation(img, 6)
+        self.assertEqual(upright.size, (1, 2))
+        self.assertEqual(upright.getpixel((0, 0)), (255, 0, 0))
+        self.assertIs(apply_orientation(img, 1), img)
+
+    def test_rejects_files_that_are_too_large(self):
+        upload = uploaded_image(Image.new('RGB', (10, 10)), 'PNG')
+        upload.size = MAX_UPLOAD_SIZE + 1
+        probe = ImageProbe(upload)
+        self.assertEqual(probe.error, "File size must be less than 10MB")
+        self.assertIsNone(probe.info)
+
+    def test_rejects_unsupported_formats(self):
+        probe = ImageProbe(uploaded_image(Image.new('RGB', (10, 10)), 'WEBP'))
+        self.assertEqual(probe.error, "Unsupported image format")
+        self.assertIsNone(probe.take_image())
+
+    def test_rejects_files_that_are_not_images(self):
+        probe = ImageProbe(SimpleUploadedFile('notes.jpg', b'not an image', content_type='image/jpeg'))
+        self.assertFalse(probe.is_valid)
+        self.assertTrue(probe.error.startswith("Invalid image file"))
+
+    def test_opened_image_is_handed_over_once(self):
+        probe = ImageProbe(uploaded_image(Image.new('RGB', (10, 10)), 'JPEG'))
+        img = probe.take_image()
+        self.assertEqual(img.size, (10, 10))
+        self.assertIsNone(probe.take_image())
+
+    def test_probe_files_keeps_order(self):
+        files = [
+            uploaded_image(Image.new('RGB', (10 + index, 10)), 'PNG') if index != 2
+            else SimpleUploadedFile('bad.png', b'nope', content_type='image/png')
+            for index in range(6)
+        ]
+        probes = probe_files(files)
+        self.assertEqual([probe.file for probe in probes], files)
+        self.assertEqual([probe.width for probe in probes], [10, 11, None, 13, 14, 15])
+        self.assertEqual([probe.is_valid for probe in probes], [True, True, False, True, True, True])
+
+
+def receive_upload(handler, data, chunk_size=1000):
+    """Feed `data` through an upload handler the way the multipart parser does"""
+    try:
+        handler.new_file('image', 'upload.jpg', 'image/jpeg', len(data))
+    except StopFutureHandlers:
+        pass
+    for start in range(0, len(data), chunk_size):
+        handler.receive_data_chunk(data[start:start + chunk_size], start)
+    return handler.file_complete(len(data))
+
+
+class SparseFileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.data = bytes(range(256)) * 40
+        self.handler = ImageHeaderUploadHandler(head_bytes=1500, tail_bytes=700)
+
+    def test_keeps_head_and_tail(self):
+        upload = receive_upload(self.handler, self.data)
+        self.assertEqual(bytes(self.handler.head), self.data[:1500])
+        self.assertEqual(bytes(self.handler.tail), self.data[-700:])
+        self.assertEqual(upload.size, len(self.data))
+        self.assertTrue(upload.is_partial)
+
+    def test_reads_from_both_ends(self):
+        upload = receive_upload(self.handler, self.data)
+        self.assertEqual(upload.read(1500), self.data[:1500])
+        upload.seek(-700, io.SEEK_END)
+        self.assertEqual(upload.read(), self.data[-700:])
+        upload.seek(100)
+        self.assertEqual(upload.read(50), self.data[100:150])
+
+    def test_reading_the_gap_fails(self):
+        upload = receive_upload(self.handler, self.data)
+        upload.seek(2000)
+        with self.assertRaises(HeaderUnavailable):
+            upload.read(10)
+        with self.assertRaises(HeaderUnavailable):
+            list(upload.chunks())
+
+    def test_small_upload_is_kept_whole(self):
+        upload = receive_upload(self.handler, self.data[:2000])
+        self.assertFalse(upload.is_partial)
+        self.assertEqual(upload.size, 2000)
+        self.assertEqual(upload.read(), self.data[:2000])
+
+    def test_probe_reads_truncated_upload(self):
+        data = encoded(Image.effect_noise((600, 400), 100).convert('RGB'), 'JPEG', quality=95).getvalue()
+        handler = ImageHeaderUploadHandler(head_bytes=4096, tail_bytes=1024)
+        upload = receive_upload(handler, data)
+        self.assertTrue(upload.is_partial)
+        probe = ImageProbe(upload)
+        self.assertTrue(probe.is_valid)
+        self.assertFalse(probe.header_incomplete)
+        self.assertEqual(probe.info['width'], 600)
+        self.assertEqual(probe.info['height'], 400)
+        self.assertEqual(probe.info['size'], len(data))
+
+    def test_probe_reports_header_beyond_kept_bytes(self):
+        # A large ICC profile pushes the frame header past the kept head
+        data = encoded(Image.new('RGB', (60, 40)), 'JPEG', icc_profile=b'\0' * 20000).getvalue()
+        handler = ImageHeaderUploadHandler(head_bytes=4096, tail_bytes=1024)
+        probe = ImageProbe(receive_upload(handler, data))
+        self.assertTrue(probe.header_incomplete)
+        self.assertIsNone(probe.info)
+
+
+class HeaderOnlyViewTests(SimpleTestCase):
+
+    def test_image_info_reports_full_size(self):
+        data = encoded(Image.effect_noise((800, 600), 100).convert('RGB'), 'JPEG', quality=95).getvalue()
+        self.assertGreater(len(data), HEADER_HEAD_BYTES + HEADER_TAIL_BYTES)
+        response = self.client.post(
+            reverse('ajax_image_info'), {'image': SimpleUploadedFile('big.jpg', data, content_type='image/jpeg')}
+        )
+        payload = response.json()
+        self.assertTrue(payload['success'])
+        self.assertEqual((payload['width'], payload['height'], payload['size']), (800, 600, len(data)))
+
+    def test_validate_image(self):
+        good = SimpleUploadedFile('good.png', encoded(Image.new('RGB', (30, 20)), 'PNG').getvalue(), content_type='image/png')
+        bad = SimpleUploadedFile('bad.png', b'not an image', content_type='image/png')
+        payload = self.client.post(reverse('ajax_validate_image'), {'image_0': good, 'image_1': bad}).json()
+        self.assertTrue(payload['0']['valid'])
+        self.assertEqual((payload['0']['width'], payload['0']['height']), (30, 20))
+        self.assertFalse(payload['1']['valid'])
+
+
+@override_settings(IMAGE_STORAGE_WRITE_WORKERS=0)
+class SessionStatsTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = ImageProcessingSession.objects.create()
+
+    def add_request(self, width, **fields):
+        data = encoded(Image.new('RGB', (width, 80), 'teal'), 'JPEG').getvalue()
+        digest, path = store_blob(ContentFile(data), 'jpg', hash_bytes(data))
+        return ImageProcessingRequest.objects.create(
+            session=self.session, original_filename='photo.jpg', output_width=60, output_height=40,
+            original_image=path, original_hash=digest, original_file_size=len(data), **fields
+        )
+
+    def aggregates(self):
+        images = self.session.images.all()
+        processed = images.filter(is_processed=True)
+        return {
+            'image_count': images.count(),
+            'processed_count': processed.count(),
+            'output_bytes': processed.aggregate(total=Sum('file_size'))['total'] or 0,
+            'first_image_at': images.aggregate(first=Min('created_at'))['first'],
+            'last_processed_at': processed.aggregate(last=Max('processed_at'))['last'],
+        }
+
+    def stats(self):
+        return ImageProcessingSession.objects.filter(pk=self.session.pk).values(*STAT_FIELDS).get()
+
+    def test_stats_follow_requests(self):
+        requests = [self.add_request(100 + index) for index in range(3)]
+        self.assertEqual(self.stats(), self.aggregates())
+
+        for image_request in requests[:2]:
+            self.assertTrue(run_processing_job(image_request)[0])
+        self.assertEqual(self.stats(), self.aggregates())
+        self.assertEqual(self.stats()['processed_count'], 2)
+
+        # Processing again replaces the output instead of counting it twice
+        requests[0].output_width = 30
+        self.assertTrue(run_processing_job(requests[0])[0])
+        self.assertEqual(self.stats(), self.aggregates())
+
+        requests[1].delete()
+        requests[2].delete()
+        self.assertEqual(self.stats(), self.aggregates())
+        self.assertEqual((self.stats()['image_count'], self.stats()['processed_count']), (1, 1))
+
+    def test_counts_do_not_go_negative(self):
+        ImageProcessingSession.update_stats(self.session.pk, images=-1, processed=-1, output_bytes=-100)
+        stats = self.stats()
+        self.assertEqual((stats['image_count'], stats['processed_count'], stats['output_bytes']), (0, 0, 0))
+
+    def test_first_image_time_is_kept(self):
+        first = self.add_request(100)
+        self.add_request(110)
+        self.assertEqual(self.stats()['first_image_at'], first.created_at)
+
+    def test_backfill_matches_aggregates(self):
+        requests = [self.add_request(100 + index) for index in range(3)]
+        run_processing_job(requests[0])
+        run_processing_job(requests[1])
+        empty = ImageProcessingSession.objects.create()
+        ImageProcessingSession.objects.update(
+            image_count=0, processed_count=0, output_bytes=0, first_image_at=None, last_processed_at=None
+        )
+
+        session_stats_migration.fill_session_stats(django_apps, None)
+        self.assertEqual(self.stats(), self.aggregates())
+        self.assertEqual(
+            ImageProcessingSession.objects.filter(pk=empty.pk).values_list('image_count', 'first_image_at').get(),
+            (0, None)
+        )
+
+
+class StorageWritePipelineTests(MediaRootMixin, TestCase):
+
+    def pipeline(self, **options):
+        options = {'workers': 0, 'retries': 2, 'retry_delay': 0, **options}
+        return StorageWritePipeline(**options)
+
+    def ref_count(self, digest):
+        return StoredBlob.objects.get(sha256=digest).ref_count
+
+    def failing_upload(self, failures):
+        """upload_blob that raises `failures` times before storing"""
+        calls = []
+
+        def upload(digest, file, extension):
+            calls.append(digest)
+            if len(calls) <= failures:
+                raise OSError("storage unavailable")
+            return upload_blob(digest, file, extension)
+        return mock.patch('image_processor.storage_writes.upload_blob', side_effect=upload), calls
+
+    def test_stores_in_the_background(self):
+        pipeline = self.pipeline(workers=2)
+        data = {hash_bytes(content): content for content in (b'first', b'second', b'third')}
+        writes = [pipeline.store_bytes(content, 'txt', digest) for digest, content in data.items()]
+        stored = []
+        pipeline.after(writes, stored.extend)
+        self.assertEqual(pipeline.finish(), 0)
+        self.assertEqual(stored, writes)
+        for write in writes:
+            self.assertEqual(lookup_blob(write.digest), write.name)
+            with default_storage.open(write.name) as file:
+                self.assertEqual(file.read(), data[write.digest])
+
+    def test_failed_write_is_retried(self):
+        patch, calls = self.failing_upload(2)
+        pipeline = self.pipeline()
+        with patch, self.assertLogs('image_processor.storage_writes', 'WARNING'):
+            write = pipeline.store_bytes(b'flaky', 'txt', hash_bytes(b'flaky'))
+            self.assertEqual(pipeline.finish(), 0)
+        self.assertEqual(len(calls), 3)
+        self.assertIsNone(write.error)
+        self.assertEqual(self.ref_count(write.digest), 1)
+
+    def test_error_callback_after_last_retry(self):
+        patch, calls = self.failing_upload(3)
+        pipeline = self.pipeline()
+        kept = store_blob(ContentFile(b'kept'), 'txt', hash_bytes(b'kept'))[0]
+        stored, errors = [], []
+        with patch, self.assertLogs('image_processor.storage_writes', 'WARNING'):
+            write = pipeline.store_bytes(b'lost', 'txt', hash_bytes(b'lost'))
+            shared = pipeline.store_bytes(b'kept', 'txt', kept)
+            pipeline.after([shared], stored.append, errors.append, requires=[write])
+            self.assertEqual(pipeline.finish(), 1)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(stored, [])
+        self.assertEqual(errors, ["Could not store the file: storage unavailable"])
+        self.assertIsNone(lookup_blob(write.digest))
+        # The reference taken for the failed result is given back
+        self.assertEqual(self.ref_count(kept), 1)
+
+    def test_duplicate_content_is_uploaded_once(self):
+        pipeline = self.pipeline()
+        digest = hash_bytes(b'twice')
+        with mock.patch('image_processor.storage_writes.upload_blob', side_effect=upload_blob) as upload:
+            first = pipeline.store_bytes(b'twice', 'txt', digest)
+            second = pipeline.store_bytes(b'twice', 'txt', digest)
+            pipeline.finish()
+        upload.assert_called_once()
+        self.assertEqual(first.name, second.name)
+        self.assertEqual(self.ref_count(digest), 2)
+
+    def test_stored_content_is_only_referenced(self):
+        digest, path = store_blob(ContentFile(b'known'), 'txt', hash_bytes(b'known'))
+        pipeline = self.pipeline()
+        with mock.patch('image_processor.storage_writes.upload_blob') as upload:
+            write = pipeline.store(ContentFile(b'known'), 'txt')
+            pipeline.finish()
+        upload.assert_not_called()
+        self.assertEqual(write.name, path)
+        self.assertEqual(self.ref_count(digest), 2)
+
+    def test_close_releases_references(self):
+        known, path = store_blob(ContentFile(b'known'), 'txt', hash_bytes(b'known'))
+        callbacks = []
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with storage_write_pipeline(workers=0) as pipeline:
+                    pipeline.store_bytes(b'known', 'txt', known)
+                    uploaded = pipeline.store_bytes(b'new', 'txt', hash_bytes(b'new'))
+                    pipeline.after([uploaded], callbacks.append)
+                    raise RuntimeError("batch failed")
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.ref_count(known), 1)
+        self.assertTrue(default_storage.exists(path))
+        self.assertIsNone(lookup_blob(uploaded.digest))
+        self.assertFalse(default_storage.exists(uploaded.name))
+
+
+@override_settings(IMAGE_PROCESSING_MODE='sync', IMAGE_POOL_WORKERS=0, IMAGE_STORAGE_WRITE_WORKERS=0)
+class EphemeralSessionTests(MediaRootMixin, TestCase):
+
+    def stored_contents(self):
+        contents = []
+        for blob in StoredBlob.objects.all():
+            with default_storage.open(blob.path) as file:
+                contents.append(file.read())
+        return contents
+
+    def assertOriginalNotStored(self, form_data):
+        original = form_data['image_0'].read()
+        form_data['image_0'].seek(0)
+        response = self.client.post('/', form_data)
+        self.assertEqual(response.status_code, 302)
+        session = ImageProcessingSession.objects.get()
+        self.assertTrue(session.ephemeral)
+        image = session.images.get()
+        self.assertTrue(image.is_processed)
+        self.assertFalse(image.original_image)
+        self.assertEqual(image.original_hash, '')
+        self.assertNotIn(original, self.stored_contents())
+        self.assertFalse(StoredBlob.objects.filter(sha256=hash_bytes(original)).exists())
+        return image
+
+    @override_settings(IMAGE_EPHEMERAL_MODE='always')
+    def test_originals_are_never_stored(self):
+        self.assertOriginalNotStored(upload_form_data())
+
+    @override_settings(IMAGE_EPHEMERAL_MODE='always', IMAGE_PROCESSING_MODE='queue')
+    def test_ephemeral_uploads_bypass_the_queue(self):
+        self.assertOriginalNotStored(upload_form_data())
+
+    @override_settings(IMAGE_EPHEMERAL_MODE='optional')
+    def test_users_can_opt_in(self):
+        self.assertOriginalNotStored({**upload_form_data(), 'ephemeral': 'on'})
+
+    @override_settings(IMAGE_EPHEMERAL_MODE='optional')
+    def test_originals_are_kept_without_opt_in(self):
+        self.client.post('/', upload_form_data())
+        image = ImageProcessingRequest.objects.get()
+        self.assertFalse(image.session.ephemeral)
+        self.assertTrue(image.original_image)
+        self.assertTrue(lookup_blob(image.original_hash))
+
+    @override_settings(IMAGE_EPHEMERAL_MODE='always')
+    def test_reprocess_is_refused(self):
+        image = self.assertOriginalNotStored(upload_form_data())
+        for method in (self.client.get, self.client.post):
+            with self.subTest(method=method.__name__):
+                response = method(reverse('reprocess_image', args=[image.id]), follow=True)
+                self.assertRedirects(response, reverse('processing_results', args=[image.session.session_id]))
+                self.assertIn(
+                    "The original of this image was not kept, so it cannot be re-processed. Please upload it again.",
+                    [message.message for message in response.context['messages']]
+                )
+        self.assertEqual(ImageProcessingRequest.objects.count(), 1)
+
+
+class FakeCloudinaryStorage:
+    """Stands in for cloudinary_storage's MediaCloudinaryStorage"""
+    __module__ = 'cloudinary_storage.storage'
+    RESOURCE_TYPE = 'image'
+
+    def path(self, name):
+        raise NotImplementedError
+
+
+class StorageRedirectTests(MediaRootMixin, SimpleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(cloudinary.reset_config)
+        cloudinary.config(cloud_name='demo', api_key='key', api_secret='secret')
+
+    def test_local_files_are_streamed(self):
+        self.assertIsNone(storage_redirect_url(default_storage, 'blobs/ab/photo.jpg', 'photo.jpg'))
+
+    def test_cloudinary_url_is_a_signed_attachment(self):
+        url = storage_redirect_url(FakeCloudinaryStorage(), 'media/blobs/ab/abcd.jpg', 'my photo.jpg')
+        self.assertRegex(
+            url, r'^https://res\.cloudinary\.com/demo/image/upload/s--[\w-]{8}--/fl_attachment:my_photo/v1/media/blobs/ab/abcd\.jpg$'
+        )
+
+    @override_settings(IMAGE_DOWNLOAD_REDIRECTS=False)
+    def test_redirects_can_be_turned_off(self):
+        self.assertIsNone(storage_redirect_url(FakeCloudinaryStorage(), 'media/blobs/ab/abcd.jpg', 'photo.jpg'))
+
+
+@override_settings(
+    IMAGE_STORAGE_WRITE_WORKERS=0, IMAGE_RESULT_CACHE_ALIAS='image_results',
+    CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'image_results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'result-cache-tests'},
+    },
+)
+class ResultCacheTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_result_cache().clear()
+        self.session = ImageProcessingSession.objects.create()
+        data = encoded(Image.new('RGB', (120, 80), 'olive'), 'JPEG').getvalue()
+        self.digest = hash_bytes(data)
+        self.source = data
+
+    def add_request(self, **fields):
+        digest, path = store_blob(ContentFile(self.source), 'jpg', self.digest)
+        fields = {'output_width': 60, 'output_height': 40, **fields}
+        return ImageProcessingRequest.objects.create(
+            session=self.session, original_filename='photo.jpg', original_image=path, original_hash=digest, **fields
+        )
+
+    def test_identical_spec_is_served_from_cache(self):
+        first = self.add_request()
+        self.assertTrue(run_processing_job(first)[0])
+        before = get_result_cache_stats()
+
+        second = self.add_request()
+        with mock.patch('image_processor.utils.render_image') as render:
+            self.assertTrue(run_processing_job(second)[0])
+        render.assert_not_called()
+        second.refresh_from_db()
+        self.assertTrue(second.is_processed)
+        self.assertEqual(second.processed_hash, first.processed_hash)
+        self.assertEqual(StoredBlob.objects.get(sha256=first.processed_hash).ref_count, 2)
+        self.assertEqual(get_result_cache_stats()['hits'], before['hits'] + 1)
+
+    def test_other_spec_is_rendered(self):
+        self.assertTrue(run_processing_job(self.add_request())[0])
+        before = get_result_cache_stats()
+        other = self.add_request(output_width=30, output_height=20)
+        self.assertTrue(run_processing_job(other)[0])
+        other.refresh_from_db()
+        with default_storage.open(other.processed_image.name) as file:
+            self.assertEqual(Image.open(file).size, (30, 20))
+        self.assertEqual(get_result_cache_stats()['misses'], before['misses'] + 1)
+
+
+class FakeConnection:
+    """Stands in for django.db.connection; `healthy` decides the health check"""
+    alias = 'default'
+
+    def __init__(self, open=True, healthy=True):
+        self.connection = object() if open else None
+        self.healthy = healthy
+
+    def close(self):
+        self.connection = None
+
+    def close_if_health_check_failed(self):
+        if not self.healthy:
+            self.close()
+
+
+@override_settings(DB_CONNECTION_MODE='serverless', DB_CONN_IDLE_TIMEOUT=30)
+class ConnectionStatsTests(SimpleTestCase):
+
+    def acquire(self, fake, idle=0):
+        db_utils._local.released_at = time.monotonic() - idle
+        with mock.patch('image_processor.db_utils.connection', fake):
+            return acquire_connection()
+
+    def counted(self, before):
+        after = get_connection_stats()
+        return {name: after[name] - before[name] for name in ('acquired', 'reused', 'opened', 'idle_closed', 'health_check_failed')}
+
+    def tearDown(self):
+        release_connection()
+
+    def test_open_connection_is_reused(self):
+        before = get_connection_stats()
+        elapsed = self.acquire(FakeConnection())
+        self.assertGreaterEqual(elapsed, 0)
+        self.assertEqual(self.counted(before), {'acquired': 1, 'reused': 1, 'opened': 0, 'idle_closed': 0, 'health_check_failed': 0})
+
+    def test_idle_connection_is_closed(self):
+        fake = FakeConnection()
+        before = get_connection_stats()
+        self.assertIsNone(self.acquire(fake, idle=60))
+        self.assertIsNone(fake.connection)
+        self.assertEqual(self.counted(before), {'acquired': 0, 'reused': 0, 'opened': 0, 'idle_closed': 1, 'health_check_failed': 0})
+
+    @override_settings(DB_CONNECTION_MODE='persistent')
+    def test_idle_timeout_only_applies_to_serverless(self):
+        fake = FakeConnection()
+        self.assertIsNotNone(self.acquire(fake, idle=60))
+        self.assertIsNotNone(fake.connection)
+
+    def test_failed_health_check(self):
+        before = get_connection_stats()
+        self.assertIsNone(self.acquire(FakeConnection(healthy=False)))
+        self.assertEqual(self.counted(before), {'acquired': 0, 'reused': 0, 'opened': 0, 'idle_closed': 0, 'health_check_failed': 1})
+
+    def test_new_connection_is_timed_from_request_start(self):
+        fake = FakeConnection(open=False)
+        before = get_connection_stats()
+        self.assertIsNone(self.acquire(fake))
+        time.sleep(0.02)
+        for max_age in (0, 60, None):
+            fake.settings_dict = {'CONN_MAX_AGE': max_age}
+            fake.close_at = None
+            connection_created.send(sender=type(fake), connection=fake)
+        after = get_connection_stats()
+        self.assertEqual(self.counted(before)['opened'], 3)
+        self.assertGreaterEqual(after['acquire_ms'] - before['acquire_ms'], 3 * 20)
+
+    def test_connections_outside_requests_are_not_counted(self):
+        release_connection()
+        before = get_connection_stats()
+        connection_created.send(sender=FakeConnection, connection=FakeConnection())
+        self.assertEqual(self.counted(before)['acquired'], 0)
@@ -0,0 +1,62 @@
+"""
+Preview thumbnails for the results page.
+
+Every render also produces small previews of the resized image, so the
+results page does not have to download full-resolution print outputs just
+to show a 160px card. Thumbnails cover an IMAGE_THUMBNAIL_WIDTH x
+IMAGE_THUMBNAIL_HEIGHT box (the card's image area) and are made at each
+scale in THUMBNAIL_SCALES for srcset on high-DPI screens. They are encoded
+as IMAGE_THUMBNAIL_FORMAT and stored content-addressed like outputs.
+"""
+from django.conf import settings
+from PIL import Image
+
+from .encoders import encode_image, get_encoder
+
+# Only used by formats that store a resolution
+THUMBNAIL_DPI = 72
+
+# Model field holding each thumbnail and the pixel density it is made for.
+# Largest first, smaller ones are scaled down from it.
+THUMBNAIL_SCALES = {
+    'thumbnail_2x': 2,
+    'thumbnail': 1,
+}
+
+def get_thumbnail_box():
+    return (
+        int(getattr(settings, 'IMAGE_THUMBNAIL_WIDTH', 400)),
+        int(getattr(settings, 'IMAGE_THUMBNAIL_HEIGHT', 160)),
+    )
+
+def get_thumbnail_format():
+    return getattr(settings, 'IMAGE_THUMBNAIL_FORMAT', 'webp')
+
+def thumbnail_extension():
+    return get_encoder(get_thumbnail_format())['extension']
+
+def thumbnail_size(width, height, scale=1):
+    """
+    Smallest size of a width x height image that still covers the thumbnail
+    box at scale, never larger than the image itself
+    """
+    box_width, box_height = get_thumbnail_box()
+    ratio = min(1, max(box_width * scale / width, box_height * scale / height))
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+def render_thumbnails(img):
+    """
+    Encode thumbnails of a resized image. Returns {field name: bytes}, empty
+    when thumbnails are disabled (IMAGE_THUMBNAIL_WIDTH or HEIGHT of 0).
+    """
+    if min(get_thumbnail_box()) <= 0:
+        return {}
+    output_type = get_thumbnail_format()
+    quality = int(getattr(settings, 'IMAGE_THUMBNAIL_QUALITY', 75))
+    thumbnails = {}
+    for name, scale in THUMBNAIL_SCALES.items():
+        size = thumbnail_size(img.width, img.height, scale)
+        if size != img.size:
+            img = img.resize(size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+        thumbnails[name] = encode_image(img, output_type, THUMBNAIL_DPI, quality=quality, profile='fast').getvalue()
+    return thumbnails
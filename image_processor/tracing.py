@@ -0,0 +1,127 @@
+"""
+Per-request stage timings.
+
+With IMAGE_TRACING on, processing an ImageProcessingRequest records how long
+each stage took and how many encodes it ran, and stores the numbers on the
+request (the *_ms fields and encode_count) where the admin can sort by them:
+
+    decode   opening and decoding the source, including reduction and
+             colour conversion (banded renders also resize here)
+    resize   the final resample and EXIF orientation
+    encode   encoding the output, including file size searches and thumbnails
+    upload   writing the output and thumbnails to storage, on the storage
+             write threads for batches (see storage_writes.py)
+    db       saving the processed request
+
+Code marks stages with `with trace_stage('decode'):`. The active trace lives
+in a context variable, so with tracing off a stage is one lookup and a
+shared no-op context manager, and nothing is written to the database.
+"""
+import contextvars
+import time
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+
+TRACE_STAGES = ('decode', 'resize', 'encode', 'upload', 'db')
+
+_current_trace = contextvars.ContextVar('image_processing_trace', default=None)
+_no_stage = nullcontext()
+
+def tracing_enabled():
+    return bool(getattr(settings, 'IMAGE_TRACING', False))
+
+class Trace:
+    """Stage durations in milliseconds and counters of one processing run"""
+
+    def __init__(self, durations=None, counts=None):
+        self.durations = dict(durations or {})
+        self.counts = dict(counts or {})
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def add(self, name, milliseconds):
+        self.durations[name] = self.durations.get(name, 0) + milliseconds
+
+    def as_dict(self):
+        return {'durations': self.durations, 'counts': self.counts}
+
+def current_trace():
+    """The active Trace, or None when nothing is being traced"""
+    return _current_trace.get()
+
+def trace_stage(name):
+    """Context manager timing a stage of the active trace, a no-op without one"""
+    trace = _current_trace.get()
+    return trace.stage(name) if trace is not None else _no_stage
+
+@contextmanager
+def collect_trace(enabled=None, seed=None):
+    """
+    Make a Trace active for the block and yield it, or yield None when
+    tracing is off. seed is an as_dict() of timings taken elsewhere, e.g.
+    in a pool worker, to continue from.
+    """
+    if enabled is None:
+        enabled = tracing_enabled()
+    if not enabled:
+        yield None
+        return
+    trace = Trace(**(seed or {}))
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+@contextmanager
+def trace_request(image_request, seed=None):
+    """
+    Trace the processing of a request and store the timings on it when the
+    block ends, whether it succeeded or not. Nested uses join the outer trace.
+    """
+    if _current_trace.get() is not None:
+        yield _current_trace.get()
+        return
+    with collect_trace(seed=seed) as trace:
+        started = time.perf_counter()
+        try:
+            yield trace
+        finally:
+            if trace is not None:
+                save_trace(image_request, trace, (time.perf_counter() - started) * 1000)
+
+@contextmanager
+def resume_trace(image_request, trace, extra_ms=0):
+    """
+    Continue the stored trace of a request for work done after its
+    trace_request block, such as a deferred storage write, and store the
+    updated timings. extra_ms is time spent on other threads to add to the
+    total.
+    """
+    if trace is None:
+        yield None
+        return
+    previous_ms = (image_request.total_ms or 0) - trace.durations.get('pool', 0)
+    token = _current_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        save_trace(image_request, trace, previous_ms + extra_ms + (time.perf_counter() - started) * 1000)
+
+def save_trace(image_request, trace, total_ms):
+    """Write a trace's numbers to the request's timing fields"""
+    fields = {f'{stage}_ms': round(trace.durations[stage], 2) for stage in TRACE_STAGES if stage in trace.durations}
+    fields['total_ms'] = round(total_ms + trace.durations.get('pool', 0), 2)
+    fields['encode_count'] = trace.counts.get('encodes', 0)
+    for name, value in fields.items():
+        setattr(image_request, name, value)
+    if image_request.pk:
+        type(image_request).objects.filter(pk=image_request.pk).update(**fields)
@@ -0,0 +1,112 @@
+"""
+Upload handler that keeps only the ends of each uploaded file.
+
+Used by the AJAX validation endpoints, which only need an image's header:
+format and dimensions live in the first bytes (JPEG SOF, PNG IHDR, BMP/GIF
+headers) or, for TIFFs written with the IFD last, in the final bytes. The
+rest of the upload is counted and discarded instead of being buffered in
+memory or spooled to a temporary file.
+"""
+import io
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+HEADER_HEAD_BYTES = 256 * 1024
+HEADER_TAIL_BYTES = 64 * 1024
+
+class HeaderUnavailable(OSError):
+    """Raised when a read needs bytes that were discarded"""
+
+class SparseFile(io.RawIOBase):
+    """
+    Read-only file of `size` bytes of which only the head and tail are known.
+    Reading from the discarded middle raises HeaderUnavailable.
+    """
+    def __init__(self, head, tail, size):
+        self._head = bytes(head)
+        self._tail = bytes(tail)
+        self._size = size
+        self._tail_start = size - len(self._tail)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        end = min(self._pos + len(buffer), self._size)
+        if end <= self._pos:
+            return 0
+        if self._pos < len(self._head):
+            # Short read up to the end of the head, so read-ahead buffering
+            # only fails when the gap itself is needed
+            data = self._head[self._pos:min(end, len(self._head))]
+        elif self._pos >= self._tail_start:
+            data = self._tail[self._pos - self._tail_start:end - self._tail_start]
+        else:
+            raise HeaderUnavailable(f"Bytes {self._pos}-{end} of the upload were not kept")
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+class PartialUploadedFile(UploadedFile):
+    """An upload of which only the head and tail were kept"""
+    def __init__(self, name, content_type, head, tail, size, charset=None, content_type_extra=None):
+        super().__init__(
+            io.BufferedReader(SparseFile(head, tail, size)),
+            name, content_type, size, charset, content_type_extra
+        )
+        self.is_partial = len(head) + len(tail) < size
+
+    def chunks(self, chunk_size=None):
+        raise HeaderUnavailable("Only the header of this upload was kept")
+
+class ImageHeaderUploadHandler(FileUploadHandler):
+    """
+    Keep the first head_bytes and last tail_bytes of every uploaded file and
+    discard the rest. Install it on a request before touching request.FILES.
+    """
+    def __init__(self, request=None, head_bytes=HEADER_HEAD_BYTES, tail_bytes=HEADER_TAIL_BYTES):
+        super().__init__(request)
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.head = bytearray()
+        self.tail = bytearray()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        missing = self.head_bytes - len(self.head)
+        if missing > 0:
+            self.head += raw_data[:missing]
+            raw_data = raw_data[missing:]
+        if raw_data and self.tail_bytes:
+            self.tail += raw_data
+            del self.tail[:-self.tail_bytes]
+        return None
+
+    def file_complete(self, file_size):
+        return PartialUploadedFile(
+            name=self.file_name,
+            content_type=self.content_type,
+            head=self.head,
+            tail=self.tail,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
@@ -4,6 +4,7 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('results/<uuid:session_id>/', views.processing_results, name='processing_results'),
+    path('results/<uuid:session_id>/progress/', views.processing_progress, name='processing_progress'),
     path('download/<int:image_id>/', views.download_image, name='download_image'),
     path('download/session/<uuid:session_id>/', views.download_session_zip, name='download_session_zip'),
     path('delete/<uuid:session_id>/', views.delete_session, name='delete_session'),
@@ -17,6 +18,9 @@ urlpatterns = [
     path('terms/', views.terms, name='terms'),
     path('contact/', views.contact, name='contact'),
     
+    # Staff-only processing metrics
+    path('metrics/', views.processing_metrics, name='processing_metrics'),
+    
     # AJAX endpoints
     path('ajax/image-info/', views.ajax_image_info, name='ajax_image_info'),
     path('ajax/validate-image/', views.ajax_validate_image, name='ajax_validate_image'),
@@ -1,10 +1,27 @@
 from PIL import Image, ImageEnhance
 import io
+import logging
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.utils import timezone
 import zipfile
-import tempfile
+
+from .encoders import get_encoder, get_output_type, get_encoder_profile, output_mode, encode_image
+from .blobs import store_blob, release_blob, hash_bytes
+from .models import ImageProcessingSession
+from .result_cache import lookup_result, remember_result
+from .probe import ImageProbe, get_exif_orientation, apply_orientation, TRANSPOSED_ORIENTATIONS
+from .strips import open_strip_reader, open_source_image
+from .thumbnails import render_thumbnails, thumbnail_extension
+from .tracing import trace_stage, trace_request, resume_trace, current_trace, collect_trace
+from .storage_writes import active_pipeline
+
+logger = logging.getLogger(__name__)
 
 # Preset configurations for common use cases
 PRESET_SIZES = {
@@ -42,13 +59,505 @@ PRESET_SIZES = {
 
 # File size processing - users can now specify any KB value directly
 
-def process_image(image_request):
+# Modes Image.reduce() can shrink directly without changing the result of the
+# later RGB conversion. Anything else (palette, alpha, 16-bit) is converted first.
+REDUCIBLE_MODES = ('RGB', 'L', 'CMYK', 'YCbCr')
+
+# Resample speed tiers. "best" is the original full-cost LANCZOS resize, the
+# cheaper tiers let Pillow shrink with reduce() (box filter) before resampling.
+# "balanced" reduces by as many whole steps as fit and finishes with LANCZOS.
+RESAMPLE_TIERS = {
+    'fast': {'resample': Image.Resampling.BILINEAR, 'reducing_gap': 2.0},
+    'balanced': {'resample': Image.Resampling.LANCZOS, 'reducing_gap': 1.0},
+    'best': {'resample': Image.Resampling.LANCZOS, 'reducing_gap': None},
+}
+
+DEFAULT_RESAMPLE_TIER = 'best'
+
+# Filter radius of each resample filter in source pixels at scale 1, used to
+# overlap bands when resizing in strips
+RESAMPLE_SUPPORT = {
+    Image.Resampling.NEAREST: 1.0,
+    Image.Resampling.BOX: 0.5,
+    Image.Resampling.BILINEAR: 1.0,
+    Image.Resampling.HAMMING: 1.0,
+    Image.Resampling.BICUBIC: 2.0,
+    Image.Resampling.LANCZOS: 3.0,
+}
+
+def get_resample_tier(tier=None):
+    """
+    Resolve a resample tier name, falling back to the deployment default
+    (IMAGE_RESAMPLE_TIER) for missing or unknown values.
+    """
+    if tier not in RESAMPLE_TIERS:
+        tier = getattr(settings, 'IMAGE_RESAMPLE_TIER', DEFAULT_RESAMPLE_TIER)
+    if tier not in RESAMPLE_TIERS:
+        tier = DEFAULT_RESAMPLE_TIER
+    return tier
+
+# Whether uploads skip storing their originals: 'off', 'optional' (the user
+# chooses on the form) or 'always'
+EPHEMERAL_MODES = ('off', 'optional', 'always')
+
+def get_ephemeral_mode():
+    """Resolve IMAGE_EPHEMERAL_MODE, 'off' for missing or unknown values"""
+    mode = getattr(settings, 'IMAGE_EPHEMERAL_MODE', 'off')
+    return mode if mode in EPHEMERAL_MODES else 'off'
+
+def resize_image(img, size, tier=None):
+    """
+    Resize an image using the filter settings of the given resample tier
+    """
+    options = RESAMPLE_TIERS[get_resample_tier(tier)]
+    return img.resize(size, options['resample'], reducing_gap=options['reducing_gap'])
+
+def prepare_image_for_resize(img, width, height, mode='RGB'):
+    """
+    Decode an opened image at the smallest power-of-two reduction that is still
+    at least width x height, and return it in the given mode (RGB or RGBA).
+
+    JPEGs are scaled by the decoder itself (DCT scaling through draft), other
+    formats are shrunk with Image.reduce right after decoding. The colour
+    conversion runs on the reduced image instead of the full-resolution one.
+    """
+    if img.format == 'JPEG':
+        # Must happen before the pixel data is loaded
+        img.draft(None, (width, height))
+
+    factor = get_reduction_factor(img.width, img.height, width, height)
+
+    if img.mode not in REDUCIBLE_MODES and img.mode != mode:
+        img = img.convert(mode)
+
+    if factor > 1:
+        img = img.reduce(factor)
+
+    if img.mode != mode:
+        img = img.convert(mode)
+
+    return img
+
+def get_reduction_factor(source_width, source_height, width, height):
+    """Largest power of two the source can be reduced by and still cover width x height"""
+    factor = 1
+    while source_width // (factor * 2) >= width and source_height // (factor * 2) >= height:
+        factor *= 2
+    return factor
+
+def _stack_rows(top, bottom):
+    stacked = Image.new(top.mode, (top.width, top.height + bottom.height))
+    stacked.paste(top, (0, 0))
+    stacked.paste(bottom, (0, top.height))
+    return stacked
+
+def resize_in_strips(reader, size, mode='RGB', tier=None):
+    """
+    Resize the image behind a strip reader (see strips.py) to size without
+    decoding it whole.
+
+    Each band goes through the same power-of-two reduce() as
+    prepare_image_for_resize and the tier's reducing_gap step, then joins a
+    window of reduced rows. Runs of output rows are resampled from the
+    window with a source box, keeping the filter's support above and below
+    the box in the window, so band seams match a resize of the whole image.
+    Peak memory is one band, the window and the output.
+    """
+    width, height = size
+    source_width, source_height = reader.size
+    factor = get_reduction_factor(source_width, source_height, width, height)
+    reduced_width = -(-source_width // factor)
+    reduced_height = -(-source_height // factor)
+
+    options = RESAMPLE_TIERS[get_resample_tier(tier)]
+    resample = options['resample']
+    # Same second reduction as Image.resize(reducing_gap=...), which skips it
+    # for images with alpha
+    gap_x = gap_y = 1
+    if options['reducing_gap'] is not None and resample != Image.Resampling.NEAREST and mode != 'RGBA':
+        gap_x = int(reduced_width / width / options['reducing_gap']) or 1
+        gap_y = int(reduced_height / height / options['reducing_gap']) or 1
+    # Resize from the exact reduced extent, as Image.resize does after reduce()
+    extent_width = reduced_width / gap_x
+    window_height = -(-reduced_height // gap_y)
+    scale = reduced_height / gap_y / height
+    margin = RESAMPLE_SUPPORT.get(resample, 3.0) * max(scale, 1.0) + 2
+    block = factor * gap_y
+
+    output = Image.new(mode, size)
+    window, window_top = None, 0
+    carry = None
+    decoded_rows = 0
+    output_row = 0
+    for _, band in reader.iter_bands():
+        decoded_rows += band.height
+        if band.mode not in REDUCIBLE_MODES and band.mode != mode:
+            band = band.convert(mode)
+        if carry is not None:
+            band = _stack_rows(carry, band)
+            carry = None
+
+        # reduce() blocks must line up with those of the whole image
+        usable = band.height if decoded_rows >= source_height else band.height - band.height % block
+        if usable < band.height:
+            carry = band.crop((0, usable, band.width, band.height))
+            band = band.crop((0, 0, band.width, usable))
+        if usable == 0:
+            continue
+        if factor > 1:
+            band = band.reduce(factor)
+        if band.mode != mode:
+            band = band.convert(mode)
+        if gap_x > 1 or gap_y > 1:
+            band = band.reduce((gap_x, gap_y))
+
+        window = band if window is None else _stack_rows(window, band)
+        window_bottom = window_top + window.height
+        if window_bottom >= window_height:
+            end = height
+        else:
+            end = min(height, int((window_bottom - margin) / scale))
+        if end <= output_row:
+            continue
+
+        box = (
+            0, output_row * scale - window_top,
+            extent_width, min(end * scale - window_top, window.height),
+        )
+        output.paste(window.resize((width, end - output_row), resample, box=box), (0, output_row))
+        output_row = end
+
+        # Drop reduced rows no later output row can reach
+        keep_from = int(output_row * scale - margin) - window_top
+        if keep_from > 0:
+            window = window.crop((0, keep_from, window.width, window.height))
+            window_top += keep_from
+
+    if output_row < height:
+        raise OSError("Image data ended before the last band")
+    return output
+
+def calculate_output_dpi(image_request):
+    """
+    DPI to embed in the output. When physical dimensions are given it is
+    derived from the pixel and physical sizes, otherwise the requested DPI.
+    Raises ValueError for non-positive physical dimensions.
+    """
+    dpi_value = image_request.dpi
+    if image_request.dimension_width and image_request.dimension_height:
+        try:
+            # Convert physical dimensions to inches if in cm
+            if image_request.dimension_unit == 'cm':
+                width_inches = image_request.dimension_width / 2.54
+                height_inches = image_request.dimension_height / 2.54
+            else:
+                width_inches = image_request.dimension_width
+                height_inches = image_request.dimension_height
+            
+            # Validate physical dimensions
+            if width_inches <= 0 or height_inches <= 0:
+                raise ValueError("Invalid physical dimensions")
+            
+            # Calculate DPI based on pixel dimensions and physical dimensions
+            width_dpi = image_request.output_width / width_inches
+            height_dpi = image_request.output_height / height_inches
+            dpi_value = int(min(width_dpi, height_dpi))
+            
+            # Validate calculated DPI
+            if dpi_value <= 0:
+                dpi_value = image_request.dpi  # Fallback to original DPI
+                
+        except ZeroDivisionError:
+            dpi_value = image_request.dpi  # Fallback to original DPI
+    return dpi_value
+
+def build_processing_spec(image_request, target_size_bytes=None, resample_tier=None):
+    """
+    Describe how an image request should be rendered as a plain dict, so the
+    work can be handed to another process
+    """
+    return {
+        'width': image_request.output_width,
+        'height': image_request.output_height,
+        'dpi': calculate_output_dpi(image_request),
+        'target_size_bytes': target_size_bytes,
+        'resample_tier': get_resample_tier(resample_tier),
+        'output_type': get_output_type(image_request.output_file_type),
+        'encoder_profile': get_encoder_profile(),
+    }
+
+def get_source_file(image_request):
+    """
+    File to read the original image from. The image already opened by the
+    upload probe is preferred, then the uploaded file, over the model field
+    to avoid reading back from Cloudinary right after creation.
+    """
+    if hasattr(image_request, '_probe'):
+        img = image_request._probe.take_image()
+        if img is not None:
+            return img
+    if hasattr(image_request, '_original_file'):
+        return image_request._original_file
+    return image_request.original_image
+
+def render_image(source, spec, stats=None, thumbnails=None):
+    """
+    Decode, resize and encode an image according to a processing spec.
+    `source` can be an opened (not yet decoded) image, a file object, a path
+    or raw bytes. The EXIF orientation is applied to the output. Returns the
+    encoded bytes, raises ValueError when the target file size cannot be met.
+    When a thumbnails dict is given it is filled with the encoded previews
+    of the resized image (see image_processor.thumbnails).
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif hasattr(source, 'seek'):
+        source.seek(0)
+
+    output_type = spec.get('output_type', 'jpg')
+    profile = spec.get('encoder_profile')
+    encoder = get_encoder(output_type)
+    if spec.get('target_size_bytes') and not encoder['supports_quality']:
+        raise ValueError(f"File size targets are not available for {encoder['extension'].upper()} output. Choose JPG or WebP.")
+
+    trace = current_trace()
+    if stats is None and trace is not None:
+        stats = trace.counts
+
+    size = (spec['width'], spec['height'])
+    img = source if isinstance(source, Image.Image) else open_source_image(source)
+    with img:
+        # Decode at the stored orientation, then turn upright
+        orientation = get_exif_orientation(img)
+        decode_size = size[::-1] if orientation in TRANSPOSED_ORIENTATIONS else size
+        mode = output_mode(output_type, img.mode, img.info)
+        strip_reader = open_strip_reader(img)
+        if strip_reader is not None:
+            # Huge TIFF/PNG sources are decoded and resized band by band
+            with trace_stage('decode'):
+                resized_img = resize_in_strips(strip_reader, decode_size, mode, spec['resample_tier'])
+            with trace_stage('resize'):
+                resized_img = apply_orientation(resized_img, orientation)
+        else:
+            with trace_stage('decode'):
+                decoded = prepare_image_for_resize(img, *decode_size, mode=mode)
+                decoded.load()
+            with trace_stage('resize'):
+                # Pillow turns TIFFs upright itself while loading them
+                if get_exif_orientation(img) == orientation:
+                    decoded = apply_orientation(decoded, orientation)
+                resized_img = resize_image(decoded, size, spec['resample_tier'])
+
+    with trace_stage('encode'):
+        if thumbnails is not None:
+            thumbnails.update(render_thumbnails(resized_img))
+
+        if spec.get('target_size_bytes'):
+            if output_type == 'jpg':
+                output_buffer, final_quality = find_optimal_quality(
+                    resized_img, spec['target_size_bytes'], spec['dpi'], stats=stats, profile=profile
+                )
+            else:
+                output_buffer, final_quality = find_quality_for_size(
+                    resized_img, output_type, spec['target_size_bytes'], spec['dpi'], profile, stats=stats
+                )
+            if not output_buffer:
+                raise ValueError("Could not meet the file size target. Try a larger size.")
+            return output_buffer.getvalue()
+
+        return encode_image(resized_img, output_type, spec['dpi'], profile=profile, stats=stats).getvalue()
+
+def render_image_job(source, spec, trace=False):
+    """
+    Process pool entry point for render_image.
+    Returns (True, (encoded bytes, thumbnails, timings)) or (False, error
+    message). timings is the worker's Trace.as_dict() when trace is set,
+    else None.
+    """
+    try:
+        thumbnails = {}
+        with collect_trace(enabled=trace) as job_trace:
+            started = time.perf_counter()
+            data = render_image(source, spec, thumbnails=thumbnails)
+            if job_trace is not None:
+                # Wall time in the worker, added to the request's total
+                job_trace.add('pool', (time.perf_counter() - started) * 1000)
+        return True, (data, thumbnails, job_trace.as_dict() if job_trace is not None else None)
+    except ValueError as e:
+        return False, str(e)
+    except Exception as e:
+        return False, f"Error processing image: {str(e)}"
+
+def get_processed_filename(image_request):
+    """
+    User-facing name for a processed image, used for downloads and ZIP
+    members (stored files are named by content hash)
+    """
+    original_name = os.path.splitext(image_request.original_filename)[0]
+    extension = get_encoder(image_request.output_file_type)['extension']
+    return f"{original_name}_resized_{image_request.output_width}x{image_request.output_height}.{extension}"
+
+def save_processed_image(image_request, data, spec=None, thumbnails=None):
+    """
+    Store rendered output and its thumbnails on the request and mark it as
+    processed. When the spec is given the output is also added to the
+    result cache. Inside a storage write pipeline the files are uploaded in
+    the background and the request is updated when the pipeline finishes.
+    """
+    extension = get_encoder(image_request.output_file_type)['extension']
+    
+    pipeline = active_pipeline()
+    if pipeline is not None:
+        _queue_processed_image(pipeline, image_request, data, extension, spec, thumbnails)
+        return
+    
+    # Identical outputs are stored once
+    with trace_stage('upload'):
+        digest, stored_name = store_blob(ContentFile(data), extension, hash_bytes(data))
+        stored_thumbnails = _store_thumbnails(thumbnails)
+    logger.debug(f"Saving processed image as: {stored_name}")
+    
+    _attach_processed_blob(image_request, digest, stored_name, len(data), stored_thumbnails)
+    if spec is not None:
+        remember_result(image_request, spec, digest, data, thumbnails)
+
+def _queue_processed_image(pipeline, image_request, data, extension, spec, thumbnails):
+    """Hand the output and thumbnails to the pipeline, attaching them once stored"""
+    trace = current_trace()
+    with trace_stage('upload'):
+        output = pipeline.store_bytes(data, extension, hash_bytes(data))
+        preview_extension = thumbnail_extension()
+        queued_thumbnails = {
+            name: pipeline.store_bytes(thumbnail, preview_extension, hash_bytes(thumbnail))
+            for name, thumbnail in (thumbnails or {}).items()
+        }
+    
+    def attach(writes):
+        upload_ms = sum(write.upload_ms for write in writes)
+        if trace is not None:
+            trace.add('upload', upload_ms)
+        with resume_trace(image_request, trace, upload_ms):
+            logger.debug(f"Saving processed image as: {output.name}")
+            stored_thumbnails = {name: (write.digest, write.name) for name, write in queued_thumbnails.items()}
+            _attach_processed_blob(image_request, output.digest, output.name, len(data), stored_thumbnails)
+            if spec is not None:
+                remember_result(image_request, spec, output.digest, data, thumbnails)
+    
+    # Not attached if the original it was made from could not be stored
+    original = getattr(image_request, '_original_write', None)
+    pipeline.after(
+        [output, *queued_thumbnails.values()],
+        attach,
+        on_error=lambda message: mark_processing_failed(image_request, message),
+        requires=[original] if original is not None else ()
+    )
+
+def _store_thumbnails(thumbnails):
+    """Store encoded thumbnails by content, returning {field name: (digest, path)}"""
+    extension = thumbnail_extension()
+    return {
+        name: store_blob(ContentFile(data), extension, hash_bytes(data))
+        for name, data in (thumbnails or {}).items()
+    }
+
+def attach_cached_result(image_request, spec):
+    """
+    Attach a previously rendered identical output to the request, skipping
+    processing. Returns True on a cache hit.
+    """
+    cached = lookup_result(image_request, spec)
+    if not cached:
+        return False
+    
+    # Only re-uploaded if the stored copy was deleted since it was cached
+    output_hash, data, thumbnails = cached
+    extension = get_encoder(image_request.output_file_type)['extension']
+    pipeline = active_pipeline()
+    if pipeline is not None:
+        _queue_processed_image(pipeline, image_request, data, extension, None, thumbnails)
+        return True
+    with trace_stage('upload'):
+        digest, stored_name = store_blob(ContentFile(data), extension, output_hash)
+        stored_thumbnails = _store_thumbnails(thumbnails)
+    logger.debug(f"Reusing cached output {stored_name}")
+    _attach_processed_blob(image_request, digest, stored_name, len(data), stored_thumbnails)
+    return True
+
+class ClaimLost(Exception):
+    """Raised when a queue worker's claim on a job was taken over before it finished"""
+
+# Written when a processed output is attached to a request
+PROCESSED_FIELDS = [
+    'processed_image', 'processed_hash', 'thumbnail', 'thumbnail_hash', 'thumbnail_2x', 'thumbnail_2x_hash',
+    'is_processed', 'processed_at', 'file_size', 'status', 'error_message',
+]
+
+def _attach_processed_blob(image_request, digest, stored_name, size, thumbnails=None):
+    """
+    Point the request at a stored output and thumbnails (already referenced
+    for it) and mark it as processed
+    """
+    previous_hashes = [image_request.processed_hash]
+    previous_size = image_request.file_size or 0 if image_request.is_processed else None
+    
+    image_request.processed_image.name = stored_name
+    image_request.processed_hash = digest
+    for name, (thumbnail_hash, thumbnail_name) in (thumbnails or {}).items():
+        previous_hashes.append(getattr(image_request, f'{name}_hash'))
+        getattr(image_request, name).name = thumbnail_name
+        setattr(image_request, f'{name}_hash', thumbnail_hash)
+    image_request.is_processed = True
+    image_request.processed_at = timezone.now()
+    image_request.file_size = size
+    image_request.status = image_request.STATUS_DONE
+    image_request.error_message = ''
+    with trace_stage('db'):
+        if not _save_claimed(image_request, PROCESSED_FIELDS):
+            # Another worker took the job over, this output is not used
+            release_blob(digest)
+            for thumbnail_hash, _ in (thumbnails or {}).values():
+                release_blob(thumbnail_hash)
+            raise ClaimLost(f"Job {image_request.id} is no longer claimed by this worker")
+        ImageProcessingSession.update_stats(
+            image_request.session_id,
+            processed=1 if previous_size is None else 0,
+            output_bytes=size - (previous_size or 0),
+            processed_at=image_request.processed_at,
+        )
+        for previous_hash in previous_hashes:
+            release_blob(previous_hash)
+
+def mark_processing_failed(image_request, message):
+    """
+    Record a processing failure on the request
+    """
+    image_request.status = image_request.STATUS_FAILED
+    image_request.error_message = message
+    _save_claimed(image_request, ['status', 'error_message'])
+
+def _save_claimed(image_request, fields):
+    """
+    Save fields of a request. Requests run by a queue worker (marked with
+    _claimed_by by jobs.run_job) are only written while that worker still
+    holds their claim. Returns False when the claim was lost.
+    """
+    worker_id = getattr(image_request, '_claimed_by', None)
+    if worker_id is None:
+        image_request.save(update_fields=fields)
+        return True
+    return type(image_request).objects.filter(
+        pk=image_request.pk,
+        claimed_by=worker_id,
+        status=image_request.STATUS_PROCESSING
+    ).update(**{field: getattr(image_request, field) for field in fields}) > 0
+
+def process_image(image_request, resample_tier=None):
     """
     Process a single image according to the specifications
     """
     try:
         # Validate input parameters
-        if not image_request.original_image:
+        if not image_request.original_image and not hasattr(image_request, '_original_file'):
             return False, "No original image provided"
         
         if image_request.output_width <= 0 or image_request.output_height <= 0:
@@ -57,187 +566,172 @@ def process_image(image_request):
         if image_request.dpi <= 0:
             return False, "Invalid DPI value"
         
-        print(f"DEBUG: Starting image processing for {image_request.original_filename}")
-        print(f"DEBUG: Output dimensions: {image_request.output_width}x{image_request.output_height}")
-        print(f"DEBUG: DPI: {image_request.dpi}")
-        
-        # Use the original uploaded file instead of the saved model field
-        # This avoids issues with Cloudinary storage access immediately after creation
-        if hasattr(image_request, '_original_file'):
-            # Use the original uploaded file if available
-            file_to_process = image_request._original_file
-            print(f"DEBUG: Using original uploaded file")
-        else:
-            # Fallback to the model field
-            file_to_process = image_request.original_image
-            print(f"DEBUG: Using model field file")
+        try:
+            spec = build_processing_spec(image_request, resample_tier=resample_tier)
+        except ValueError as e:
+            return False, str(e)
+        logger.debug(
+            f"Processing {image_request.original_filename} at "
+            f"{spec['width']}x{spec['height']}, {spec['dpi']} DPI"
+        )
         
         # Open the original image - use the file object directly instead of path
         # This works with both local storage and cloud storage (Cloudinary)
         try:
-            print(f"DEBUG: File object type: {type(file_to_process)}")
-            print(f"DEBUG: File object name: {getattr(file_to_process, 'name', 'No name')}")
-            print(f"DEBUG: File object size: {getattr(file_to_process, 'size', 'No size')}")
-            
-            # Reset file pointer to beginning
-            if hasattr(file_to_process, 'seek'):
-                file_to_process.seek(0)
-                print(f"DEBUG: File pointer reset to beginning")
-            
-            with Image.open(file_to_process) as img:
-                print(f"DEBUG: Original image opened successfully")
-                print(f"DEBUG: Original size: {img.width}x{img.height}, Mode: {img.mode}")
-                
-                # Convert to RGB if necessary (for JPEG compatibility)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                    print(f"DEBUG: Converted image to RGB mode")
-                
-                # Resize the image
-                resized_img = img.resize(
-                    (image_request.output_width, image_request.output_height),
-                    Image.Resampling.LANCZOS
-                )
-                print(f"DEBUG: Image resized successfully")
-                
-                # Calculate DPI based on physical dimensions if provided
-                dpi_value = image_request.dpi
-                if image_request.dimension_width and image_request.dimension_height:
-                    try:
-                        # Convert physical dimensions to inches if in cm
-                        if image_request.dimension_unit == 'cm':
-                            width_inches = image_request.dimension_width / 2.54
-                            height_inches = image_request.dimension_height / 2.54
-                        else:
-                            width_inches = image_request.dimension_width
-                            height_inches = image_request.dimension_height
-                        
-                        # Validate physical dimensions
-                        if width_inches <= 0 or height_inches <= 0:
-                            return False, "Invalid physical dimensions"
-                        
-                        # Calculate DPI based on pixel dimensions and physical dimensions
-                        width_dpi = image_request.output_width / width_inches
-                        height_dpi = image_request.output_height / height_inches
-                        dpi_value = int(min(width_dpi, height_dpi))
-                        
-                        # Validate calculated DPI
-                        if dpi_value <= 0:
-                            dpi_value = image_request.dpi  # Fallback to original DPI
-                            
-                    except (ValueError, ZeroDivisionError):
-                        dpi_value = image_request.dpi  # Fallback to original DPI
-                
-                print(f"DEBUG: Using DPI: {dpi_value}")
-                
-                # Save the processed image
-                output_buffer = io.BytesIO()
-                resized_img.save(
-                    output_buffer, 
-                    format='JPEG', 
-                    quality=95,
-                    dpi=(dpi_value, dpi_value),
-                    optimize=True
-                )
-                print(f"DEBUG: Image saved to buffer successfully")
-                
-                # Create filename for processed image
-                original_name = os.path.splitext(image_request.original_filename)[0]
-                processed_filename = f"{original_name}_resized_{image_request.output_width}x{image_request.output_height}.jpg"
-                print(f"DEBUG: Processed filename: {processed_filename}")
-                
-                # Save to model
-                image_request.processed_image.save(
-                    processed_filename,
-                    ContentFile(output_buffer.getvalue()),
-                    save=False
-                )
-                print(f"DEBUG: Image saved to model successfully")
-                
-                # Update processing status
-                image_request.is_processed = True
-                image_request.processed_at = timezone.now()
-                image_request.file_size = len(output_buffer.getvalue())
-                image_request.save()
-                print(f"DEBUG: Processing status updated successfully")
-                
-                return True, "Image processed successfully"
+            with trace_request(image_request):
+                if attach_cached_result(image_request, spec):
+                    return True, "Image processed successfully"
+                thumbnails = {}
+                data = render_image(get_source_file(image_request), spec, thumbnails=thumbnails)
+                save_processed_image(image_request, data, spec, thumbnails)
+            return True, "Image processed successfully"
                 
+        except ClaimLost:
+            raise
         except Exception as img_error:
-            print(f"DEBUG: Error during image processing: {str(img_error)}")
+            logger.exception(f"Error processing {image_request.original_filename}")
             return False, f"Error processing image: {str(img_error)}"
             
+    except ClaimLost:
+        raise
     except Exception as e:
-        print(f"DEBUG: General error in process_image: {str(e)}")
+        logger.exception(f"Error processing {image_request.original_filename}")
         return False, f"Error processing image: {str(e)}"
 
-def create_zip_file(session):
+def run_processing_job(image_request, resample_tier=None):
     """
-    Create a ZIP file containing all processed images from a session
+    Process a request according to its stored settings (target file size or
+    standard quality) and record the outcome in its status
     """
-    try:
-        # Create a temporary file for the ZIP
-        temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-        
-        with zipfile.ZipFile(temp_zip.name, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            processed_images = session.images.filter(is_processed=True)
-            
-            for img_request in processed_images:
-                if img_request.processed_image:
-                    # Get the filename from the processed image
-                    filename = os.path.basename(img_request.processed_image.name)
-                    
-                    # Add file to ZIP - use the file object directly instead of path
-                    # This works with both local storage and cloud storage
-                    zip_file.writestr(filename, img_request.processed_image.read())
-        
-        # Read the ZIP file content
-        with open(temp_zip.name, 'rb') as zip_file:
-            zip_content = zip_file.read()
-        
-        # Clean up temporary file
-        os.unlink(temp_zip.name)
-        
-        return zip_content, f"images_session_{session.session_id}.zip"
-        
-    except Exception as e:
-        return None, f"Error creating ZIP file: {str(e)}"
+    if image_request.target_file_size:
+        success, message = process_image_with_size_limit(
+            image_request,
+            target_size_bytes=image_request.target_file_size,
+            resample_tier=resample_tier
+        )
+    else:
+        success, message = process_image(image_request, resample_tier=resample_tier)
+    
+    if not success:
+        mark_processing_failed(image_request, message)
+    return success, message
+
+# Bytes read from storage per step when streaming a ZIP download. Memory use
+# stays bounded by this, not by the archive or member size.
+ZIP_STREAM_CHUNK_SIZE = 64 * 1024
+
+class ZipStreamBuffer:
+    """
+    Write-only, unseekable target for ZipFile. Because it cannot seek,
+    ZipFile writes sizes and CRCs in data descriptors after each member
+    instead of going back to patch the local headers, so output can be sent
+    as soon as it is written.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Return and forget everything written since the last call"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def get_zip_filename(session):
+    return f"images_session_{session.session_id}.zip"
+
+def stream_zip_file(session, chunk_size=ZIP_STREAM_CHUNK_SIZE):
+    """
+    Generate a ZIP archive of all processed images in a session chunk by
+    chunk. Already-compressed formats are stored, others deflated.
+    """
+    return stream_zip(_session_zip_entries(session), chunk_size)
+
+def _session_zip_entries(session):
+    """(ZipInfo, open file, size) for each processed image of a session"""
+    processed_images = session.images.filter(is_processed=True).order_by('created_at')
+    used_names = set()
+
+    for img_request in processed_images.iterator():
+        if not img_request.processed_image:
+            continue
+
+        try:
+            source = img_request.processed_image.open('rb')
+        except Exception as e:
+            logger.warning(f"Skipping {img_request.processed_image.name} in ZIP: {e}")
+            continue
+
+        filename = get_processed_filename(img_request)
+        base, extension = os.path.splitext(filename)
+        copy_number = 1
+        while filename in used_names:
+            copy_number += 1
+            filename = f"{base}_{copy_number}{extension}"
+        used_names.add(filename)
+        modified = timezone.localtime(img_request.processed_at or timezone.now())
+        zip_info = zipfile.ZipInfo(filename, date_time=modified.timetuple()[:6])
+        zip_info.compress_type = (
+            zipfile.ZIP_STORED if get_encoder(img_request.output_file_type)['precompressed']
+            else zipfile.ZIP_DEFLATED
+        )
+        yield zip_info, source, img_request.file_size
+
+def stream_zip(entries, chunk_size=ZIP_STREAM_CHUNK_SIZE):
+    """
+    Generate a ZIP archive of (ZipInfo, open file, size or None) entries
+    chunk by chunk. Members are ZIP64 when their size is unknown or large,
+    and the archive switches to ZIP64 records as needed.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zip_file:
+        for zip_info, source, size in entries:
+            # ZipFile picks ZIP64 headers from the expected size up front
+            zip_info.file_size = size or 0
+
+            with source, zip_file.open(zip_info, 'w', force_zip64=not size) as member:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    data = buffer.pop()
+                    if data:
+                        yield data
+
+            data = buffer.pop()
+            if data:
+                yield data
+
+    # Central directory
+    yield buffer.pop()
 
 def validate_image_file(file):
     """
     Validate uploaded image file
     """
-    try:
-        # Check file size (max 10MB)
-        if file.size > 10 * 1024 * 1024:
-            return False, "File size must be less than 10MB"
-        
-        # Check if it's a valid image
-        img = Image.open(file)
-        img.verify()
-        
-        # Check format
-        if img.format.lower() not in ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff']:
-            return False, "Unsupported image format"
-        
-        return True, "Valid image file"
-        
-    except Exception as e:
-        return False, f"Invalid image file: {str(e)}"
+    probe = ImageProbe(file)
+    if not probe.is_valid:
+        return False, probe.error
+    return True, "Valid image file"
 
 def get_image_info(file):
     """
     Get basic information about an image file
     """
     try:
-        with Image.open(file) as img:
-            return {
-                'width': img.width,
-                'height': img.height,
-                'format': img.format,
-                'mode': img.mode,
-                'size': file.size
-            }
+        return ImageProbe(file).info
     except Exception:
         return None
 
@@ -316,117 +810,281 @@ def get_preset_categories():
         })
     return categories
 
-def find_optimal_quality(img, target_size_bytes, dpi_value):
+# Rate control for size-targeted JPEG output. The size-vs-quality curve is
+# predicted from a cheap sample of the image, full-resolution probes are
+# encoded with the 'fast' profile (no Huffman optimisation), and only the
+# output itself is encoded with the deployment's encoder profile.
+RATE_SAMPLE_TILE = 32
+RATE_SAMPLE_MAX_PIXELS = 128 * 1024
+RATE_SAMPLE_QUALITIES = (10, 20, 35, 50, 65, 80, 90)
+RATE_UNOPTIMIZED_PROBES = 2
+RATE_MAX_PREDICTED_PROBES = 3
+
+def encode_jpeg(img, quality, dpi_value, optimize=True, stats=None, profile=None):
     """
-    Find the optimal JPEG quality to meet the target file size using binary search.
+    Encode an image as JPEG into a new buffer with the encoder profile's
+    options. optimize=False encodes with the 'fast' profile instead, for
+    cheap size probes.
+    Full-resolution encodes are counted in stats['encodes'] when stats is given.
     """
-    low = 1
-    high = 100
-    best_quality = -1
-    best_image_buffer = None
+    return encode_image(img, 'jpg', dpi_value, quality=quality, profile=profile if optimize else 'fast', stats=stats)
 
-    while low <= high:
-        quality = (low + high) // 2
-        buffer = io.BytesIO()
-        img.save(buffer, format='JPEG', quality=quality, dpi=(dpi_value, dpi_value), optimize=True)
-        buffer.seek(0)  # Reset buffer position
+def _interpolate(points, quality):
+    """
+    Interpolate a positive value for any quality from a sorted list of
+    (quality, value) points, linearly in log space
+    """
+    if quality <= points[0][0]:
+        return points[0][1]
+    for (q0, v0), (q1, v1) in zip(points, points[1:]):
+        if quality <= q1:
+            weight = (quality - q0) / (q1 - q0)
+            return math.exp(math.log(v0) + weight * (math.log(v1) - math.log(v0)))
+    return points[-1][1]
+
+def sample_image_tiles(img):
+    """
+    Build a small mosaic of full-resolution tiles spread evenly over the image.
+    Unlike a downscaled copy it keeps the per-block detail the JPEG encoder
+    sees, so its bytes per pixel track the full image closely.
+    """
+    tile = RATE_SAMPLE_TILE
+    budget = min(RATE_SAMPLE_MAX_PIXELS, img.width * img.height // 16)
+    grid = int(budget ** 0.5) // tile
+    if grid < 2 or img.width < tile or img.height < tile:
+        return img
+
+    mosaic = Image.new(img.mode, (grid * tile, grid * tile))
+    for row in range(grid):
+        top = (img.height - tile) * row // (grid - 1)
+        for col in range(grid):
+            left = (img.width - tile) * col // (grid - 1)
+            mosaic.paste(img.crop((left, top, left + tile, top + tile)), (col * tile, row * tile))
+    return mosaic
+
+def predict_size_curve(img, dpi_value, min_quality=1, max_quality=100, profile=None):
+    """
+    Predict the full-resolution JPEG size curve from a tile sample.
+    Returns [(quality, unoptimized size, optimized size)] sorted by quality,
+    the optimized size being that of the encoder profile's output.
+    """
+    sample = sample_image_tiles(img)
+    scale = (img.width * img.height) / (sample.width * sample.height)
+
+    qualities = sorted({min_quality, max_quality, *[
+        q for q in RATE_SAMPLE_QUALITIES if min_quality < q < max_quality
+    ]})
+    return [
+        (
+            q,
+            len(encode_jpeg(sample, q, dpi_value, optimize=False).getvalue()) * scale,
+            len(encode_jpeg(sample, q, dpi_value, optimize=True, profile=profile).getvalue()) * scale,
+        )
+        for q in qualities
+    ]
+
+def _pick_quality(estimate, target_size_bytes, fits, too_big):
+    """
+    Highest quality strictly between fits and too_big whose estimated size
+    meets the target, or fits + 1 if none is predicted to
+    """
+    for quality in range(too_big - 1, fits, -1):
+        if estimate(quality) <= target_size_bytes:
+            return quality
+    return fits + 1
+
+# Shared pool for parallel quality searches. Its width caps the number of
+# concurrent encode threads across all requests in the process.
+_quality_search_pool = None
+_quality_search_pool_lock = threading.Lock()
+
+def get_quality_search_threads():
+    """Number of qualities encoded per round in parallel searches (1 = serial search)"""
+    return max(1, int(getattr(settings, 'IMAGE_QUALITY_SEARCH_THREADS', 1)))
+
+def get_quality_search_pool():
+    """Return the process-wide quality search thread pool, creating it on first use"""
+    global _quality_search_pool
+    with _quality_search_pool_lock:
+        if _quality_search_pool is None:
+            _quality_search_pool = ThreadPoolExecutor(
+                max_workers=get_quality_search_threads(),
+                thread_name_prefix='quality-search'
+            )
+        return _quality_search_pool
+
+def find_optimal_quality_parallel(img, target_size_bytes, dpi_value, min_quality=1, max_quality=100, stats=None, threads=None, profile=None):
+    """
+    Find the highest JPEG quality that meets the target file size with a
+    k-ary search. Each round encodes `threads` evenly spaced qualities
+    concurrently on the shared pool (Pillow releases the GIL while encoding),
+    so the search takes about log_(k+1)(100) rounds.
+    """
+    threads = threads or get_quality_search_threads()
+    pool = get_quality_search_pool()
+
+    def encode(quality):
+        # Image.save stores encoder options on the image object, so every
+        # thread needs its own copy
+        return encode_jpeg(img.copy(), quality, dpi_value, profile=profile)
+
+    result = (None, -1)
+    fits, too_big = min_quality - 1, max_quality + 1
+    while too_big - fits > 1:
+        span = too_big - fits
+        candidates = sorted({fits + span * i // (threads + 1) for i in range(1, threads + 1)} - {fits})
+        futures = [pool.submit(encode, quality) for quality in candidates]
+        if stats is not None:
+            stats['encodes'] = stats.get('encodes', 0) + len(candidates)
+
+        for quality, future in zip(candidates, futures):
+            buffer = future.result()
+            if len(buffer.getvalue()) <= target_size_bytes:
+                result = (buffer, quality)
+                fits = quality
+            else:
+                too_big = quality
+                break
+
+        # Let the remaining encodes of this round finish before the next one
+        for future in futures:
+            future.result()
+
+    return result
+
+def find_optimal_quality(img, target_size_bytes, dpi_value, min_quality=1, max_quality=100, stats=None, threads=None, profile=None):
+    """
+    Find the highest JPEG quality that meets the target file size.
+
+    The sampled size curve picks the first probe. Unoptimized full-resolution
+    probes re-anchor the curve, and between two probes the size is
+    interpolated (a secant step). Optimized encodes then start at the
+    predicted quality and correct the prediction by the measured Huffman gain,
+    falling back to bisection if it keeps missing. Typically one or two probes
+    and one or two optimized encodes are needed.
+
+    With more than one search thread (IMAGE_QUALITY_SEARCH_THREADS or the
+    threads argument) the parallel k-ary search is used instead. Outputs are
+    encoded with the encoder profile (IMAGE_ENCODER_PROFILE by default).
+    """
+    threads = threads or get_quality_search_threads()
+    if threads > 1:
+        return find_optimal_quality_parallel(
+            img, target_size_bytes, dpi_value, min_quality, max_quality, stats=stats, threads=threads, profile=profile
+        )
+
+    curve = predict_size_curve(img, dpi_value, min_quality, max_quality, profile)
+    sampled_sizes = [(q, unoptimized) for q, unoptimized, _ in curve]
+    sampled_gain = [(q, optimized / unoptimized) for q, unoptimized, optimized in curve]
+    probe_sizes = {}
+
+    def estimate_unoptimized(quality):
+        if quality in probe_sizes:
+            return probe_sizes[quality]
+        below = [q for q in probe_sizes if q < quality]
+        above = [q for q in probe_sizes if q > quality]
+        if below and above:
+            return _interpolate([(q, probe_sizes[q]) for q in (max(below), min(above))], quality)
+        if below or above:
+            anchor = max(below) if below else min(above)
+            return _interpolate(sampled_sizes, quality) * probe_sizes[anchor] / _interpolate(sampled_sizes, anchor)
+        return _interpolate(sampled_sizes, quality)
+
+    def estimate_optimized(quality, correction=1.0):
+        return estimate_unoptimized(quality) * _interpolate(sampled_gain, quality) * correction
+
+    # Cheap unoptimized probes to anchor the size curve near the target
+    fits, too_big = min_quality - 1, max_quality + 1
+    for _ in range(RATE_UNOPTIMIZED_PROBES):
+        quality = _pick_quality(estimate_optimized, target_size_bytes, fits, too_big)
+        if quality in probe_sizes:
+            break
+        probe_sizes[quality] = len(encode_jpeg(img, quality, dpi_value, optimize=False, stats=stats).getvalue())
+        if estimate_optimized(quality) <= target_size_bytes:
+            fits = quality
+        else:
+            too_big = quality
+        if too_big - fits <= 1:
+            break
+
+    # Optimized encodes, correcting the estimate by the measured gain
+    result = (None, -1)
+    fits, too_big = min_quality - 1, max_quality + 1
+    correction = 1.0
+    attempts = 0
+    while too_big - fits > 1:
+        if attempts < RATE_MAX_PREDICTED_PROBES:
+            quality = _pick_quality(lambda q: estimate_optimized(q, correction), target_size_bytes, fits, too_big)
+        else:
+            quality = (fits + too_big) // 2
+        attempts += 1
+
+        buffer = encode_jpeg(img, quality, dpi_value, optimize=True, stats=stats, profile=profile)
         size = len(buffer.getvalue())
+        correction = size / estimate_optimized(quality)
 
         if size <= target_size_bytes:
-            best_quality = quality
-            buffer.seek(0)  # Reset buffer position for return
-            best_image_buffer = buffer
+            result = (buffer, quality)
+            fits = quality
+            # Stop once the next quality is not expected to fit either
+            if estimate_optimized(quality + 1, correction) > target_size_bytes:
+                break
+        else:
+            too_big = quality
+
+    return result
+
+def find_quality_for_size(img, output_type, target_size_bytes, dpi_value, profile=None, min_quality=1, max_quality=100, stats=None):
+    """
+    Binary search the highest quality that meets the target file size for
+    quality-based formats other than JPEG (which has its own rate control).
+    Returns (buffer, quality) or (None, -1).
+    """
+    result = (None, -1)
+    low, high = min_quality, max_quality
+    while low <= high:
+        quality = (low + high) // 2
+        buffer = encode_image(img, output_type, dpi_value, quality=quality, profile=profile, stats=stats)
+        if len(buffer.getvalue()) <= target_size_bytes:
+            result = (buffer, quality)
             low = quality + 1
         else:
             high = quality - 1
-            
-    return best_image_buffer, best_quality
+    return result
 
-def process_image_with_size_limit(image_request, target_size_bytes):
+def process_image_with_size_limit(image_request, target_size_bytes, resample_tier=None):
     """
     Process image to meet a target file size.
     """
     try:
-        print(f"DEBUG: Starting size-limited processing for {image_request.original_filename}")
-        print(f"DEBUG: Target size: {target_size_bytes} bytes ({target_size_bytes/1024:.1f} KB)")
-        
-        # Use the original uploaded file instead of the saved model field
-        # This avoids issues with Cloudinary storage access immediately after creation
-        if hasattr(image_request, '_original_file'):
-            # Use the original uploaded file if available
-            file_to_process = image_request._original_file
-            print(f"DEBUG: Using original uploaded file")
-        else:
-            # Fallback to the model field
-            file_to_process = image_request.original_image
-            print(f"DEBUG: Using model field file")
-        
-        with Image.open(file_to_process) as img:
-            print(f"DEBUG: Original image opened successfully")
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-                print(f"DEBUG: Converted image to RGB mode")
-
-            # Resize the image to the requested output dimensions
-            resized_img = img.resize(
-                (image_request.output_width, image_request.output_height),
-                Image.Resampling.LANCZOS
-            )
-            print(f"DEBUG: Image resized to {image_request.output_width}x{image_request.output_height}")
-
-            # Calculate DPI
-            dpi_value = image_request.dpi
-            if image_request.dimension_width and image_request.dimension_height:
-                if image_request.dimension_unit == 'cm':
-                    width_inches = image_request.dimension_width / 2.54
-                    height_inches = image_request.dimension_height / 2.54
-                else:
-                    width_inches = image_request.dimension_width
-                    height_inches = image_request.dimension_height
-                
-                if width_inches > 0 and height_inches > 0:
-                    width_dpi = image_request.output_width / width_inches
-                    height_dpi = image_request.output_height / height_inches
-                    dpi_value = int(min(width_dpi, height_dpi))
-
-            print(f"DEBUG: Using DPI: {dpi_value}")
-
-            # Find the best quality setting for the target size
-            output_buffer, final_quality = find_optimal_quality(resized_img, target_size_bytes, dpi_value)
-            print(f"DEBUG: find_optimal_quality returned - Buffer: {output_buffer is not None}, Quality: {final_quality}")
+        spec = build_processing_spec(image_request, target_size_bytes, resample_tier)
+        logger.debug(
+            f"Processing {image_request.original_filename} at "
+            f"{spec['width']}x{spec['height']}, {spec['dpi']} DPI, "
+            f"target {target_size_bytes / 1024:.1f} KB"
+        )
 
-            if not output_buffer:
-                print(f"DEBUG: Could not meet file size target")
-                return False, "Could not meet the file size target. Try a larger size."
+        with trace_request(image_request):
+            if attach_cached_result(image_request, spec):
+                return True, "Image processed successfully."
 
-            # Save the processed image
-            original_name = os.path.splitext(image_request.original_filename)[0]
-            processed_filename = f"{original_name}_resized_{image_request.output_width}x{image_request.output_height}.jpg"
-            print(f"DEBUG: Saving processed image as: {processed_filename}")
-            
-            image_request.processed_image.save(
-                processed_filename,
-                ContentFile(output_buffer.getvalue()),
-                save=False
-            )
-            print(f"DEBUG: Image saved to model successfully")
-            
-            image_request.is_processed = True
-            image_request.processed_at = timezone.now()
-            image_request.file_size = len(output_buffer.getvalue())
-            image_request.save()
-            print(f"DEBUG: Processing status updated successfully")
+            thumbnails = {}
+            try:
+                data = render_image(get_source_file(image_request), spec, thumbnails=thumbnails)
+            except ValueError as e:
+                logger.debug(f"Could not meet file size target for {image_request.original_filename}")
+                return False, str(e)
 
-            return True, "Image processed successfully."
+            save_processed_image(image_request, data, spec, thumbnails)
+        return True, "Image processed successfully."
 
+    except ClaimLost:
+        raise
     except Exception as e:
-        import traceback
-        print(f"DEBUG: Exception in process_image_with_size_limit: {str(e)}")
-        print(f"DEBUG: Exception type: {type(e)}")
-        print(f"DEBUG: Exception traceback: {traceback.format_exc()}")
+        logger.exception(f"Error processing {image_request.original_filename}")
         return False, f"Error processing image: {str(e)}"
 
-def optimize_image_size(img, image_request, target_size_bytes, dpi_value):
+def optimize_image_size(img, image_request, target_size_bytes, dpi_value, resample_tier=None):
     """
     Intelligent image size optimization using binary search and smart heuristics.
     Prioritizes user-defined dimensions.
@@ -436,7 +1094,7 @@ def optimize_image_size(img, image_request, target_size_bytes, dpi_value):
 
     # The primary strategy is to adjust quality to meet the target size
     # at the dimensions specified by the user.
-    result = try_quality_optimization(img, user_width, user_height, target_size_bytes, dpi_value)
+    result = try_quality_optimization(img, user_width, user_height, target_size_bytes, dpi_value, resample_tier)
 
     # If the result from quality optimization is within the target size, that's perfect.
     if result and result[2] <= target_size_bytes:
@@ -452,79 +1110,38 @@ def optimize_image_size(img, image_request, target_size_bytes, dpi_value):
     # This part of the logic is preserved for future flexibility but may not be
     # reached with the current UI, which always provides dimensions.
     aspect_ratio = user_width / user_height
-    best_result = try_smart_dimension_reduction(img, user_width, user_height, target_size_bytes, dpi_value, aspect_ratio)
+    best_result = try_smart_dimension_reduction(img, user_width, user_height, target_size_bytes, dpi_value, aspect_ratio, resample_tier)
     if best_result:
         return best_result
     
     # Final fallback to aggressive optimization.
-    return try_aggressive_optimization(img, user_width, user_height, target_size_bytes, dpi_value, aspect_ratio)
+    return try_aggressive_optimization(img, user_width, user_height, target_size_bytes, dpi_value, aspect_ratio, resample_tier)
 
-def try_quality_optimization(img, width, height, target_size_bytes, dpi_value):
+def try_quality_optimization(img, width, height, target_size_bytes, dpi_value, resample_tier=None):
     """
     Try to achieve target size by adjusting quality only.
-    Uses binary search for optimal quality.
+    Uses the predictive rate control in find_optimal_quality.
     Returns the best result that is under the target size, or if that's not
     possible, returns the result with the lowest possible quality (smallest size).
     """
-    low_quality, high_quality = 10, 95
-    best_result_under_target = None
-    best_size_diff = float('inf')
-
-    # Keep track of the result with the lowest size in case we never get under the target.
-    result_at_lowest_quality = None
-
-    # It's more efficient to resize once before the loop.
+    # It's more efficient to resize once before searching.
     try:
-        resized_img = img.resize((width, height), Image.Resampling.LANCZOS)
+        resized_img = resize_image(img, (width, height), resample_tier)
     except ValueError:
         # This can happen if dimensions are invalid (e.g., zero or negative)
         # We should handle this gracefully.
         return None 
 
-    # Check lowest quality first to get a baseline for smallest possible size
-    output_buffer = io.BytesIO()
-    resized_img.save(
-        output_buffer,
-        format='JPEG',
-        quality=low_quality,
-        dpi=(dpi_value, dpi_value),
-        optimize=True
-    )
-    result_at_lowest_quality = (output_buffer.getvalue(), low_quality, len(output_buffer.getvalue()), width, height)
+    output_buffer, quality = find_optimal_quality(resized_img, target_size_bytes, dpi_value, 10, 95)
+    if output_buffer is not None:
+        data = output_buffer.getvalue()
+        return (data, quality, len(data), width, height)
 
+    # Even the lowest quality is over the target, so return the smallest file we can create.
+    data = encode_jpeg(resized_img, 10, dpi_value).getvalue()
+    return (data, 10, len(data), width, height)
 
-    while low_quality <= high_quality:
-        mid_quality = (low_quality + high_quality) // 2
-        
-        output_buffer = io.BytesIO()
-        resized_img.save(
-            output_buffer,
-            format='JPEG',
-            quality=mid_quality,
-            dpi=(dpi_value, dpi_value),
-            optimize=True
-        )
-        
-        current_size = len(output_buffer.getvalue())
-        
-        if current_size <= target_size_bytes:
-            # This is a potential candidate for the best result under the target.
-            size_diff = target_size_bytes - current_size
-            if size_diff < best_size_diff:
-                best_result_under_target = (output_buffer.getvalue(), mid_quality, current_size, width, height)
-                best_size_diff = size_diff
-            
-            # We might be able to get a slightly larger file that is still under
-            # the target, which means higher quality. So we search upwards.
-            low_quality = mid_quality + 1
-        else:
-            # File is too big, need to reduce quality.
-            high_quality = mid_quality - 1
-    
-    # If we found a result that meets the target, return it. Otherwise, return the smallest file we could create.
-    return best_result_under_target if best_result_under_target is not None else result_at_lowest_quality
-
-def try_smart_dimension_reduction(img, original_width, original_height, target_size_bytes, dpi_value, aspect_ratio):
+def try_smart_dimension_reduction(img, original_width, original_height, target_size_bytes, dpi_value, aspect_ratio, resample_tier=None):
     """
     Smart dimension reduction with quality optimization
     """
@@ -549,7 +1166,7 @@ def try_smart_dimension_reduction(img, original_width, original_height, target_s
         new_height = max(100, int(original_height * scale))
         
         # Try quality optimization for this dimension
-        result = try_quality_optimization(img, new_width, new_height, target_size_bytes, dpi_value)
+        result = try_quality_optimization(img, new_width, new_height, target_size_bytes, dpi_value, resample_tier)
         if result:
             current_size = result[2]
             size_diff = abs(current_size - target_size_bytes)
@@ -564,7 +1181,7 @@ def try_smart_dimension_reduction(img, original_width, original_height, target_s
     
     return best_result
 
-def try_aggressive_optimization(img, original_width, original_height, target_size_bytes, dpi_value, aspect_ratio):
+def try_aggressive_optimization(img, original_width, original_height, target_size_bytes, dpi_value, aspect_ratio, resample_tier=None):
     """
     Aggressive optimization as final fallback
     """
@@ -579,16 +1196,11 @@ def try_aggressive_optimization(img, original_width, original_height, target_siz
         new_width = max(50, int(original_width * scale))
         new_height = max(50, int(original_height * scale))
         
+        # Resize once per scale, only the quality changes in the inner loop
+        resized_img = resize_image(img, (new_width, new_height), resample_tier)
+        
         for quality in qualities:
-            output_buffer = io.BytesIO()
-            resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            resized_img.save(
-                output_buffer,
-                format='JPEG',
-                quality=quality,
-                dpi=(dpi_value, dpi_value),
-                optimize=True
-            )
+            output_buffer = encode_jpeg(resized_img, quality, dpi_value)
             
             current_size = len(output_buffer.getvalue())
             size_diff = abs(current_size - target_size_bytes)
@@ -599,15 +1211,8 @@ def try_aggressive_optimization(img, original_width, original_height, target_siz
     
     # If still no result, return the smallest possible
     if not best_result:
-        output_buffer = io.BytesIO()
-        resized_img = img.resize((50, int(50 / aspect_ratio)), Image.Resampling.LANCZOS)
-        resized_img.save(
-            output_buffer,
-            format='JPEG',
-            quality=10,
-            dpi=(dpi_value, dpi_value),
-            optimize=True
-        )
+        resized_img = resize_image(img, (50, int(50 / aspect_ratio)), resample_tier)
+        output_buffer = encode_jpeg(resized_img, 10, dpi_value)
         best_result = (output_buffer.getvalue(), 10, len(output_buffer.getvalue()), 50, int(50 / aspect_ratio))
     
     return best_result
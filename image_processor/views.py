@@ -1,31 +1,52 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.contrib import messages
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from django.core.paginator import Paginator
-from django.urls import reverse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+import base64
+import hashlib
 import json
-import mimetypes
 import os
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from PIL import Image
 import io
+import logging
 from datetime import date
 
 from .models import ImageProcessingSession, ImageProcessingRequest
 from .forms import BulkImageProcessingForm
 from .utils import (
-    process_image, create_zip_file, validate_image_file, get_image_info,
-    get_preset_categories, PRESET_SIZES, process_image_with_size_limit, calculate_dimensions
+    process_image, stream_zip_file, get_zip_filename, get_image_info,
+    get_preset_categories, PRESET_SIZES, process_image_with_size_limit, calculate_dimensions,
+    prepare_image_for_resize, resize_image, build_processing_spec, save_processed_image,
+    mark_processing_failed, get_processed_filename, attach_cached_result, get_ephemeral_mode
 )
-from .db_utils import retry_on_db_error, ensure_db_connection, close_db_connections
+from .result_cache import get_result_cache_stats
+from .blobs import hash_file, retain_blob
+from .storage_writes import storage_write_pipeline
+from .downloads import file_response, storage_redirect_url
+from .probe import ImageProbe, probe_files
+from .upload_handlers import ImageHeaderUploadHandler
+from .processing_pool import processing_pool_enabled, get_pool_workers, render_in_pool
+from .admission import (
+    admit, AdmissionRejected, estimate_decode_cost, get_admission_wait, get_admission_stats
+)
+from .jobs import queue_enabled, session_progress
+from .encoders import get_encoder, get_output_type
+from .db_utils import retry_on_db_error, get_connection_stats
+from .tracing import trace_request
+
+logger = logging.getLogger(__name__)
+
+BUSY_MESSAGE = "The server is busy processing other large images. Please try again in a few seconds."
 
-@retry_on_db_error(max_retries=3, delay=1)
 def home(request):
     """
     Main view for bulk image processing
     """
+    retry_after = None
     if request.method == 'POST':
         # Get num_images from POST data (form submission)
         num_images = int(request.POST.get('num_images', 1))
@@ -34,149 +55,54 @@ def home(request):
         form = BulkImageProcessingForm(request.POST, request.FILES, num_images=num_images)
         
         if form.is_valid():
-            # Create a new session for this processing batch
-            session = ImageProcessingSession.objects.create()
-            
-            processed_count = 0
             num_images = form.cleaned_data.get('num_images', 1)
             
-            print(f"DEBUG: Processing {num_images} images")
-            print(f"DEBUG: Available files: {list(request.FILES.keys())}")
+            # Ephemeral submissions never store their originals
+            ephemeral = _ephemeral_submission(form)
             
-            for i in range(num_images):
-                image_field = f'image_{i}'
-                print(f"DEBUG: Checking for image field: {image_field}")
-                
-                if image_field in request.FILES:
-                    image_file = request.FILES[image_field]
-                    print(f"DEBUG: Found image {i+1}: {image_file.name}")
-                    
-                    # Validate image
-                    is_valid, validation_message = validate_image_file(image_file)
-                    if not is_valid:
-                        messages.error(request, f"Image {i+1}: {validation_message}")
-                        continue
-                    
-                    # Get image information
-                    original_info = get_image_info(image_file)
-                    if not original_info:
-                        messages.error(request, f"Image {i+1}: Could not read image information")
-                        continue
-                    
-                    # Calculate dimensions
-                    unit = form.cleaned_data.get(f'dimension_unit_{i}', 'pixels')
-                    dpi = form.cleaned_data.get(f'dpi_{i}', 300)
-                    
-                    # Ensure DPI is valid
-                    if dpi is None or dpi <= 0:
-                        dpi = 300
-                    
-                    width, height = calculate_dimensions(
-                        original_info, unit, dpi,
-                        form.cleaned_data.get(f'output_width_{i}'),
-                        form.cleaned_data.get(f'output_height_{i}'),
-                        form.cleaned_data.get(f'cm_width_{i}'),
-                        form.cleaned_data.get(f'cm_height_{i}'),
-                        form.cleaned_data.get(f'inch_width_{i}'),
-                        form.cleaned_data.get(f'inch_height_{i}')
-                    )
-                    
-                    if not width or not height:
-                        messages.error(request, f"Image {i+1}: Invalid dimensions")
-                        continue
-                    
-                    # Additional validation for Cloudinary upload
-                    try:
-                        # Validate file format
-                        if not image_file.content_type.startswith('image/'):
-                            messages.error(request, f"Image {i+1}: Invalid file format. Please upload an image file.")
-                            continue
-                        
-                        # Check file size (Cloudinary has limits)
-                        if image_file.size > 100 * 1024 * 1024:  # 100MB limit
-                            messages.error(request, f"Image {i+1}: File too large. Maximum size is 100MB.")
-                            continue
-                        
-                        # Validate image format using Pillow
-                        try:
-                            # Reset file pointer
-                            image_file.seek(0)
-                            # Try to open with Pillow to validate
-                            with Image.open(image_file) as img:
-                                img.verify()  # Verify the image
-                            # Reset file pointer again
-                            image_file.seek(0)
-                        except Exception as img_error:
-                            messages.error(request, f"Image {i+1}: Invalid image file. Please upload a valid image.")
-                            continue
-                        
-                    except Exception as validation_error:
-                        messages.error(request, f"Image {i+1}: File validation failed.")
-                        continue
-                    
-                    print(f"DEBUG: Creating ImageProcessingRequest with DPI: {dpi}, Width: {width}, Height: {height}")
-                    
-                    img_request = ImageProcessingRequest.objects.create(
-                        session=session,
-                        original_image=image_file,
-                        output_width=width,
-                        output_height=height,
-                        dpi=dpi,
-                        dimension_unit=unit,
-                        dimension_width=form.cleaned_data.get(f'cm_width_{i}') if unit == 'cm' else form.cleaned_data.get(f'inch_width_{i}'),
-                        dimension_height=form.cleaned_data.get(f'cm_height_{i}') if unit == 'cm' else form.cleaned_data.get(f'inch_height_{i}'),
-                        original_filename=image_file.name,
-                        original_width=original_info['width'],
-                        original_height=original_info['height'],
-                        original_file_size=original_info['size'],
-                    )
-                    
-                    # Store the original file for processing
-                    img_request._original_file = image_file
-                    
-                    # Check for file size target
-                    target_file_size_kb = form.cleaned_data.get(f'target_file_size_kb_{i}')
-                    print(f"DEBUG: Image {i+1} target file size: {target_file_size_kb} KB")
-                    
-                    if target_file_size_kb and target_file_size_kb > 0:
-                        target_size_bytes = target_file_size_kb * 1024
-                        print(f"DEBUG: Processing with size limit: {target_file_size_kb} KB")
-                        try:
-                            success, error_message = process_image_with_size_limit(
-                                img_request,
-                                target_size_bytes=target_size_bytes
-                            )
-                            print(f"DEBUG: Size-limited processing result - Success: {success}, Message: {error_message}")
-                        except Exception as e:
-                            print(f"DEBUG: Exception in size-limited processing: {str(e)}")
-                            success, error_message = False, f"Processing error: {str(e)}"
-                    else:
-                        # Process with standard method
-                        print(f"DEBUG: Processing with standard method")
-                        try:
-                            success, error_message = process_image(img_request)
-                            print(f"DEBUG: Processing result - Success: {success}, Message: {error_message}")
-                            if not success:
-                                print(f"DEBUG: Image processing failed: {error_message}")
-                        except Exception as e:
-                            print(f"DEBUG: Exception in image processing: {str(e)}")
-                            success, error_message = False, f"Processing error: {str(e)}"
-                    
-                    print(f"DEBUG: Final result - Success: {success}, Processed count: {processed_count}")
-                    if success:
-                        processed_count += 1
-                        print(f"DEBUG: Incremented processed count to: {processed_count}")
-                    else:
-                        messages.error(request, f"Image {i+1}: {error_message}")
-                else:
-                    messages.error(request, f"Image {i+1}: No file uploaded")
+            # In queue mode images are only stored here and picked up by
+            # `manage.py process_jobs` workers, which need the stored
+            # originals, so ephemeral submissions are processed here
+            use_queue = queue_enabled() and not ephemeral
             
-            if processed_count > 0:
-                messages.success(request, f"Successfully processed {processed_count} image(s)")
-                return redirect('processing_results', session_id=session.session_id)
-            else:
-                messages.error(request, "No images were processed successfully")
-                session.delete()  # Clean up empty session
+            # Multi-image batches may run on a cheaper resample tier than
+            # interactive single-image requests
+            uploaded_count = sum(1 for i in range(num_images) if f'image_{i}' in request.FILES)
+            resample_tier = settings.IMAGE_BULK_RESAMPLE_TIER if uploaded_count > 1 else None
+            
+            # Multi-image batches are fanned out to the process pool when enabled
+            use_pool = not use_queue and uploaded_count > 1 and processing_pool_enabled()
+            
+            # Hash every upload before storing anything, so repeated files in
+            # the batch are written to storage once
+            upload_hashes = {
+                i: hash_file(request.FILES[f'image_{i}'])
+                for i in range(num_images) if f'image_{i}' in request.FILES
+            }
+            if len(set(upload_hashes.values())) < len(upload_hashes):
+                logger.debug(f"{len(upload_hashes) - len(set(upload_hashes.values()))} duplicate upload(s) in batch")
+            
+            # A double-clicked or retried submission goes to the results of
+            # the first one instead of processing the batch again
+            submission_key = _submission_key(form, [upload_hashes[i] for i in sorted(upload_hashes)])
+            existing = _submitted_session(submission_key)
+            if existing is not None:
+                return _duplicate_submission_redirect(request, existing)
+            
+            # Validate every upload and read its header with a single open, so
+            # each image can be charged its decode cost before it is rendered
+            probes = {i: ImageProbe(request.FILES[f'image_{i}']) for i in upload_hashes}
+            
+            try:
+                response = _process_batch(
+                    request, form, num_images, upload_hashes, probes,
+                    use_queue, use_pool, resample_tier, submission_key, ephemeral
+                )
+                if response is not None:
+                    return response
+            except AdmissionRejected as e:
+                retry_after = e.retry_after
+                messages.error(request, BUSY_MESSAGE)
         else:
             for field, errors in form.errors.items():
                 for error in errors:
@@ -194,54 +120,399 @@ def home(request):
         'preset_categories': get_preset_categories(),
         'presets_json': json.dumps(PRESET_SIZES),
     }
+    if retry_after is not None:
+        response = render(request, 'image_processor/home.html', context, status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
     return render(request, 'image_processor/home.html', context)
 
+def _requested_dimensions(form, i, original_info):
+    """Unit, DPI and output pixel size requested for form entry i"""
+    unit = form.cleaned_data.get(f'dimension_unit_{i}', 'pixels')
+    dpi = form.cleaned_data.get(f'dpi_{i}', 300)
+    
+    # Ensure DPI is valid
+    if dpi is None or dpi <= 0:
+        dpi = 300
+    
+    width, height = calculate_dimensions(
+        original_info, unit, dpi,
+        form.cleaned_data.get(f'output_width_{i}'),
+        form.cleaned_data.get(f'output_height_{i}'),
+        form.cleaned_data.get(f'cm_width_{i}'),
+        form.cleaned_data.get(f'cm_height_{i}'),
+        form.cleaned_data.get(f'inch_width_{i}'),
+        form.cleaned_data.get(f'inch_height_{i}')
+    )
+    return unit, dpi, width, height
+
+def _decode_cost(probe, width, height):
+    """Decode budget charged while an upload is rendered at width x height"""
+    info = probe.info
+    return estimate_decode_cost(
+        info['width'], info['height'], info['mode'], width, height, band_rows=probe.band_rows
+    )
+
+def _ephemeral_submission(form):
+    """Whether a valid home form's originals are processed without being stored"""
+    mode = get_ephemeral_mode()
+    return mode == 'always' or (mode == 'optional' and bool(form.cleaned_data.get('ephemeral')))
+
+def _submission_key(form, upload_hashes):
+    """
+    Idempotency key of a valid form submission: its form token with the
+    content hashes of the uploads and every other submitted value, or None
+    when the form carried no token
+    """
+    token = form.cleaned_data.get('submission_token')
+    if not token:
+        return None
+    values = {
+        name: value for name, value in form.cleaned_data.items()
+        if name != 'submission_token' and not name.startswith('image_')
+    }
+    payload = json.dumps({'token': token, 'uploads': upload_hashes, 'values': values}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@retry_on_db_error(max_retries=3, delay=0.5)
+def _submitted_session(submission_key):
+    if submission_key is None:
+        return None
+    return ImageProcessingSession.objects.filter(idempotency_key=submission_key).first()
+
+@retry_on_db_error(max_retries=3, delay=0.5)
+def _claim_submission(submission_key, ephemeral=False):
+    """
+    Create the session for a submission. Returns (session, created); when a
+    concurrent request with the same key got there first, its session is
+    returned instead.
+    """
+    if submission_key is not None:
+        try:
+            with transaction.atomic():
+                return ImageProcessingSession.objects.create(idempotency_key=submission_key, ephemeral=ephemeral), True
+        except IntegrityError:
+            existing = _submitted_session(submission_key)
+            if existing is not None:
+                return existing, False
+    return ImageProcessingSession.objects.create(ephemeral=ephemeral), True
+
+@retry_on_db_error(max_retries=3, delay=0.5)
+def _create_image_request(**fields):
+    return ImageProcessingRequest.objects.create(**fields)
+
+def _duplicate_submission_redirect(request, session):
+    messages.info(request, "These images were already submitted; showing the results of that submission.")
+    return redirect('processing_results', session_id=session.session_id)
+
+def _process_batch(request, form, num_images, upload_hashes, probes, use_queue, use_pool, resample_tier,
+                   submission_key=None, ephemeral=False):
+    """
+    Store, and unless queued process, the uploads of a valid home form.
+    Ephemeral batches are processed from the uploads and only their outputs
+    are stored. Returns the redirect to the results page, or None when
+    nothing was processed or queued. Raises AdmissionRejected when nothing
+    was processed because the decode budget did not free up in time.
+    """
+    # Create a new session for this processing batch
+    session, created = _claim_submission(submission_key, ephemeral)
+    if not created:
+        return _duplicate_submission_redirect(request, session)
+    
+    with storage_write_pipeline() as pipeline:
+        processed, stored_ids, rejected = _store_and_process(
+            request, form, num_images, upload_hashes, probes, use_queue, use_pool, resample_tier, session, pipeline
+        )
+        # Barrier: every original and output is stored before the redirect
+        pipeline.finish()
+    
+    processed_count = 0
+    for i, img_request in processed:
+        if img_request.status == ImageProcessingRequest.STATUS_FAILED:
+            messages.error(request, f"Image {i+1}: {img_request.error_message}")
+        else:
+            processed_count += 1
+    
+    if rejected and processed_count == 0:
+        session.delete()
+        raise rejected[0][1]
+    for i, _ in rejected:
+        messages.error(request, f"Image {i+1}: {BUSY_MESSAGE}")
+    
+    queued_count = 0
+    if use_queue and stored_ids:
+        # Released to the workers only now that their originals are stored
+        queued_count = ImageProcessingRequest.objects.filter(
+            pk__in=stored_ids,
+            status=ImageProcessingRequest.STATUS_PROCESSING
+        ).update(status=ImageProcessingRequest.STATUS_QUEUED, claimed_at=None)
+    
+    if queued_count > 0:
+        messages.info(request, f"Queued {queued_count} image(s) for processing")
+        return redirect('processing_results', session_id=session.session_id)
+    elif processed_count > 0:
+        messages.success(request, f"Successfully processed {processed_count} image(s)")
+        return redirect('processing_results', session_id=session.session_id)
+    else:
+        messages.error(request, "No images were processed successfully")
+        session.delete()  # Clean up empty session
+    return None
+
+def _store_and_process(request, form, num_images, upload_hashes, probes, use_queue, use_pool, resample_tier,
+                       session, pipeline):
+    """
+    Create the requests of a batch, queueing their originals and outputs on
+    the storage write pipeline so the next image is processed while earlier
+    files upload. Every image is charged its decode cost while it renders
+    (see admission.py). Returns the (index, request) pairs processed, whose
+    outputs may still be uploading, the ids of requests whose originals will
+    be stored by pipeline.finish(), and (index, AdmissionRejected) for the
+    images that could not be admitted.
+    """
+    processed = []
+    stored_ids = []
+    pool_jobs = []
+    rejected = []
+    
+    logger.debug(f"Processing {num_images} images")
+    
+    for i in range(num_images):
+        image_field = f'image_{i}'
+        
+        if image_field in request.FILES:
+            image_file = request.FILES[image_field]
+            
+            # Validated and read with a single open before admission
+            probe = probes[i]
+            if not probe.is_valid:
+                messages.error(request, f"Image {i+1}: {probe.error}")
+                continue
+            original_info = probe.info
+            
+            # Calculate dimensions
+            unit, dpi, width, height = _requested_dimensions(form, i, original_info)
+            
+            if not width or not height:
+                messages.error(request, f"Image {i+1}: Invalid dimensions")
+                continue
+            
+            # Additional validation for Cloudinary upload
+            if not image_file.content_type or not image_file.content_type.startswith('image/'):
+                messages.error(request, f"Image {i+1}: Invalid file format. Please upload an image file.")
+                continue
+            
+            # Check for file size target
+            target_file_size_kb = form.cleaned_data.get(f'target_file_size_kb_{i}')
+            target_size_bytes = target_file_size_kb * 1024 if target_file_size_kb and target_file_size_kb > 0 else None
+            
+            # Content-addressed original; identical files share one stored
+            # copy. Ephemeral sessions skip it and keep only the outputs.
+            original = None
+            if not session.ephemeral:
+                ext = os.path.splitext(image_file.name)[1] or original_info['format']
+                original = pipeline.store(image_file, ext, upload_hashes[i])
+            
+            img_request = _create_image_request(
+                session=session,
+                original_image=original.name if original else '',
+                original_hash=original.digest if original else '',
+                output_width=width,
+                output_height=height,
+                dpi=dpi,
+                dimension_unit=unit,
+                dimension_width=form.cleaned_data.get(f'cm_width_{i}') if unit == 'cm' else form.cleaned_data.get(f'inch_width_{i}'),
+                dimension_height=form.cleaned_data.get(f'cm_height_{i}') if unit == 'cm' else form.cleaned_data.get(f'inch_height_{i}'),
+                original_filename=image_file.name,
+                original_width=original_info['width'],
+                original_height=original_info['height'],
+                original_file_size=original_info['size'],
+                output_file_type=get_output_type(form.cleaned_data.get(f'output_file_type_{i}')),
+                target_file_size=target_size_bytes,
+                # Queued rows are held back from the workers until
+                # their original is stored; the lease requeues them if
+                # this request dies first
+                status=ImageProcessingRequest.STATUS_PROCESSING,
+                claimed_at=timezone.now() if use_queue else None,
+            )
+            if original is not None:
+                img_request._original_write = original
+                _after_original_stored(pipeline, img_request, original, stored_ids)
+            else:
+                # Still lets identical renders be served from the result cache
+                img_request._source_hash = upload_hashes[i]
+            
+            if use_queue:
+                continue
+            
+            # Store the original file for processing; the probe's opened
+            # image is decoded directly when processing inline
+            img_request._original_file = image_file
+            img_request._probe = probe
+            
+            if use_pool:
+                # Rendered in the process pool after all images are queued
+                try:
+                    spec = build_processing_spec(img_request, target_size_bytes, resample_tier)
+                except ValueError as e:
+                    mark_processing_failed(img_request, str(e))
+                    messages.error(request, f"Image {i+1}: {str(e)}")
+                    continue
+                with trace_request(img_request):
+                    cached = attach_cached_result(img_request, spec)
+                if cached:
+                    processed.append((i, img_request))
+                    continue
+                pool_jobs.append((i, img_request, spec, _decode_cost(probe, width, height)))
+                continue
+            
+            try:
+                with admit(_decode_cost(probe, width, height), timeout=get_admission_wait()):
+                    success, error_message = _render_entry(img_request, i, target_size_bytes, resample_tier)
+            except AdmissionRejected as e:
+                mark_processing_failed(img_request, BUSY_MESSAGE)
+                rejected.append((i, e))
+                continue
+            
+            if success:
+                processed.append((i, img_request))
+            else:
+                mark_processing_failed(img_request, error_message)
+                messages.error(request, f"Image {i+1}: {error_message}")
+        else:
+            messages.error(request, f"Image {i+1}: No file uploaded")
+    
+    if pool_jobs:
+        # As many images render at once as the pool has workers
+        cost = sum(sorted((job[3] for job in pool_jobs), reverse=True)[:get_pool_workers()])
+        try:
+            with admit(cost, timeout=get_admission_wait()):
+                results = render_in_pool([(img_request._original_file, spec) for _, img_request, spec, _ in pool_jobs])
+        except AdmissionRejected as e:
+            for i, img_request, _, _ in pool_jobs:
+                mark_processing_failed(img_request, BUSY_MESSAGE)
+                rejected.append((i, e))
+            pool_jobs, results = [], []
+        for (i, img_request, spec, _), (success, result) in zip(pool_jobs, results):
+            if success:
+                try:
+                    data, thumbnails, timings = result
+                    with trace_request(img_request, seed=timings):
+                        save_processed_image(img_request, data, spec, thumbnails)
+                except Exception as e:
+                    success, result = False, f"Error processing image: {str(e)}"
+            if success:
+                processed.append((i, img_request))
+            else:
+                mark_processing_failed(img_request, result)
+                messages.error(request, f"Image {i+1}: {result}")
+    
+    return processed, stored_ids, rejected
+
+def _render_entry(img_request, i, target_size_bytes, resample_tier):
+    """Render one inline upload. Returns (success, error message)"""
+    if target_size_bytes:
+        try:
+            return process_image_with_size_limit(
+                img_request,
+                target_size_bytes=target_size_bytes,
+                resample_tier=resample_tier
+            )
+        except Exception as e:
+            logger.exception(f"Size-limited processing of image {i+1} failed")
+            return False, f"Processing error: {str(e)}"
+    # Process with standard method
+    try:
+        return process_image(img_request, resample_tier=resample_tier)
+    except Exception as e:
+        logger.exception(f"Processing of image {i+1} failed")
+        return False, f"Processing error: {str(e)}"
+
+def _after_original_stored(pipeline, img_request, write, stored_ids):
+    """
+    Once the pipeline has stored a request's original, record the path on
+    file if it differs from the one the row was created with; fail the
+    request if it could not be stored.
+    """
+    def stored(writes):
+        if img_request.original_image.name != write.name:
+            img_request.original_image.name = write.name
+            ImageProcessingRequest.objects.filter(pk=img_request.pk).update(original_image=write.name)
+        stored_ids.append(img_request.pk)
+    
+    pipeline.after([write], stored, on_error=lambda message: mark_processing_failed(img_request, message))
+
 def processing_results(request, session_id):
     """
     Display processing results for a session
     """
     session = get_object_or_404(ImageProcessingSession, session_id=session_id)
-    images = session.images.all().order_by('created_at')
-
-    # Calculate time taken in seconds (from first created_at to last processed_at)
-    if images.exists():
-        first_created = images.order_by('created_at').first().created_at
-        last_processed = images.filter(is_processed=True).order_by('-processed_at').first()
-        if last_processed and last_processed.processed_at and first_created:
-            time_taken_seconds = int((last_processed.processed_at - first_created).total_seconds())
-        else:
-            time_taken_seconds = None
-    else:
-        time_taken_seconds = None
+    # One query for the images; the totals are kept on the session row
+    images = list(session.images.order_by('created_at'))
 
     context = {
         'session': session,
         'images': images,
-        'processed_count': images.filter(is_processed=True).count(),
-        'total_count': images.count(),
-        'time_taken_seconds': time_taken_seconds,
+        'processed_count': session.processed_count,
+        'total_count': session.image_count,
+        'time_taken_seconds': session.time_taken_seconds,
+        'progress': session_progress(session, images),
     }
     return render(request, 'image_processor/results.html', context)
 
+def processing_progress(request, session_id):
+    """
+    JSON progress of a session's queued images, polled by the results page
+    """
+    session = get_object_or_404(ImageProcessingSession, session_id=session_id)
+    images = list(session.images.order_by('created_at').values('id', 'status', 'error_message'))
+    progress = session_progress(session, images)
+    progress['images'] = [
+        {
+            'id': image['id'],
+            'status': image['status'],
+            'error': image['error_message'],
+        }
+        for image in images
+    ]
+    return JsonResponse(progress)
+
+@staff_member_required
+def processing_metrics(request):
+    """
+    Processing counters for staff, as JSON
+    """
+    return JsonResponse({
+        'result_cache': get_result_cache_stats(),
+        'decode_budget': get_admission_stats(),
+        'db_connections': get_connection_stats(),
+    })
+
 def download_image(request, image_id):
     """
-    Download a single processed image
+    Download a single processed image. Storage with its own URLs is
+    redirected to, anything else is streamed (see downloads.py).
     """
     img_request = get_object_or_404(ImageProcessingRequest, id=image_id, is_processed=True)
     
     if not img_request.processed_image:
         raise Http404("Processed image not found")
     
+    encoder = get_encoder(img_request.output_file_type)
+    filename = get_processed_filename(img_request)
+    storage = img_request.processed_image.storage
+    name = img_request.processed_image.name
+    
+    url = storage_redirect_url(storage, name, filename)
+    if url:
+        return redirect(url)
+    
     try:
-        response = HttpResponse(
-            img_request.processed_image.read(),
-            content_type='image/jpeg'
-        )
-        filename = f"{img_request.original_filename.split('.')[0]}_resized_{img_request.output_width}x{img_request.output_height}.jpg"
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return response
+        file = storage.open(name, 'rb')
     except FileNotFoundError:
         raise Http404("File not found")
+    # Content-addressed, so the hash identifies this exact file
+    etag = f'"{img_request.processed_hash}"' if img_request.processed_hash else None
+    return file_response(request, file, filename, encoder['content_type'], etag)
 
 def download_session_zip(request, session_id):
     """
@@ -254,15 +525,10 @@ def download_session_zip(request, session_id):
         messages.error(request, "No processed images found in this session")
         return redirect('processing_results', session_id=session_id)
     
-    zip_content, filename = create_zip_file(session)
-    
-    if zip_content:
-        response = HttpResponse(zip_content, content_type='application/zip')
-        response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return response
-    else:
-        messages.error(request, f"Error creating ZIP file: {filename}")
-        return redirect('processing_results', session_id=session_id)
+    # The archive is built while it is sent, one image at a time
+    response = StreamingHttpResponse(stream_zip_file(session), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{get_zip_filename(session)}"'
+    return response
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -270,29 +536,36 @@ def ajax_image_info(request):
     """
     AJAX endpoint to get image information
     """
+    # Only the header is needed, so the rest of the upload is not buffered
+    request.upload_handlers = [ImageHeaderUploadHandler(request)]
     if 'image' not in request.FILES:
         return JsonResponse({'success': False, 'error': 'No image provided'})
     
-    image_file = request.FILES['image']
+    probe = ImageProbe(request.FILES['image'])
+    if not probe.is_valid:
+        return JsonResponse({'success': False, 'error': probe.error})
     
-    # Validate image
-    is_valid, message = validate_image_file(image_file)
-    if not is_valid:
-        return JsonResponse({'success': False, 'error': message})
-    
-    # Get image info
-    info = get_image_info(image_file)
+    info = probe.info
     if info:
-        return JsonResponse({
+        response_data = {
             'success': True,
             'width': info['width'],
             'height': info['height'],
             'format': info['format'],
             'size': info['size']
-        })
+        }
+        response_data.update(_thumbnail_data(probe))
+        return JsonResponse(response_data)
     else:
         return JsonResponse({'success': False, 'error': 'Could not read image information'})
 
+def _thumbnail_data(probe):
+    """Embedded EXIF thumbnail of a probed image as a data URI, if it has one"""
+    thumbnail = probe.exif_thumbnail()
+    if not thumbnail:
+        return {}
+    return {'thumbnail': 'data:image/jpeg;base64,' + base64.b64encode(thumbnail).decode('ascii')}
+
 def delete_session(request, session_id):
     """
     Delete a processing session and all associated files
@@ -315,7 +588,7 @@ def delete_session(request, session_id):
     
     context = {
         'session': session,
-        'processed_count': session.images.filter(is_processed=True).count(),
+        'processed_count': session.processed_count,
     }
     return render(request, 'image_processor/confirm_delete.html', context)
 
@@ -331,26 +604,37 @@ def ajax_validate_image(request):
     """
     AJAX endpoint to validate uploaded images
     """
+    # Only the headers are needed, so the rest of each upload is not buffered
+    request.upload_handlers = [ImageHeaderUploadHandler(request)]
     response_data = {}
     
-    for key, file in request.FILES.items():
-        if key.startswith('image_'):
-            is_valid, message = validate_image_file(file)
-            index = key.split('_')[1]
+    uploads = [(key, file) for key, file in request.FILES.items() if key.startswith('image_')]
+    probes = probe_files(file for _, file in uploads)
+    
+    for (key, file), probe in zip(uploads, probes):
+        index = key.split('_')[1]
+        if probe.header_incomplete:
+            # Checked in full when the form is submitted
             response_data[index] = {
-                'valid': is_valid,
-                'message': message
+                'valid': True,
+                'message': "Image details will be checked on upload"
             }
-            
-            if is_valid:
-                info = get_image_info(file)
-                if info:
-                    response_data[index].update({
-                        'width': info['width'],
-                        'height': info['height'],
-                        'format': info['format'],
-                        'size_mb': round(info['size'] / (1024 * 1024), 2)
-                    })
+            continue
+        
+        response_data[index] = {
+            'valid': probe.is_valid,
+            'message': "Valid image file" if probe.is_valid else probe.error
+        }
+        
+        info = probe.info
+        if info:
+            response_data[index].update({
+                'width': info['width'],
+                'height': info['height'],
+                'format': info['format'],
+                'size_mb': round(info['size'] / (1024 * 1024), 2)
+            })
+            response_data[index].update(_thumbnail_data(probe))
     
     return JsonResponse(response_data)
 
@@ -389,7 +673,12 @@ def reprocess_image(request, image_id):
     """
     Reprocess an existing image with new settings.
     """
-    original_request = get_object_or_404(ImageProcessingRequest, id=image_id)
+    original_request = get_object_or_404(ImageProcessingRequest.objects.select_related('session'), id=image_id)
+    retry_after = None
+    
+    if original_request.session.ephemeral or not original_request.original_image:
+        messages.error(request, "The original of this image was not kept, so it cannot be re-processed. Please upload it again.")
+        return redirect('processing_results', session_id=original_request.session.session_id)
 
     if request.method == 'POST':
         post_data = request.POST.copy()
@@ -401,17 +690,39 @@ def reprocess_image(request, image_id):
                 post_data[tfs_key] = ''
         form = BulkImageProcessingForm(post_data, num_images=1)
         if form.is_valid():
-            session = ImageProcessingSession.objects.create()
+            # Read before a session is claimed, so a missing original leaves
+            # nothing behind
             image_file = original_request.original_image
             original_info = get_image_info(image_file)
-
-            # Re-use the processing logic from the home view
-            if _process_form_entry(request, form, 0, session, image_file, original_info):
-                messages.success(request, "Image re-processed successfully.")
-                return redirect('processing_results', session_id=session.session_id)
-            else:
-                session.delete()  # Clean up empty session on failure
+            if original_info is None:
+                messages.error(request, "The original image could not be read, so it cannot be re-processed. Please upload it again.")
                 # Fall through to re-render form with errors
+            else:
+                submission_key = _submission_key(form, [original_request.original_hash or str(original_request.id)])
+                session, created = _claim_submission(submission_key)
+                if not created:
+                    return _duplicate_submission_redirect(request, session)
+
+                _, _, width, height = _requested_dimensions(form, 0, original_info)
+                cost = estimate_decode_cost(
+                    original_info['width'], original_info['height'], original_info['mode'], width, height
+                )
+
+                # Re-use the processing logic from the home view
+                try:
+                    with admit(cost, timeout=get_admission_wait()):
+                        processed = _process_form_entry(request, form, 0, session, image_file, original_info,
+                                                        original_hash=original_request.original_hash)
+                except AdmissionRejected as e:
+                    retry_after = e.retry_after
+                    processed = False
+                    messages.error(request, BUSY_MESSAGE)
+                if processed:
+                    messages.success(request, "Image re-processed successfully.")
+                    return redirect('processing_results', session_id=session.session_id)
+                else:
+                    session.delete()  # Clean up empty session on failure
+                    # Fall through to re-render form with errors
         else:
             pass  # Fall through to re-render form with errors
     else:
@@ -419,6 +730,7 @@ def reprocess_image(request, image_id):
         initial_data = {
             'dimension_unit_0': original_request.dimension_unit,
             'dpi_0': original_request.dpi,
+            'output_file_type_0': original_request.output_file_type,
             'target_file_size_kb_0': int(original_request.file_size / 1024) if original_request.file_size else None,
         }
         if original_request.dimension_unit == 'pixels':
@@ -437,11 +749,17 @@ def reprocess_image(request, image_id):
         'form': form,
         'original_request': original_request
     }
+    if retry_after is not None:
+        response = render(request, 'image_processor/reprocess.html', context, status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
     return render(request, 'image_processor/reprocess.html', context)
 
-def _process_form_entry(request, form, i, session, image_file, original_info):
+def _process_form_entry(request, form, i, session, image_file, original_info, original_hash=''):
     """
     Helper function to process a single form entry for an image.
+    `original_hash` is the content hash of an already stored original, which
+    gains a reference instead of being stored again.
     Returns True on success, False on failure.
     """
     try:
@@ -483,9 +801,16 @@ def _process_form_entry(request, form, i, session, image_file, original_info):
             messages.error(request, f"Image {i+1}: Invalid final dimensions calculated.")
             return False
 
-        img_request = ImageProcessingRequest.objects.create(
+        target_file_size_kb = form.cleaned_data.get(f'target_file_size_kb_{i}')
+        target_size_bytes = target_file_size_kb * 1024 if target_file_size_kb and target_file_size_kb > 0 else None
+
+        if original_hash and not retain_blob(original_hash):
+            original_hash = ''
+        
+        img_request = _create_image_request(
             session=session,
             original_image=image_file,
+            original_hash=original_hash,
             output_width=width,
             output_height=height,
             dpi=dpi,
@@ -496,29 +821,28 @@ def _process_form_entry(request, form, i, session, image_file, original_info):
             original_width=original_info['width'],
             original_height=original_info['height'],
             original_file_size=original_info['size'],
+            output_file_type=get_output_type(form.cleaned_data.get(f'output_file_type_{i}')),
+            target_file_size=target_size_bytes,
+            status=ImageProcessingRequest.STATUS_PROCESSING,
         )
         
         # Store the original file for processing
         img_request._original_file = image_file
         
-        target_file_size_kb = form.cleaned_data.get(f'target_file_size_kb_{i}')
-        
-        if target_file_size_kb and target_file_size_kb > 0:
-            target_size_bytes = target_file_size_kb * 1024
-            print(f"DEBUG: Processing with size limit: {target_file_size_kb} KB")
+        if target_size_bytes:
             try:
                 success, error_message = process_image_with_size_limit(
                     img_request,
                     target_size_bytes=target_size_bytes
                 )
-                print(f"DEBUG: Size-limited processing result - Success: {success}, Message: {error_message}")
             except Exception as e:
-                print(f"DEBUG: Exception in size-limited processing: {str(e)}")
+                logger.exception(f"Size-limited processing of {img_request.original_filename} failed")
                 success, error_message = False, f"Processing error: {str(e)}"
         else:
             success, error_message = process_image(img_request)
         
         if not success:
+            mark_processing_failed(img_request, error_message)
             messages.error(request, f"Image {i+1}: {error_message}")
             return False
             
@@ -535,26 +859,34 @@ def in_memory_process(request):
     """
     if request.method == 'POST' and request.FILES.get('image'):
         image_file = request.FILES['image']
+        from PIL import Image
         try:
             # Read image into Pillow
             img = Image.open(image_file)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
 
             # Example: Resize (you can add more options)
             width = int(request.POST.get('width', img.width))
             height = int(request.POST.get('height', img.height))
-            img = img.resize((width, height), Image.Resampling.LANCZOS)
+            cost = estimate_decode_cost(img.width, img.height, img.mode, width, height)
+            with admit(cost, timeout=get_admission_wait()):
+                img = prepare_image_for_resize(img, width, height)
+                img = resize_image(img, (width, height))
 
-            # Save to in-memory buffer
-            buffer = io.BytesIO()
-            img.save(buffer, format='JPEG', quality=90)
-            buffer.seek(0)
+                # Save to in-memory buffer
+                buffer = io.BytesIO()
+                img.save(buffer, format='JPEG', quality=90)
+                buffer.seek(0)
 
             # Prepare response
             response = HttpResponse(buffer, content_type='image/jpeg')
             response['Content-Disposition'] = f'attachment; filename="processed_{image_file.name.split(".")[0]}.jpg"'
             return response
+        except AdmissionRejected as e:
+            response = render(request, 'image_processor/in_memory_process.html', {
+                'error': BUSY_MESSAGE
+            }, status=429)
+            response['Retry-After'] = str(e.retry_after)
+            return response
         except Exception as e:
             return render(request, 'image_processor/in_memory_process.html', {
                 'error': f'Error processing image: {e}'
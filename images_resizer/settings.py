@@ -12,8 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from pathlib import Path
 import os
-import dj_database_url
-import boto3
+import tempfile
 from django.core.exceptions import ImproperlyConfigured
 
 # Load environment variables from .env file
@@ -74,7 +73,6 @@ INSTALLED_APPS = [
     'image_processor',
     'crispy_forms',
     'crispy_bootstrap5',
-    'cloudinary',
     'cloudinary_storage',
 ]
 
@@ -117,6 +115,44 @@ WSGI_APPLICATION = 'images_resizer.wsgi.application'
 # Get database URL from environment variable
 DATABASE_URL = get_env_variable('DATABASE_URL', default=None)
 
+# How connections are kept between requests (see image_processor/db_utils.py):
+# 'persistent' reuses health-checked connections for up to DB_CONN_MAX_AGE
+# seconds (long-running gunicorn), 'serverless' also drops a connection left
+# idle for more than DB_CONN_IDLE_TIMEOUT seconds, since the function may have
+# been frozen meanwhile, 'pool' checks connections out of an in-process pool
+# of DB_POOL_SIZE (plus DB_POOL_MAX_OVERFLOW) and 'close' opens a new
+# connection for every request.
+DB_CONNECTION_MODE = get_env_variable('DB_CONNECTION_MODE', 'serverless')
+DB_CONN_MAX_AGE = int(get_env_variable('DB_CONN_MAX_AGE', '600'))
+DB_CONN_IDLE_TIMEOUT = int(get_env_variable('DB_CONN_IDLE_TIMEOUT', '30'))
+DB_POOL_SIZE = int(get_env_variable('DB_POOL_SIZE', '5'))
+DB_POOL_MAX_OVERFLOW = int(get_env_variable('DB_POOL_MAX_OVERFLOW', '5'))
+DB_FORCE_IPV4 = get_env_variable('DB_FORCE_IPV4', 'False') == 'True'
+DB_POOL_BACKENDS = {
+    'django.db.backends.postgresql': 'dj_db_conn_pool.backends.postgresql',
+    'django.db.backends.mysql': 'dj_db_conn_pool.backends.mysql',
+    'django.db.backends.oracle': 'dj_db_conn_pool.backends.oracle',
+}
+
+def connection_settings(engine):
+    """CONN_MAX_AGE and related DATABASES options for DB_CONNECTION_MODE"""
+    if DB_CONNECTION_MODE == 'pool' and engine in DB_POOL_BACKENDS:
+        # Django hands the connection back after every request, which
+        # returns it to the pool
+        return {
+            'ENGINE': DB_POOL_BACKENDS[engine],
+            'CONN_MAX_AGE': 0,
+            'POOL_OPTIONS': {
+                'POOL_SIZE': DB_POOL_SIZE,
+                'MAX_OVERFLOW': DB_POOL_MAX_OVERFLOW,
+                'RECYCLE': DB_CONN_MAX_AGE,
+                'PRE_PING': True,
+            },
+        }
+    if DB_CONNECTION_MODE in ('persistent', 'serverless'):
+        return {'CONN_MAX_AGE': DB_CONN_MAX_AGE, 'CONN_HEALTH_CHECKS': True}
+    return {'CONN_MAX_AGE': 0}
+
 if DATABASE_URL:
     # Parse the database URL and add Supabase-specific configurations
     import dj_database_url
@@ -131,21 +167,22 @@ if DATABASE_URL:
             'client_encoding': 'UTF8',
             'options': '-c timezone=utc',
         },
-        'CONN_MAX_AGE': 60,  # Connection pooling - keep connections alive for 60 seconds
-        'CONN_HEALTH_CHECKS': True,  # Enable connection health checks
         'ATOMIC_REQUESTS': False,  # Disable atomic requests for better performance
         'AUTOCOMMIT': True,  # Enable autocommit
     })
+    db_config.update(connection_settings(db_config['ENGINE']))
     
-    # Force IPv4 connection if IPv6 fails
-    if 'HOST' in db_config:
-        # Try to resolve host to IPv4 if possible
+    # Optionally connect over IPv4 where IPv6 routes fail. This resolves the
+    # host while settings load, so it is off by default; libpq still uses
+    # HOST for TLS.
+    if DB_FORCE_IPV4 and db_config.get('HOST'):
+        import socket
         try:
-            import socket
-            host = db_config['HOST']
-            # Try to get IPv4 address
-            ipv4_address = socket.gethostbyname(host)
-            db_config['HOST'] = ipv4_address
+            ipv4_address = socket.gethostbyname(db_config['HOST'])
+            if 'postgresql' in db_config['ENGINE']:
+                db_config['OPTIONS']['hostaddr'] = ipv4_address
+            else:
+                db_config['HOST'] = ipv4_address
         except (socket.gaierror, socket.herror):
             # If resolution fails, keep original host
             pass
@@ -159,6 +196,7 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            **connection_settings('django.db.backends.sqlite3'),
         }
     }
 
@@ -232,12 +270,6 @@ if CLOUDINARY_CLOUD_NAME and CLOUDINARY_API_KEY and CLOUDINARY_API_SECRET:
         'STATIC_IMAGES_EXTENSIONS': ['jpg', 'jpe', 'jpeg', 'jpc', 'jp2', 'j2k', 'wdp', 'jxr', 'hdp', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff', 'ico'],
         'MAGIC_FILE_PATH': 'magic',
     })
-    
-    # Import and verify Cloudinary storage
-    try:
-        from cloudinary_storage.storage import MediaCloudinaryStorage
-    except ImportError as e:
-        raise
 else:
     # Use local media storage (development only)
     MEDIA_URL = '/media/'
@@ -254,26 +286,9 @@ if CLOUDINARY_CLOUD_NAME and CLOUDINARY_API_KEY and CLOUDINARY_API_SECRET:
     FILE_UPLOAD_PERMISSIONS = None  # Don't set file permissions
     FILE_UPLOAD_DIRECTORY_PERMISSIONS = None  # Don't set directory permissions
     
-    # Ensure Django uses Cloudinary for all file operations
-    import cloudinary
-    import cloudinary.uploader
-    import cloudinary.api
-    
-    # Configure Cloudinary
-    cloudinary.config(
-        cloud_name=CLOUDINARY_CLOUD_NAME,
-        api_key=CLOUDINARY_API_KEY,
-        api_secret=CLOUDINARY_API_SECRET
-    )
-    
-    # Test Cloudinary connection
-    try:
-        # Try a simple API call to test the connection
-        result = cloudinary.api.ping()
-    except Exception as e:
-        pass  # Silently handle connection test failures
-    
-    # Additional storage configuration to prevent filesystem fallback
+    # The storage backends are created on first use, and configure the
+    # Cloudinary client from CLOUDINARY_STORAGE then; nothing connects to
+    # Cloudinary while settings load
     STORAGES = {
         "default": {
             "BACKEND": "cloudinary_storage.storage.MediaCloudinaryStorage",
@@ -283,6 +298,123 @@ if CLOUDINARY_CLOUD_NAME and CLOUDINARY_API_KEY and CLOUDINARY_API_SECRET:
         },
     }
 
+# Image processing
+# Resample speed tier for resizes: 'fast', 'balanced' or 'best' (full LANCZOS).
+# Bulk (multi-image) submissions use IMAGE_BULK_RESAMPLE_TIER so they can be
+# moved to a cheaper tier under load while single images keep the default.
+IMAGE_RESAMPLE_TIER = get_env_variable('IMAGE_RESAMPLE_TIER', 'best')
+IMAGE_BULK_RESAMPLE_TIER = get_env_variable('IMAGE_BULK_RESAMPLE_TIER', IMAGE_RESAMPLE_TIER)
+
+# Threads used by the JPEG quality search for size-targeted output. Values
+# above 1 switch to a parallel k-ary search on a shared pool of this width,
+# so it also caps encode threads when many requests run concurrently.
+IMAGE_QUALITY_SEARCH_THREADS = int(get_env_variable('IMAGE_QUALITY_SEARCH_THREADS', '1'))
+
+# Process pool for multi-image submissions. 0 workers processes images inline
+# in the request thread. The queue depth bounds tasks waiting for a worker and
+# the task timeout (seconds) bounds both waiting for a slot and for a result.
+IMAGE_POOL_WORKERS = int(get_env_variable('IMAGE_POOL_WORKERS', '0'))
+IMAGE_POOL_QUEUE_DEPTH = int(get_env_variable('IMAGE_POOL_QUEUE_DEPTH', '20'))
+IMAGE_POOL_TASK_TIMEOUT = int(get_env_variable('IMAGE_POOL_TASK_TIMEOUT', '120'))
+
+# Threads uploading the originals and outputs of a submission while the next
+# image is processed (0 uploads inline). Failed writes are retried this many
+# times, waiting the delay (seconds) and doubling it between attempts.
+IMAGE_STORAGE_WRITE_WORKERS = int(get_env_variable('IMAGE_STORAGE_WRITE_WORKERS', '4'))
+IMAGE_STORAGE_WRITE_RETRIES = int(get_env_variable('IMAGE_STORAGE_WRITE_RETRIES', '2'))
+IMAGE_STORAGE_WRITE_RETRY_DELAY = float(get_env_variable('IMAGE_STORAGE_WRITE_RETRY_DELAY', '0.5'))
+
+# Encoder speed/size trade-off for every output format: 'fast', 'balanced' or
+# 'small'. See image_processor/encoders.py for the per-format options.
+IMAGE_ENCODER_PROFILE = get_env_variable('IMAGE_ENCODER_PROFILE', 'balanced')
+
+# Processed-output cache (see image_processor/result_cache.py). Defaults to a
+# bounded on-disk store per machine; set IMAGE_RESULT_CACHE_BACKEND and
+# IMAGE_RESULT_CACHE_LOCATION to e.g. django.core.cache.backends.redis.RedisCache
+# and a redis:// URL to share it across nodes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'image_results': {
+        'BACKEND': get_env_variable('IMAGE_RESULT_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': get_env_variable('IMAGE_RESULT_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'images_resizer_results')),
+        'TIMEOUT': int(get_env_variable('IMAGE_RESULT_CACHE_TIMEOUT', str(7 * 24 * 3600))),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(get_env_variable('IMAGE_RESULT_CACHE_MAX_ENTRIES', '1000')),
+        },
+    },
+}
+IMAGE_RESULT_CACHE_ALIAS = 'image_results'
+IMAGE_RESULT_CACHE_TIMEOUT = CACHES['image_results']['TIMEOUT']
+IMAGE_RESULT_CACHE_MAX_ITEM_BYTES = int(get_env_variable('IMAGE_RESULT_CACHE_MAX_ITEM_BYTES', str(5 * 1024 * 1024)))
+
+# Results page previews (see image_processor/thumbnails.py). Thumbnails cover
+# a WIDTH x HEIGHT box at 1x and 2x density; a width or height of 0 turns
+# them off and the page falls back to the full output.
+IMAGE_THUMBNAIL_WIDTH = int(get_env_variable('IMAGE_THUMBNAIL_WIDTH', '400'))
+IMAGE_THUMBNAIL_HEIGHT = int(get_env_variable('IMAGE_THUMBNAIL_HEIGHT', '160'))
+IMAGE_THUMBNAIL_FORMAT = get_env_variable('IMAGE_THUMBNAIL_FORMAT', 'webp')
+IMAGE_THUMBNAIL_QUALITY = int(get_env_variable('IMAGE_THUMBNAIL_QUALITY', '75'))
+
+# 'sync' processes uploads inside the request. 'queue' only stores them and
+# leaves the work to `manage.py process_jobs` workers, so request time no
+# longer grows with batch size.
+IMAGE_PROCESSING_MODE = get_env_variable('IMAGE_PROCESSING_MODE', 'sync')
+
+# Whether uploaded originals are kept. 'off' stores every original so images
+# can be reprocessed later; 'optional' lets the upload form skip storing them
+# and 'always' never stores them. Ephemeral sessions are processed straight
+# from the upload, in the request even in queue mode, and only keep outputs.
+IMAGE_EPHEMERAL_MODE = get_env_variable('IMAGE_EPHEMERAL_MODE', 'off')
+
+# Single-image downloads redirect to the storage backend's own (signed where
+# supported) URL instead of passing the file through the worker. Local files
+# are always streamed.
+IMAGE_DOWNLOAD_REDIRECTS = get_env_variable('IMAGE_DOWNLOAD_REDIRECTS', 'True') == 'True'
+
+# Decode budgets (see image_processor/admission.py). Each render is charged
+# its estimated decoded size against a per-process budget and, when
+# IMAGE_HOST_DECODE_BUDGET_MB is set, a budget shared by all processes on the
+# machine. Requests wait up to IMAGE_ADMISSION_WAIT seconds for budget before
+# getting a 429 with Retry-After: IMAGE_ADMISSION_RETRY_AFTER.
+IMAGE_PROCESS_DECODE_BUDGET_MB = int(get_env_variable('IMAGE_PROCESS_DECODE_BUDGET_MB', '1024'))
+IMAGE_HOST_DECODE_BUDGET_MB = int(get_env_variable('IMAGE_HOST_DECODE_BUDGET_MB', '0'))
+IMAGE_HOST_BUDGET_FILE = get_env_variable('IMAGE_HOST_BUDGET_FILE', os.path.join(tempfile.gettempdir(), 'images_resizer_decode_budget.json'))
+IMAGE_ADMISSION_WAIT = float(get_env_variable('IMAGE_ADMISSION_WAIT', '10'))
+IMAGE_ADMISSION_RETRY_AFTER = int(get_env_variable('IMAGE_ADMISSION_RETRY_AFTER', '5'))
+
+# TIFF and PNG sources whose decoded size reaches IMAGE_STRIP_THRESHOLD_MB are
+# decoded and resized in bands of about IMAGE_STRIP_BAND_MB (see
+# image_processor/strips.py). IMAGE_MAX_SOURCE_PIXELS is the largest source
+# that is opened at all; sources over Pillow's own limit are only accepted
+# when they can be decoded in bands.
+IMAGE_STRIP_THRESHOLD_MB = int(get_env_variable('IMAGE_STRIP_THRESHOLD_MB', '256'))
+IMAGE_STRIP_BAND_MB = int(get_env_variable('IMAGE_STRIP_BAND_MB', '16'))
+IMAGE_MAX_SOURCE_PIXELS = int(get_env_variable('IMAGE_MAX_SOURCE_PIXELS', '320000000'))
+
+# Record per-stage processing timings on each request (see
+# image_processor/tracing.py); they show up in the admin. Off by default.
+IMAGE_TRACING = get_env_variable('IMAGE_TRACING', 'False') == 'True'
+
+# Processing diagnostics go through the image_processor logger. Set
+# IMAGE_LOG_LEVEL=DEBUG to see per-image messages.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'image_processor': {
+            'handlers': ['console'],
+            'level': get_env_variable('IMAGE_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
+
 # Crispy Forms Settings
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"